@@ -8,7 +8,10 @@ from widgets.signal_selection_widget import SignalSelectionWidget
 from widgets.existing_calc_selection_widget import ExistingCalcSelectionWidget
 from widgets.calctype_selection_widget import (CreateNewCalculationWidget,
                                                EditCalculationWidget)
-from calculations.database_queries import update_data
+from widgets.job_queue_widget import JobQueueWidget
+from calculations.caches import get_signal_catalog
+from calculations.database_queries import start_write_listener
+from calculations.scheduler import schedule_tasks
 
 #import os
 #import numpy as np
@@ -47,11 +50,26 @@ def open_modal_callback(event, modal_type, input_data):
 def my_panel_app():
     logging.info("New session created")
 
-    def button_click_handler(attr, old, new):
-        if new == 0:
-            final_layout[1] = SignalSelectionWidget(df, open_modal_callback=open_modal_callback).layout
+    # Vyerna byggs första gången de visas och lever sedan hela sessionen,
+    # flikbyte döljer den ena och visar den andra
+    views = {}
+
+    def build_view(active):
+        if active == 0:
+            return SignalSelectionWidget(get_signal_catalog(), open_modal_callback=open_modal_callback)
+        return ExistingCalcSelectionWidget(open_modal_callback=open_modal_callback)
+
+    def show_view(active):
+        if active not in views:
+            views[active] = build_view(active)
+            final_layout.append(views[active].layout)
         else:
-            final_layout[1] = ExistingCalcSelectionWidget(open_modal_callback=open_modal_callback).layout
+            views[active].refresh()
+        for key, view in views.items():
+            view.layout.visible = key == active
+
+    def button_click_handler(attr, old, new):
+        show_view(new)
 
     radio_button_group = RadioButtonGroup(
         labels=["Skapa beräkning", "Existerande beräkningar"],
@@ -59,14 +77,19 @@ def my_panel_app():
         width=250,
         height=30)
     radio_button_group.on_change('active', button_click_handler)
-    
-    final_layout = pn.Column(radio_button_group,
-                             SignalSelectionWidget(df, open_modal_callback=open_modal_callback).layout)
+
+    final_layout = pn.Column(radio_button_group)
+    show_view(radio_button_group.active)
 
     ui.main.append(final_layout)
+    ui.main.append(JobQueueWidget().layout)
     ui.servable()
 
 pn.extension('tabulator')
+# Schemaläggs en gång per process, samma namn från flera sessioner ignoreras
+schedule_tasks()
+# Cacherna i den här processen töms även när andra processer (--num-procs) skriver
+start_write_listener()
 ui = pn.template.BootstrapTemplate(favicon="images/favicon2.png", 
                                    site="Flödesberäkningar?", 
                                    title="Självfallet!")
@@ -76,5 +99,4 @@ logout.js_on_click(code="""window.location.href = './logout'""")
 div_session_timeout = Div(name='div_inactivity', text='')
 ui.header.append(logout)
 ui.header.append(div_session_timeout)
-df = update_data()
 my_panel_app()
@@ -0,0 +1,52 @@
+"""
+Benchmark of the flow kernels in calculations.flow_kernels against the
+original array implementations in benchmarks/flow_references.py. Parity
+is checked by tests/test_flow_kernels.py.
+
+    python -m benchmarks.flow_kernels 100000 1000000 10000000
+"""
+import argparse
+import logging
+import time
+import numpy as np
+from calculations import flow_kernels
+from benchmarks.flow_references import reference_overfall, reference_pipe, synthetic_level
+
+
+def timed(func, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("sizes", nargs="*", type=int, default=[100_000, 1_000_000, 10_000_000])
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    print(f"numba {'installed' if flow_kernels.compiled else 'not installed'}")
+
+    kernels = [("numpy", False)] + ([("numba", True)] if flow_kernels.compiled else [])
+    header = f"{'samples':>10} {'kernel':>6} {'overfall ref':>13} {'overfall':>9} {'pipe ref':>9} {'pipe':>9}"
+    print(header)
+    for n in args.sizes:
+        level = synthetic_level(n, 0.5)
+        out = np.empty(n), np.empty(n), np.empty(n)
+        overfall_ref = timed(lambda: reference_overfall(level, 0.3, 1.0, "l/s"))
+        pipe_ref = timed(lambda: reference_pipe(level, 3, 330, 1, "l/s"))
+        for name, use_compiled in kernels:
+            flow_kernels.overfall_flow(level[:10], 0.3, 1.0, use_compiled=use_compiled)  # kompilering
+            overfall = timed(lambda: flow_kernels.overfall_flow(level, 0.3, 1.0, 1000, out=out[0],
+                                                                use_compiled=use_compiled))
+            pipe = timed(lambda: flow_kernels.cole_white_flow(level, 0.165, 0.001, 0.003, 1000, out=out,
+                                                              use_compiled=use_compiled))
+            print(f"{n:>10} {name:>6} {overfall_ref:>12.3f}s {overfall:>8.3f}s {pipe_ref:>8.3f}s {pipe:>8.3f}s"
+                  f"   ({overfall_ref / overfall:.1f}x, {pipe_ref / pipe:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""
+Reference implementations of the flow models for the kernels in
+calculations.flow_kernels: the overfall formula as it was before
+flow_kernels (reference_overfall) and cole_white_new, which is unchanged
+(reference_pipe), plus a synthetic level series with the edge values.
+Shared by benchmarks/flow_kernels.py and tests/test_flow_kernels.py.
+"""
+import numpy as np
+from calculations import flow_kernels
+from calculations.flow_calculations import cole_white_new
+
+
+def reference_overfall(level, skibordshojd, skibordsbredd, unit):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        g = 9.81
+        b = float(skibordsbredd)
+        p = float(skibordshojd)
+        h = np.array(level) - p
+        h[h < 0] = 0
+        Ce = 0.602 + 0.083 * h / p
+        Q = Ce * 2/3 * np.sqrt(2*g)*b*h**1.5
+        Q[np.isnan(Q)] = 0.0
+        if unit == "l/s":
+            Q *= 1000
+        return Q.flatten()
+
+
+def reference_pipe(level, slope, diameter, roughness, unit):
+    Q = cole_white_new(level, slope, diameter, roughness, unit, dataframe=False)
+    velocity = cole_white_new(level, slope, diameter, roughness, unit, velocity_output=True)
+    return Q, velocity, level - flow_kernels.head_loss_factor * velocity**2
+
+
+def synthetic_level(n, top):
+    rng = np.random.default_rng(0)
+    level = rng.uniform(-0.1 * top, 1.5 * top, n)
+    level[rng.integers(0, n, max(n // 1000, 1))] = np.nan
+    # Kantfall: noll, exakt fullt/skibordshöjd, NaN och negativ nivå
+    level[:4] = [0.0, top, np.nan, -1.0]
+    return level
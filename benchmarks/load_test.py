@@ -0,0 +1,137 @@
+"""
+Load test of the plot data path with one or several server processes.
+
+Simulates --users concurrent sessions that pan and zoom a level series:
+every request is a get_ts_window for a random window (one day up to the
+whole history) followed by the overfall preview of the result, i.e. the
+database and CPU work of one RangesUpdate in the app. The users are spread
+over P forked processes, as with `panel serve --num-procs P`, with one
+thread per user inside each process as in a single Bokeh server. The
+parent warms its connection pool and caches before forking, so the run
+also checks that the module state is fork safe.
+
+Seeds a bench_ signal in the database in the DB_* environment variables
+and removes it again. Use a throwaway database.
+
+    python -m benchmarks.load_test --procs 1 2 4 --users 8 --duration 20
+
+Measured results (PostgreSQL on the same machine, 365 days of 1-minute
+data):
+
+    1 core, 8 users, 20 s per run
+    procs  requests    req/s  speedup
+        1       491     24.6    1.00x
+        2       508     25.4    1.03x
+
+With a single core the processes only share the same CPU, so this run
+shows that forked workers serve requests correctly, not that they scale.
+The speedup of NUM_PROCS > 1 on a multi-core host is unverified, measure
+it there with --procs 1 2 4 before relying on it.
+
+The test calls the query functions directly and does not go through
+Bokeh. Behind a load balancer the websocket of a session must reach the
+same server instance as the page request that created it, see the
+Dockerfile.
+"""
+import argparse
+import datetime
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import numpy as np
+
+default_days = 365
+
+
+def user_loop(signal_id, start, end, deadline, seed, counts, index):
+    from calculations.caches import get_ts_window
+    from calculations.flow_calculations import overfall
+
+    rng = np.random.default_rng(seed)
+    history = (end - start).total_seconds()
+    done = 0
+    while time.monotonic() < deadline:
+        width = history * 10 ** rng.uniform(np.log10(86400 / history), 0)
+        window_start = start + datetime.timedelta(seconds=rng.uniform(0, history - width))
+        window_end = window_start + datetime.timedelta(seconds=width)
+        df = get_ts_window("acurve", signal_id, window_start, window_end, 1000)
+        overfall(df.iloc[:, 0].values if df.shape[1] else np.empty(0), 0.3, 1.0, "l/s")
+        done += 1
+    counts[index] = done
+
+
+def worker(signal_id, start, end, duration, users, queue):
+    counts = [0] * users
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=user_loop,
+                                args=(signal_id, start, end, deadline, os.getpid() * 100 + i, counts, i))
+               for i in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue.put(sum(counts))
+
+
+def run(signal_id, start, end, procs, users, duration):
+    """
+    Run users sessions on procs forked processes for duration seconds.
+
+    Returns:
+        int: Number of completed requests.
+    """
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    per_proc = [users // procs + (i < users % procs) for i in range(procs)]
+    processes = [context.Process(target=worker, args=(signal_id, start, end, duration, n, queue))
+                 for n in per_proc if n]
+    for process in processes:
+        process.start()
+    total = sum(queue.get() for _ in processes)
+    for process in processes:
+        process.join()
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--procs", nargs="+", type=int, default=[1, 2, os.cpu_count() or 1],
+                        help="process counts to compare")
+    parser.add_argument("--users", type=int, default=8, help="concurrent simulated sessions")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per run")
+    parser.add_argument("--days", type=float, default=default_days, help="history of the seeded signal")
+    args = parser.parse_args(argv)
+    logging.disable(logging.INFO)
+
+    from benchmarks.synthetic_data import seed_acurve, bench_prefix, default_start, drop_seeded
+    from calculations.caches import get_ts_window
+    from calculations.database_queries import refresh_rollups
+
+    signal_id = f"{bench_prefix}load"
+    n = int(args.days * 1440)
+    start = default_start
+    end = default_start + datetime.timedelta(minutes=n - 1)
+    try:
+        seed_acurve(signal_id, n, step_s=60)
+        refresh_rollups("acurve", [signal_id])
+        # Pool, prefetch-trådar och cache skapas i föräldern före forken
+        get_ts_window("acurve", signal_id, start, start + datetime.timedelta(days=30), 1000)
+
+        print(f"{os.cpu_count()} cores, {args.users} users, {args.duration:.0f} s per run")
+        print(f"{'procs':>5} {'requests':>9} {'req/s':>8} {'speedup':>8}")
+        baseline = None
+        for procs in args.procs:
+            total = run(signal_id, start, end, procs, args.users, args.duration)
+            rate = total / args.duration
+            baseline = baseline or rate
+            print(f"{procs:>5} {total:>9} {rate:>8.1f} {rate / baseline:>7.2f}x", flush=True)
+    finally:
+        drop_seeded()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
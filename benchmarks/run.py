@@ -0,0 +1,195 @@
+"""
+Benchmark suite for flow_calculations and database_queries.
+
+Times the flow models and dataframe_to_input_data on synthetic level series
+of several lengths. With --db it also times get_ts_from_id and the writers
+against the database in the DB_* environment variables, which is seeded by
+benchmarks.synthetic_data and cleaned up again. Use a throwaway database.
+
+Results are written to benchmarks/results/<commit>.json. --compare reads an
+earlier result (commit or file) and exits with status 1 if any benchmark
+got slower than --threshold times its earlier best.
+
+    python -m benchmarks.run                                  # compute only
+    python -m benchmarks.run --db --sizes 10000 100000 1000000
+    python -m benchmarks.run --compare 1a2b3c4 --threshold 1.25
+"""
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from os import path, makedirs
+import numpy as np
+import pandas as pd
+
+results_dir = path.join(path.dirname(path.abspath(__file__)), "results")
+default_sizes = [10_000, 100_000, 1_000_000]
+# Skrivningarna mot databasen är långsamma, större serier än så här hoppas över
+max_write_rows = 1_000_000
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       cwd=path.dirname(results_dir), stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def timed(func, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"best_s": min(times), "median_s": statistics.median(times), "repeat": repeat}
+
+
+def compute_benchmarks(sizes):
+    from benchmarks.synthetic_data import level_series
+    from calculations.database_queries import dataframe_to_input_data
+    from calculations.flow_calculations import overfall, cole_white_new, cole_white_with_loss
+
+    for n in sizes:
+        times, level = level_series(n)
+        series = pd.Series(level, index=pd.DatetimeIndex(times))
+        flow_df = pd.DataFrame({"Flöde (l/s)": level}, index=pd.DatetimeIndex(times))
+        yield f"overfall[{n}]", lambda: overfall(level, 0.3, 1.0, "l/s")
+        yield f"cole_white_new[{n}]", lambda: cole_white_new(level, 3, 330, 1, "l/s", dataframe=False)
+        yield f"cole_white_with_loss[{n}]", lambda: cole_white_with_loss(series, 3, 330, 1, "l/s")
+        yield f"dataframe_to_input_data[{n}]", lambda: dataframe_to_input_data(flow_df, "bench")
+
+
+def db_benchmarks(sizes):
+    from benchmarks.synthetic_data import seed_acurve, level_series, bench_prefix, default_start
+    from calculations import database_queries
+    from calculations.database_queries import (get_ts_from_id, store_calc_ts, store_calc_dataframe,
+                                               store_calc_metadata, delete_data_by_id,
+                                               dataframe_to_input_data, refresh_rollups)
+
+    signal_id = f"{bench_prefix}read"
+    unique_id = f"{bench_prefix}write"
+    seed_acurve(signal_id, max(sizes), step_s=60)
+    refresh_rollups("acurve", [signal_id])
+    month_end = default_start + datetime.timedelta(days=30)
+    history_end = default_start + datetime.timedelta(minutes=max(sizes) - 1)
+
+    def overview(rollups):
+        database_queries.use_rollups = rollups
+        try:
+            get_ts_from_id(signal_id, default_start, history_end, max_points=2000)
+        finally:
+            database_queries.use_rollups = True
+
+    def reset_write():
+        delete_data_by_id(unique_id)
+        store_calc_metadata(unique_id, unique_id, signal_id, "overfall", "l/s", (0.3, 1.0))
+
+    for n in sizes:
+        end = default_start + datetime.timedelta(minutes=n - 1)
+        yield f"get_ts_from_id.raw[{n}]", lambda: get_ts_from_id(signal_id, default_start, end), None
+        yield (f"get_ts_from_id.max_points[{n}]",
+               lambda: get_ts_from_id(signal_id, default_start, end, max_points=2000), None)
+        if n > max_write_rows:
+            continue
+        times, level = level_series(n)
+        df = pd.DataFrame({"Flöde (l/s)": level}, index=pd.DatetimeIndex(times))
+        yield f"store_calc_ts[{n}]", lambda: store_calc_ts(dataframe_to_input_data(df, unique_id)), reset_write
+        yield f"store_calc_dataframe[{n}]", lambda: store_calc_dataframe(df, unique_id), reset_write
+    yield "get_ts_from_id.month", lambda: get_ts_from_id(signal_id, default_start, month_end), None
+    yield "get_ts_from_id.overview.raw", lambda: overview(False), None
+    yield "get_ts_from_id.overview.rollup", lambda: overview(True), None
+
+
+def cleanup_db():
+    from benchmarks.synthetic_data import drop_seeded
+    drop_seeded()
+
+
+def load_result(ref):
+    file_path = ref if path.isfile(ref) else path.join(results_dir, f"{ref}.json")
+    with open(file_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare(old, new, threshold):
+    """
+    Print the change of every benchmark in both results.
+
+    Returns:
+        list of str: Benchmarks slower than threshold times before.
+    """
+    regressions = []
+    print(f"\n{'benchmark':<40} {old['commit']:>10} {new['commit']:>10} {'ratio':>7}")
+    for name, result in new["results"].items():
+        if name not in old["results"]:
+            continue
+        before, after = old["results"][name]["best_s"], result["best_s"]
+        ratio = after / before if before > 0 else float("inf")
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print(f"{name:<40} {before:>9.4f}s {after:>9.4f}s {ratio:>6.2f}x{flag}")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", type=int, default=default_sizes, help="series lengths")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark, best is kept")
+    parser.add_argument("--db", action="store_true", help="include database benchmarks (DB_* env)")
+    parser.add_argument("--filter", default="", help="only benchmarks whose name contains this")
+    parser.add_argument("--output", help="result file (default benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="earlier result to compare with: commit or file")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown ratio reported as regression (default 1.25)")
+    args = parser.parse_args(argv)
+    logging.disable(logging.INFO)
+
+    commit = git_commit()
+    result = {"commit": commit,
+              "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "pandas": pd.__version__,
+              "sizes": args.sizes,
+              "results": {}}
+
+    # Generatorerna konsumeras en i taget, varje lambda körs innan nästa serie byggs
+    benchmarks = [((name, func, None) for name, func in compute_benchmarks(args.sizes))]
+    if args.db:
+        benchmarks.append(db_benchmarks(args.sizes))
+    try:
+        for name, func, setup in itertools.chain(*benchmarks):
+            if args.filter not in name:
+                continue
+            result["results"][name] = timed(func, args.repeat, setup)
+            print(f"{name:<40} {result['results'][name]['best_s']:>9.4f}s", flush=True)
+    finally:
+        if args.db:
+            cleanup_db()
+
+    output = args.output or path.join(results_dir, f"{commit}.json")
+    makedirs(path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"Resultat sparat i {output}")
+
+    if args.compare:
+        regressions = compare(load_result(args.compare), result, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) slower than {args.threshold}x: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""
+Benchmark of the time-series writers against a throwaway database.
+
+Compares the old path (dataframe_to_input_data + store_calc_ts with
+execute_values) with store_calc_dataframe (binary COPY into a staging table
+and one merge). Uses the usual DB_* environment variables.
+
+    python -m benchmarks.store_calc_ts 100000 1000000
+"""
+import argparse
+import datetime
+import time
+import numpy as np
+import pandas as pd
+from calculations.database_queries import (dataframe_to_input_data, store_calc_ts,
+                                           store_calc_dataframe, store_calc_metadata,
+                                           delete_data_by_id)
+
+bench_id = "benchmark_store_calc_ts"
+
+
+def synthetic_result(n_rows):
+    index = pd.date_range(datetime.datetime(2000, 1, 1), periods=n_rows, freq="min")
+    return pd.DataFrame({"Flöde (l/s)": np.random.default_rng(0).random(n_rows) * 100}, index=index)
+
+
+def bench_execute_values(df):
+    start = time.perf_counter()
+    store_calc_ts(dataframe_to_input_data(df, bench_id))
+    return time.perf_counter() - start
+
+
+def bench_binary_copy(df):
+    start = time.perf_counter()
+    store_calc_dataframe(df, bench_id)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("sizes", nargs="*", type=int, default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'execute_values rows/s':>22} {'binary COPY rows/s':>20} {'speed-up':>9}")
+    for n_rows in args.sizes:
+        df = synthetic_result(n_rows)
+        results = []
+        for bench in (bench_execute_values, bench_binary_copy):
+            delete_data_by_id(bench_id)
+            store_calc_metadata(bench_id, bench_id, bench_id, "overfall", "l/s", (1.0, 1.0))
+            results.append(bench(df))
+        delete_data_by_id(bench_id)
+        old, new = results
+        print(f"{n_rows:>10} {n_rows / old:>22.0f} {n_rows / new:>20.0f} {old / new:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
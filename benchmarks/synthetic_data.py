@@ -0,0 +1,130 @@
+"""
+Synthetic level data for benchmarks, and seeding of a throwaway database.
+
+The level series has a daily cycle, a slow seasonal drift, rain events that
+rise fast and drain exponentially, sensor noise and short dropouts (NaN),
+so that it behaves like real acurve_ts data in the flow models, the
+downsampling and the database.
+
+Seeded rows use IDs starting with "bench_" and are removed again with
+drop_seeded(). Uses the usual DB_* environment variables.
+
+    python -m benchmarks.synthetic_data --signals 3 --days 365 --step 60
+"""
+import argparse
+import datetime
+import io
+import numpy as np
+from calculations.database_queries import (get_connection, _encode_binary_copy, store_calc_metadata,
+                                           store_calc_arrays, delete_data_by_id, ensure_schema)
+from calculations.flow_calculations import overfall
+
+bench_prefix = "bench_"
+default_start = datetime.datetime(2020, 1, 1)
+
+
+def level_series(n, step_s=60, start=default_start, seed=0, base=0.3, dropout_rate=1e-3):
+    """
+    Synthetic level (m) with n samples every step_s seconds.
+
+    Returns:
+        tuple: (datetime64[ms] array, float64 array)
+    """
+    rng = np.random.default_rng(seed)
+    times = np.datetime64(start, "ms") + np.arange(n, dtype=np.int64) * np.timedelta64(int(step_s * 1000), "ms")
+    t_days = np.arange(n) * (step_s / 86400)
+
+    level = base + 0.05 * np.sin(2 * np.pi * t_days) + 0.03 * np.sin(2 * np.pi * t_days / 365)
+
+    # Regn: Poissonfördelade händelser (ungefär en i veckan), momentan ökning
+    # och exponentiell avtappning, beräknat segment för segment mellan händelserna
+    n_events = rng.poisson(t_days[-1] / 7) if n else 0
+    starts = np.unique(rng.integers(0, max(n, 1), n_events))
+    amplitudes = rng.gamma(2.0, 0.08, starts.size)
+    decay_rate = step_s / (6 * 3600)
+    rain_level = 0.0
+    for k, start_idx in enumerate(starts):
+        end_idx = starts[k + 1] if k + 1 < starts.size else n
+        if k:
+            rain_level *= np.exp(-decay_rate * (start_idx - starts[k - 1]))
+        rain_level += amplitudes[k]
+        level[start_idx:end_idx] += rain_level * np.exp(-decay_rate * np.arange(end_idx - start_idx))
+
+    level += rng.normal(0, 0.002, n)
+    level[rng.random(n) < dropout_rate] = np.nan
+    return times, level
+
+
+def seed_acurve(signal_id, n, step_s=60, start=default_start, seed=0):
+    """
+    Write a synthetic level series to public.acurve_ts with binary COPY.
+    """
+    times, level = level_series(n, step_s, start, seed)
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM public.acurve_ts WHERE signal = %s", (signal_id,))
+        cur.copy_expert("COPY public.acurve_ts (timestamp, value, signal) FROM STDIN (FORMAT binary)",
+                        io.BytesIO(_encode_binary_copy(times, level, signal_id)))
+        conn.commit()
+    return times, level
+
+
+def seed_flow(unique_id, signal_id, times, level):
+    """
+    Store a synthetic overfall calculation of level in flow_meta / flow_ts.
+    """
+    delete_data_by_id(unique_id)
+    store_calc_metadata(unique_id, unique_id, signal_id, "overfall", "l/s", (0.3, 1.0))
+    store_calc_arrays(times, overfall(level, 0.3, 1.0, "l/s"), unique_id, high_water_mark=times[-1])
+
+
+def seed_database(signals=3, days=365, step_s=60):
+    """
+    Seed bench_signal_<i> in acurve_ts and an overfall calculation
+    bench_flow_<i> of each in flow_ts.
+
+    Returns:
+        list of str: The seeded signal IDs.
+    """
+    n = int(days * 86400 / step_s)
+    signal_ids = []
+    for i in range(signals):
+        signal_id = f"{bench_prefix}signal_{i}"
+        times, level = seed_acurve(signal_id, n, step_s, seed=i)
+        seed_flow(f"{bench_prefix}flow_{i}", signal_id, times, level)
+        signal_ids.append(signal_id)
+    return signal_ids
+
+
+def drop_seeded():
+    """
+    Remove everything seeded by this module.
+    """
+    ensure_schema()
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM public.acurve_ts WHERE signal LIKE %s", (bench_prefix + "%",))
+        cur.execute("DELETE FROM flowcalc_schema.acurve_rollup WHERE signal LIKE %s", (bench_prefix + "%",))
+        cur.execute("DELETE FROM flowcalc_schema.rollup_state WHERE kind = 'acurve' AND id LIKE %s",
+                    (bench_prefix + "%",))
+        cur.execute("SELECT unique_id FROM flowcalc_schema.flow_meta WHERE unique_id LIKE %s",
+                    (bench_prefix + "%",))
+        unique_ids = [row[0] for row in cur.fetchall()]
+        conn.commit()
+    for unique_id in unique_ids:
+        delete_data_by_id(unique_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--signals", type=int, default=3)
+    parser.add_argument("--days", type=float, default=365)
+    parser.add_argument("--step", type=float, default=60, help="seconds between samples")
+    parser.add_argument("--drop", action="store_true", help="remove seeded data and exit")
+    args = parser.parse_args()
+    if args.drop:
+        drop_seeded()
+        return
+    print(seed_database(args.signals, args.days, args.step))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Async counterparts of the read queries used by the widget callbacks.
+
+Each coroutine runs the synchronous query from database_queries / caches on
+a thread pool with as many threads as the connection pool has connections,
+and awaits it. psycopg2 releases the GIL while it waits for the server, so
+a session awaiting a slow window no longer blocks the Tornado event loop:
+the callbacks of other sessions run, and their queries overlap on the
+other pooled connections. The queries, their statement cache, the month
+cache and the rollup routing are shared with the synchronous API.
+
+Callbacks that await these must run with the session's document lock, see
+widgets.job_queue_widget.run_in_session.
+"""
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from calculations import database_queries, caches
+
+
+logger = logging.getLogger(__name__)
+logger.propagate = False
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    The process-wide query thread pool, created on first use with
+    pool_size + pool_max_overflow threads.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=database_queries.pool_size + database_queries.pool_max_overflow,
+                    thread_name_prefix="db-async")
+    return _executor
+
+
+def _after_fork_in_child():
+    global _executor, _executor_lock
+    # Förälderns trådar följer inte med, poolen skapas på nytt vid första anrop
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+async def run_query(func, *args, **kwargs):
+    """
+    Await func(*args, **kwargs) run on the query thread pool.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), partial(func, *args, **kwargs))
+
+
+async def get_ts_window(kind, selected_id, start_time, end_time, max_points):
+    """
+    See calculations.caches.get_ts_window.
+    """
+    return await run_query(caches.get_ts_window, kind, selected_id, start_time, end_time, max_points)
+
+
+async def get_ts_windows(kind, selected_ids, start_time, end_time, max_points):
+    """
+    Downsampled plot data of several series in one round trip, one column
+    per ID, see get_ts_from_ids / get_flow_ts_from_ids. Not cached.
+    """
+    fetch = database_queries.get_ts_from_ids if kind == "acurve" else database_queries.get_flow_ts_from_ids
+    return await run_query(fetch, list(selected_ids), start_time, end_time, max_points=max_points)
+
+
+async def get_ts_extent(kind, selected_id):
+    """
+    See database_queries.get_ts_extent.
+    """
+    return await run_query(database_queries.get_ts_extent, kind, selected_id)
+
+
+async def get_ts_from_id(selected_id, start_time, end_time, **kwargs):
+    """
+    See database_queries.get_ts_from_id.
+    """
+    return await run_query(database_queries.get_ts_from_id, selected_id, start_time, end_time, **kwargs)
+
+
+async def get_flow_ts_from_id(selected_id, start_time, end_time, **kwargs):
+    """
+    See database_queries.get_flow_ts_from_id.
+    """
+    return await run_query(database_queries.get_flow_ts_from_id, selected_id, start_time, end_time, **kwargs)
+
+
+async def get_flow_meta(unique_id):
+    """
+    See database_queries.get_flow_meta.
+    """
+    return await run_query(database_queries.get_flow_meta, unique_id)
+
+
+async def query_flow_meta(filters=None, sorters=None, page=1, page_size=50):
+    """
+    See database_queries.query_flow_meta.
+    """
+    return await run_query(database_queries.query_flow_meta, filters, sorters, page, page_size)
@@ -0,0 +1,155 @@
+"""
+Headless batch calculation of the calculations in flowcalc_schema.flow_meta.
+
+Calculations are fanned out over a process pool. Each worker holds a slot
+of a shared semaphore while it reads or writes the database, so at most
+--db-concurrency jobs use the database at the same time while the rest
+compute.
+
+    python -m calculations.batch_runner                      # full history, all calculations
+    python -m calculations.batch_runner --incremental        # only new input samples
+    python -m calculations.batch_runner --ids Q1 Q2 --since 2024-01-01
+    python -m calculations.batch_runner --rating-tables      # interpolate in rating tables
+    python -m calculations.batch_runner --rollups            # only refresh the rollup tables
+"""
+import argparse
+import datetime
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import logging_config
+from calculations import database_queries
+from calculations.database_queries import ensure_schema, get_flow_meta_data, refresh_rollups
+from calculations.incremental import refresh_calculation
+
+
+logger = logging.getLogger(__name__)
+logger.propagate = False
+
+_db_slot = None
+
+
+def _init_worker(db_slot):
+    global _db_slot
+    _db_slot = db_slot
+    # Anslutningar som ärvts från föräldern får inte användas eller stängas här
+    database_queries.dispose_pool(close=False)
+    database_queries.pool_size = 1
+    database_queries.pool_max_overflow = 0
+
+
+def run_job(meta, mode, since=None, rating_table=False):
+    """
+    Calculate and store one calculation in a worker process.
+
+    Parameters:
+        meta (dict): Row of flowcalc_schema.flow_meta.
+        mode (str): "full", "since" or "incremental".
+        since (datetime): Start time for mode "since".
+        rating_table (bool): Calculate with a rating table.
+
+    Returns:
+        tuple: (unique_id, samples, seconds, error message or None)
+    """
+    start = time.perf_counter()
+    if mode == "full":
+        meta = dict(meta, last_input_time=None)
+    try:
+        samples = refresh_calculation(meta, since=since if mode == "since" else None, db_slot=_db_slot,
+                                      rating_table=rating_table)
+        return meta["unique_id"], samples, time.perf_counter() - start, None
+    except Exception as e:
+        return meta["unique_id"], 0, time.perf_counter() - start, str(e)
+
+
+def run_batch(unique_ids=None, since=None, incremental=False, workers=None, db_concurrency=4,
+              rating_table=False):
+    """
+    Calculate and store many calculations in parallel.
+
+    Parameters:
+        unique_ids (list of str): Calculations to run, None for all.
+        since (datetime): Recalculate input from this time.
+        incremental (bool): Only calculate input newer than each
+            calculation's high-water mark.
+        workers (int): Number of processes, default one per core.
+        db_concurrency (int): Max number of jobs using the database at once.
+        rating_table (bool): Interpolate in per-parameter rating tables
+            instead of evaluating the flow model for every sample.
+
+    Returns:
+        list of tuple: Results of run_job, in completion order.
+    """
+    if since is not None and incremental:
+        raise ValueError("since and incremental are mutually exclusive")
+    mode = "since" if since is not None else "incremental" if incremental else "full"
+
+    ensure_schema()
+    meta_df = get_flow_meta_data()
+    if unique_ids:
+        meta_df = meta_df[meta_df["unique_id"].isin(unique_ids)]
+    jobs = [row.to_dict() for _, row in meta_df.iterrows()]
+    logging.info(f"Startar {len(jobs)} beräkningar ({mode}).")
+
+    workers = workers or os.cpu_count() or 1
+    db_slot = multiprocessing.BoundedSemaphore(max(db_concurrency, 1))
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(db_slot,)) as executor:
+        futures = [executor.submit(run_job, meta, mode, since, rating_table) for meta in jobs]
+        for future in as_completed(futures):
+            unique_id, samples, seconds, error = result = future.result()
+            results.append(result)
+            if error:
+                logging.error(f"{unique_id}: misslyckades efter {seconds:.2f} s: {error}")
+            else:
+                logging.info(f"{unique_id}: {samples} värden på {seconds:.2f} s.")
+
+    failed = sum(1 for result in results if result[3])
+    logging.info(f"{len(results) - failed} av {len(results)} beräkningar klara på "
+                 f"{time.perf_counter() - start:.1f} s.")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--ids", nargs="+", help="unique_id of the calculations to run (default all)")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--since", type=datetime.datetime.fromisoformat,
+                       help="recalculate input from this time, e.g. 2024-01-01")
+    group.add_argument("--incremental", action="store_true",
+                       help="only calculate input newer than each calculation's high-water mark")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes (default: cores)")
+    parser.add_argument("--db-concurrency", type=int, default=4,
+                        help="max number of jobs using the database at once (default: 4)")
+    parser.add_argument("--rating-tables", action="store_true",
+                        help="interpolate flow in cached rating tables (relative error <= 1e-4)")
+    parser.add_argument("--rollups", action="store_true",
+                        help="refresh the hourly/daily/monthly rollup tables and exit")
+    parser.add_argument("--rebuild-rollups", action="store_true",
+                        help="with --rollups: recompute the full history of every series")
+    args = parser.parse_args(argv)
+
+    if args.rollups:
+        for kind in ("acurve", "flow"):
+            refreshed = refresh_rollups(kind, args.ids if kind == "flow" else None,
+                                        rebuild=args.rebuild_rollups)
+            print(f"{kind}: {refreshed} series refreshed")
+        return 0
+
+    results = run_batch(args.ids, since=args.since, incremental=args.incremental,
+                        workers=args.workers, db_concurrency=args.db_concurrency,
+                        rating_table=args.rating_tables)
+
+    print(f"{'unique_id':<30} {'samples':>10} {'seconds':>9}  status")
+    for unique_id, samples, seconds, error in sorted(results):
+        print(f"{unique_id:<30} {samples:>10} {seconds:>9.2f}  {error or 'ok'}")
+    return 1 if any(result[3] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,299 @@
+import datetime
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dateutil.relativedelta import relativedelta
+import numpy as np
+import pandas as pd
+from calculations.database_queries import (update_data, get_ts_from_id, get_flow_ts_from_id,
+                                           register_write_listener, ts_tables)
+from calculations.downsampling import minmax_downsample
+
+
+logger = logging.getLogger(__name__)
+logger.propagate = False
+
+signal_catalog_ttl = float(os.getenv("SIGNAL_CATALOG_TTL", "600"))
+earth_radius = 6378137.0  # m, Web Mercator
+ts_cache_max_bytes = int(os.getenv("TS_CACHE_MAX_BYTES", str(256 * 1024 ** 2)))
+# Innevarande månad får nya värden hela tiden och hämtas om efter en kort stund
+ts_cache_current_month_ttl = float(os.getenv("TS_CACHE_CURRENT_MONTH_TTL", "60"))
+# Kortare och längre fönster än så här går förbi månadscachen, se get_ts_window
+ts_cache_min_window = datetime.timedelta(days=28)
+ts_cache_max_months = int(os.getenv("TS_CACHE_MAX_MONTHS", "3"))
+
+
+class TTLCache:
+    """
+    A single value shared by all sessions in the process, loaded on first use
+    and reloaded when it is older than ttl seconds or has been invalidated.
+    Concurrent callers wait for one load instead of loading in parallel.
+    version counts the loads, so callers can tell when the value changed.
+    """
+
+    def __init__(self, loader, ttl):
+        self.loader = loader
+        self.ttl = ttl
+        self.version = 0
+        self._value = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._value = self.loader()
+                self._loaded_at = time.monotonic()
+                self.version += 1
+            return self._value
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+
+def to_web_mercator(lat, lon):
+    """
+    WGS84 latitude/longitude (degrees, scalars or arrays) to Web Mercator
+    x/y (m), the coordinates of the Bokeh tile map.
+    """
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    x = lon * (np.pi / 180) * earth_radius
+    y = np.log(np.tan((90 + lat) * np.pi / 360)) * earth_radius
+    return x, y
+
+
+def _load_signal_catalog():
+    df = update_data()
+    # Söksträngen byggs kolumnvis en gång i stället för med apply per rad och widget
+    df['Search'] = (df['SubjectID'].astype(str) + " | " + df['name'].astype(str) + " | "
+                    + df['unit'].astype(str) + " |" + df['beskrivning'].astype(str))
+    # Kartkoordinaterna likaså, kartan i SignalSelectionWidget läser dem direkt
+    lat, lon = zip(*df['coordinates']) if len(df) else ((), ())
+    df['mercator_x'], df['mercator_y'] = to_web_mercator(lat, lon)
+    return df
+
+
+_signal_catalog = TTLCache(_load_signal_catalog, signal_catalog_ttl)
+
+
+def get_signal_catalog():
+    """
+    The signals in public.acurve_meta, as returned by update_data() plus the
+    precomputed 'Search' column used by the autocomplete inputs and the
+    'mercator_x'/'mercator_y' map coordinates.
+
+    The data is loaded once per process and shared by every session. Each
+    call returns a shallow copy, so a caller can add or replace columns
+    without affecting other sessions. Values must not be written in place,
+    since without copy-on-write (pandas < 3) they are shared.
+    """
+    return _signal_catalog.get().copy(deep=False)
+
+
+def signal_catalog_version():
+    """
+    Number of times the signal catalog has been loaded, changes when
+    get_signal_catalog returns reloaded data.
+    """
+    return _signal_catalog.version
+
+
+def invalidate_signal_catalog():
+    """
+    Reload the signal catalog on next use, e.g. after acurve_meta changed.
+    """
+    _signal_catalog.invalidate()
+
+
+def month_start(time_point):
+    return datetime.datetime(time_point.year, time_point.month, 1)
+
+
+class MonthWindowCache:
+    """
+    Process-wide LRU cache of downsampled time series in calendar-month chunks,
+    keyed by (kind, id, month, points). A plot window is assembled from the
+    chunks it overlaps. The cache is bounded by the bytes of the cached
+    arrays, and chunks of a calculation are dropped when it is written or
+    deleted (see register_write_listener).
+
+    Each series has a generation that invalidate() increments. A chunk is
+    only inserted if its series' generation is unchanged since the load
+    started, so a write that lands during a load is not hidden by the
+    chunk read before it.
+    """
+    _fetchers = {"acurve": get_ts_from_id, "flow": get_flow_ts_from_id}
+
+    def __init__(self, max_bytes, current_month_ttl, prefetch_workers=2):
+        self.max_bytes = max_bytes
+        self.current_month_ttl = current_month_ttl
+        self._chunks = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._generations = {}
+        self._epoch = 0
+        self.prefetch_workers = prefetch_workers
+        self._prefetching = set()
+        self._prefetcher = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix="ts-prefetch")
+
+    @staticmethod
+    def chunk_points(max_points):
+        # Avrundas uppåt till en tvåpotens så att sessioner med olika
+        # plotbredd delar samma månadsbitar
+        return 1 << max(int(max_points) - 1, 1).bit_length()
+
+    def _fresh(self, month, loaded_at):
+        if month_start(datetime.datetime.now()) > month:
+            return True
+        return time.monotonic() - loaded_at <= self.current_month_ttl
+
+    def _load(self, key):
+        kind, selected_id, month, points = key
+        end = month + relativedelta(months=1) - datetime.timedelta(microseconds=1)
+        df = self._fetchers[kind](selected_id, month, end, max_points=points)
+        if df.shape[1] == 0:
+            return np.empty(0, dtype="M8[ms]"), np.empty(0, dtype=np.float64)
+        return (df.index.values.astype("M8[ms]"),
+                np.ascontiguousarray(df.iloc[:, 0].values, dtype=np.float64))
+
+    def _generation(self, kind, selected_id):
+        # Anropas med låset taget
+        return self._epoch, self._generations.get((kind, selected_id), 0)
+
+    def get_chunk(self, kind, selected_id, month, points):
+        key = (kind, str(selected_id), month, points)
+        with self._lock:
+            entry = self._chunks.get(key)
+            if entry is not None and self._fresh(month, entry[2]):
+                self._chunks.move_to_end(key)
+                return entry[0], entry[1]
+            generation = self._generation(kind, key[1])
+
+        times, values = self._load(key)
+        with self._lock:
+            if self._generation(kind, key[1]) != generation:
+                # Serien skrevs under laddningen, biten kan vara inaktuell och
+                # sparas inte, nästa anrop läser om den
+                return times, values
+            old = self._chunks.pop(key, None)
+            if old is not None:
+                self._bytes -= old[0].nbytes + old[1].nbytes
+            self._chunks[key] = (times, values, time.monotonic())
+            self._bytes += times.nbytes + values.nbytes
+            while self._bytes > self.max_bytes and len(self._chunks) > 1:
+                _, (old_times, old_values, _) = self._chunks.popitem(last=False)
+                self._bytes -= old_times.nbytes + old_values.nbytes
+        return times, values
+
+    def get_window(self, kind, selected_id, start_time, end_time, max_points, prefetch=True):
+        """
+        Downsampled series for start_time <= time <= end_time, in the same
+        form as get_ts_from_id / get_flow_ts_from_id with max_points.
+        """
+        points = self.chunk_points(max_points)
+        months = []
+        month = month_start(start_time)
+        while month <= end_time:
+            months.append(month)
+            month += relativedelta(months=1)
+
+        chunks = [self.get_chunk(kind, selected_id, m, points) for m in months]
+        times = np.concatenate([c[0] for c in chunks])
+        values = np.concatenate([c[1] for c in chunks])
+        inside = (times >= np.datetime64(start_time, "ms")) & (times <= np.datetime64(end_time, "ms"))
+        times, values = times[inside], values[inside]
+        keep = minmax_downsample(times, values, max_points)
+
+        if prefetch and months:
+            self.prefetch(kind, selected_id, [months[0] - relativedelta(months=1),
+                                              months[-1] + relativedelta(months=1)], points)
+
+        table, id_col, time_col = ts_tables[kind]
+        return pd.DataFrame(values[keep].reshape(-1, 1),
+                            index=pd.DatetimeIndex(times[keep], name=time_col),
+                            columns=pd.Index([str(selected_id)], name=id_col))
+
+    def prefetch(self, kind, selected_id, months, points):
+        """
+        Load the given months in the background if they are not cached.
+        """
+        now = datetime.datetime.now()
+        for month in months:
+            key = (kind, str(selected_id), month, points)
+            with self._lock:
+                if month > now or key in self._chunks or key in self._prefetching:
+                    continue
+                self._prefetching.add(key)
+            self._prefetcher.submit(self._prefetch_one, key)
+
+    def _prefetch_one(self, key):
+        try:
+            self.get_chunk(*key)
+        except Exception:
+            logging.exception("Exception occured")
+        finally:
+            with self._lock:
+                self._prefetching.discard(key)
+
+    def invalidate(self, kind=None, selected_id=None):
+        """
+        Drop the cached chunks of one series, or everything.
+        """
+        with self._lock:
+            if kind is None:
+                self._epoch += 1
+            else:
+                series = (kind, str(selected_id))
+                self._generations[series] = self._generations.get(series, 0) + 1
+            for key in list(self._chunks):
+                if kind is None or (key[0] == kind and key[1] == str(selected_id)):
+                    times, values, _ = self._chunks.pop(key)
+                    self._bytes -= times.nbytes + values.nbytes
+
+    def _after_fork(self):
+        # Förälderns lås och prefetch-trådar följer inte med till barnprocessen,
+        # de cachade bitarna är giltiga och delas copy-on-write
+        self._lock = threading.Lock()
+        self._prefetching = set()
+        self._prefetcher = ThreadPoolExecutor(max_workers=self.prefetch_workers, thread_name_prefix="ts-prefetch")
+
+    def stats(self):
+        with self._lock:
+            return {"chunks": len(self._chunks), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+ts_cache = MonthWindowCache(ts_cache_max_bytes, ts_cache_current_month_ttl)
+register_write_listener(lambda unique_id: ts_cache.invalidate("flow", unique_id))
+
+
+def _after_fork_in_child():
+    _signal_catalog._after_fork()
+    ts_cache._after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def get_ts_window(kind, selected_id, start_time, end_time, max_points):
+    """
+    Downsampled plot data for a time window. kind is "acurve"
+    (get_ts_from_id) or "flow" (get_flow_ts_from_id).
+
+    Windows from about one month up to ts_cache_max_months months are
+    served from the shared month cache. Other windows are read directly
+    with max_points: long ones from the rollup tables, so a multi-year view
+    costs one small query instead of one chunk per month, and short ones
+    from the raw rows of just that window, since a month chunk has too few
+    points to zoom into.
+    """
+    width = end_time - start_time
+    if width < ts_cache_min_window or month_start(start_time) + relativedelta(months=ts_cache_max_months) <= end_time:
+        return MonthWindowCache._fetchers[kind](selected_id, start_time, end_time, max_points=max_points)
+    return ts_cache.get_window(kind, selected_id, start_time, end_time, max_points)
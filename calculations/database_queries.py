@@ -1,13 +1,22 @@
+import io
 import os
 from os import path
 import logging
 import logging.config
 import random
+import re
+import select
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
 import psycopg2
+import psycopg2.extras
 import sqlalchemy
-from sqlalchemy import create_engine
-#import datetime
+from sqlalchemy import create_engine, event
+from calculations.downsampling import lttb, minmax_downsample
+import datetime
 #from sqlalchemy.orm import sessionmaker
 #from sqlalchemy.engine import URL
 
@@ -17,6 +26,20 @@ passw = os.environ["DB_PASSWORD"]
 port = os.environ["DB_PORT"]
 db_user = os.environ["DB_USER"]
 
+# Inställningar för den gemensamma anslutningspoolen
+pool_size = int(os.getenv("DB_POOL_SIZE", "5"))
+pool_max_overflow = int(os.getenv("DB_POOL_MAX_OVERFLOW", "10"))
+pool_timeout = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+pool_recycle = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+statement_timeout_ms = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "300000"))
+use_prepared_statements = os.getenv("DB_PREPARED_STATEMENTS", "1") != "0"
+# Rader per bit när hela historiken strömmas, se iter_ts_arrays
+ts_chunk_rows = int(os.getenv("TS_CHUNK_ROWS", "500000"))
+# Långa fönster läses ur aggregattabellerna, se refresh_rollups
+use_rollups = os.getenv("TS_USE_ROLLUPS", "1") != "0"
+# Kanal för skrivnotiser mellan arbetsprocesser, se start_write_listener
+write_notify_channel = os.getenv("DB_WRITE_CHANNEL", "flow_app_writes")
+
 logger = logging.getLogger(__name__)
 logger.propagate = False
 #parent_path = Path(__file__).parent / 'logging.conf'
@@ -27,6 +50,251 @@ logger.propagate = False
 #logging.config.fileConfig(log_path)
 #print("got here")
 
+_engine = None
+_engine_lock = threading.Lock()
+_pool_stats_lock = threading.Lock()
+_pool_stats = {
+    "connects": 0,
+    "checkouts": 0,
+    "waits": 0,
+    "wait_time": 0.0,
+    "timeouts": 0,
+    "invalidated": 0,
+}
+
+
+_write_listeners = []
+
+
+def register_write_listener(listener):
+    """
+    Call listener(unique_id) after flowcalc_schema.flow_ts has been written
+    or deleted for unique_id, e.g. to invalidate caches.
+    """
+    _write_listeners.append(listener)
+
+
+_write_listener_pid = None
+
+
+def _call_write_listeners(unique_id):
+    for listener in _write_listeners:
+        try:
+            listener(str(unique_id))
+        except Exception:
+            logging.exception("Exception occured")
+
+
+def _notify_write(unique_id):
+    _call_write_listeners(unique_id)
+    # Övriga arbetsprocesser (panel serve --num-procs) har egna cacher och får
+    # skrivningen via NOTIFY, avsändarens pid gör att den egna notisen hoppas över
+    try:
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT pg_notify(%s, %s);", (write_notify_channel, f"{os.getpid()}:{unique_id}"))
+            conn.commit()
+    except Exception:
+        logging.exception("Exception occured")
+
+
+def _listen_for_writes():
+    own_prefix = f"{os.getpid()}:"
+    while True:
+        conn = None
+        try:
+            # Egen anslutning utanför poolen, den är upptagen av LISTEN hela tiden
+            conn = _connect()
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {write_notify_channel};")
+            logging.info(f"Lyssnar på skrivnotiser ({write_notify_channel}).")
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    payload = conn.notifies.pop(0).payload
+                    if not payload.startswith(own_prefix):
+                        _call_write_listeners(payload.split(":", 1)[1])
+        except Exception:
+            logging.exception("Exception occured")
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+def start_write_listener():
+    """
+    Start a daemon thread that LISTENs for writes made by other processes
+    and calls the write listeners for them, so that caches in every worker
+    of a multi-process deployment are invalidated. Runs once per process,
+    also after a fork, and reconnects if the connection is lost.
+    """
+    global _write_listener_pid
+    with _engine_lock:
+        if _write_listener_pid == os.getpid():
+            return
+        _write_listener_pid = os.getpid()
+    threading.Thread(target=_listen_for_writes, name="write-listener", daemon=True).start()
+
+
+def _connect():
+    return psycopg2.connect(
+        host=host,
+        port=port,
+        database=db_name,
+        user=db_user,
+        password=passw,
+        options=f"-c statement_timeout={statement_timeout_ms}",
+        application_name="flow_app",
+    )
+
+
+def _count(key, amount=1):
+    with _pool_stats_lock:
+        _pool_stats[key] += amount
+
+
+def get_engine():
+    """
+    Return the process-wide SQLAlchemy engine, creating it on first use.
+
+    All queries in this module share the engine's bounded QueuePool, so a
+    session never pays for a new TCP/auth handshake and the process never
+    holds more than pool_size + pool_max_overflow connections.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = create_engine(
+                    "postgresql+psycopg2://",
+                    creator=_connect,
+                    pool_size=pool_size,
+                    max_overflow=pool_max_overflow,
+                    pool_timeout=pool_timeout,
+                    pool_recycle=pool_recycle,
+                    pool_pre_ping=True,
+                )
+                event.listen(engine.pool, "connect", lambda *args: _count("connects"))
+                event.listen(engine.pool, "checkout", lambda *args: _count("checkouts"))
+                event.listen(engine.pool, "invalidate", lambda *args: _count("invalidated"))
+                _engine = engine
+                logging.info("Anslutningspool skapades.")
+    return _engine
+
+
+def _acquire(connect_func):
+    # Hämta en anslutning från poolen och räkna väntetid om poolen är full
+    pool = get_engine().pool
+    saturated = pool.checkedout() >= pool.size() + pool_max_overflow
+    start = time.perf_counter()
+    try:
+        conn = connect_func()
+    except sqlalchemy.exc.TimeoutError:
+        _count("timeouts")
+        raise
+    finally:
+        if saturated:
+            _count("waits")
+            _count("wait_time", time.perf_counter() - start)
+    return conn
+
+
+@contextmanager
+def get_connection():
+    """
+    Borrow a raw psycopg2 connection from the shared pool.
+
+    The connection is returned to the pool (and rolled back) when the
+    block exits, it is never closed.
+    """
+    conn = _acquire(get_engine().raw_connection)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+@contextmanager
+def get_sqlalchemy_connection():
+    """
+    Borrow a SQLAlchemy connection from the shared pool, for pd.read_sql.
+    """
+    conn = _acquire(get_engine().connect)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def get_pool_status():
+    """
+    Return pool metrics.
+
+    Returns:
+        dict: size, checked_out, checked_in and overflow from the pool, and the
+        cumulative connects, checkouts, waits, wait_time (s), timeouts and
+        invalidated counters since the pool was created.
+    """
+    pool = get_engine().pool
+    with _pool_stats_lock:
+        status = dict(_pool_stats)
+    status.update({
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+    })
+    return status
+
+
+def check_pool_health():
+    """
+    Run a round trip through the pool and report its latency together with
+    the pool metrics. Raises ValueError if the database cannot be reached.
+    """
+    try:
+        start = time.perf_counter()
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+            cur.fetchone()
+        status = get_pool_status()
+        status["latency_ms"] = (time.perf_counter() - start) * 1000
+        return status
+
+    except Exception as Argument:
+        logging.exception("Exception occured")
+        raise ValueError(f"Error: {Argument}") from Argument
+
+
+def dispose_pool(close=True):
+    """
+    Close all pooled connections. The pool is recreated on next use.
+
+    Parameters:
+        close (bool): Close the connections. Use close=False in a forked
+            child process, where the connections belong to the parent and
+            must only be forgotten.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose(close=close)
+            _engine = None
+
+
+def _after_fork_in_child():
+    global _engine_lock, _pool_stats_lock
+    # Lås som hölls av en annan tråd vid forken släpps aldrig i barnet
+    _engine_lock = threading.Lock()
+    _pool_stats_lock = threading.Lock()
+    dispose_pool(close=False)
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
 
 def dataframe_to_input_data(df, new_signal_id):
     # konvertera dataframe till input data format för tidsserie
@@ -34,7 +302,7 @@ def dataframe_to_input_data(df, new_signal_id):
     try:
         timestamps = df.index.values
         values = df[df.columns[0]].values
-        input_data = list(zip(timestamps.astype('M8[ms]').tolist(), values, [new_signal_id] * len(values)))
+        input_data = list(zip(timestamps.astype('M8[ms]').tolist(), values.tolist(), [new_signal_id] * len(values)))
         logging.info("Dataframe konverterades till rätt format.")
         return input_data
     
@@ -46,19 +314,12 @@ def dataframe_to_input_data(df, new_signal_id):
 def update_data():
     logging.info("Hämtar metadata...")
     try:
-        conn = psycopg2.connect(
-            host=host,
-            database=db_name,
-            user=db_user,
-            password=passw
-        )
-        cur = conn.cursor()
-
-        # Query to select all rows from the table
-        query = "SELECT * FROM public.acurve_meta;"
+        with get_connection() as conn, conn.cursor() as cur:
+            # Query to select all rows from the table
+            query = "SELECT * FROM public.acurve_meta;"
 
-        cur.execute(query)
-        rows = cur.fetchall()
+            cur.execute(query)
+            rows = cur.fetchall()
 
         lat_range = (57.6, 57.8)  # Example latitude range
         lon_range = (11.9, 12.1)  # Example longitude range
@@ -84,10 +345,6 @@ def update_data():
     except Exception as Argument:
         logging.exception("Exception occured")
         raise ValueError(f"Error: {Argument}") from Argument
-    
-    finally:
-        cur.close()
-        conn.close()
 
         
 def get_flow_meta_data():
@@ -95,25 +352,16 @@ def get_flow_meta_data():
     check_metadata = "SELECT * FROM flowcalc_schema.flow_meta;"
 
     try:
-        # Connect to the database
-        conn = psycopg2.connect(
-            host=host,
-            database=db_name,
-            user=db_user,
-            password=passw
-        )
+        # Borrow a pooled connection and create a cursor object
+        with get_connection() as conn, conn.cursor() as cur:
+            # Execute the SQL query
+            cur.execute(check_metadata)
 
-        # Create a cursor object
-        cur = conn.cursor()
+            # Fetch all rows from the result set
+            rows = cur.fetchall()
 
-        # Execute the SQL query
-        cur.execute(check_metadata)
-
-        # Fetch all rows from the result set
-        rows = cur.fetchall()
-
-        # Get column names from cursor description
-        columns = [desc[0] for desc in cur.description]
+            # Get column names from cursor description
+            columns = [desc[0] for desc in cur.description]
 
         # Create a DataFrame from the retrieved data and column names
         df = pd.DataFrame(rows, columns=columns)
@@ -124,41 +372,424 @@ def get_flow_meta_data():
         logging.exception("Exception occured")
         raise ValueError(f"Error: {Argument}") from Argument
 
-    finally:
-        cur.close()
-        conn.close()
 
-        
-def get_ts_from_id(selected_id, start_time, end_time, all_data=False, samples=None):
+# Kolumnerna i listan över beräkningar, de enda som går att filtrera och sortera på
+flow_meta_list_columns = ["unique_id", "name", "original_signal_id", "calc_type", "unit"]
+
+
+def _flow_meta_where(filters):
+    # Tabulators header-filter {'field', 'type', 'value'} som parametriserad SQL
+    clauses, values = [], []
+    for filt in filters or []:
+        field, op, value = filt["field"], filt["type"], filt["value"]
+        if field not in flow_meta_list_columns:
+            raise ValueError(f"Unknown filter column '{field}'")
+        if isinstance(value, list) and len(value) == 1 and op != "in":
+            value = value[0]
+        if value is None or value == "" or value == []:
+            continue
+        if op == "like":
+            escaped = str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            clauses.append(f"{field} ILIKE %s")
+            values.append(f"%{escaped}%")
+        elif op == "in":
+            clauses.append(f"{field} = ANY(%s)")
+            values.append([str(v) for v in (value if isinstance(value, list) else [value])])
+        elif op == "=":
+            clauses.append(f"{field} = %s")
+            values.append(str(value))
+        else:
+            raise ValueError(f"Unsupported filter type '{op}'")
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", values
+
+
+def query_flow_meta(filters=None, sorters=None, page=1, page_size=50):
+    """
+    One page of the calculations in flowcalc_schema.flow_meta, filtered and
+    sorted in the database.
+
+    Parameters:
+        filters (list of dict): Tabulator header filters with 'field',
+            'type' ("like", "in" or "=") and 'value'.
+        sorters (list of dict): Tabulator sorters with 'field' and 'dir'
+            ("asc" or "desc"), most significant first.
+        page (int): Page number, starting at 1.
+        page_size (int): Rows per page.
+
+    Returns:
+        tuple: (pandas.DataFrame with flow_meta_list_columns, total number
+        of matching rows)
+    """
+    logging.info("Hämtar sida med beräkningar...")
+    try:
+        where, values = _flow_meta_where(filters)
+        order = []
+        for sorter in sorters or []:
+            if sorter["field"] not in flow_meta_list_columns:
+                raise ValueError(f"Unknown sort column '{sorter['field']}'")
+            order.append(f"{sorter['field']} {'DESC' if sorter.get('dir') == 'desc' else 'ASC'}")
+        # unique_id sist så att sidorna blir stabila
+        order.append("unique_id")
+        columns = ", ".join(flow_meta_list_columns)
+
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"SELECT count(*) FROM flowcalc_schema.flow_meta{where};", values)
+            total = cur.fetchone()[0]
+            cur.execute(f"""
+                SELECT {columns} FROM flowcalc_schema.flow_meta{where}
+                ORDER BY {", ".join(order)}
+                LIMIT %s OFFSET %s;
+            """, values + [page_size, (max(page, 1) - 1) * page_size])
+            rows = cur.fetchall()
+
+        logging.info("Sida med beräkningar hämtades.")
+        return pd.DataFrame(rows, columns=flow_meta_list_columns), total
+
+    except Exception as Argument:
+        logging.exception("Exception occured")
+        raise ValueError(f"Error: {Argument}") from Argument
+
+
+def get_flow_meta_values(column):
+    """
+    Distinct values of a list column of flow_meta, for the list filters.
+    """
+    if column not in flow_meta_list_columns:
+        raise ValueError(f"Unknown column '{column}'")
+    try:
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"SELECT DISTINCT {column} FROM flowcalc_schema.flow_meta WHERE {column} IS NOT NULL "
+                        f"ORDER BY {column};")
+            return [row[0] for row in cur.fetchall()]
+
+    except Exception as Argument:
+        logging.exception("Exception occured")
+        raise ValueError(f"Error: {Argument}") from Argument
+
+
+def get_flow_meta(unique_id):
+    """
+    All columns of one calculation in flowcalc_schema.flow_meta.
+
+    Returns:
+        dict: The row, or None if there is no such calculation.
+    """
+    try:
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT * FROM flowcalc_schema.flow_meta WHERE unique_id = %s;", (str(unique_id),))
+            row = cur.fetchone()
+            columns = [desc[0] for desc in cur.description]
+        return None if row is None else dict(zip(columns, row))
+
+    except Exception as Argument:
+        logging.exception("Exception occured")
+        raise ValueError(f"Error: {Argument}") from Argument
+
+
+# Tidsserietabeller: (tabell, id-kolumn, tidskolumn). Frågorna filtrerar alltid
+# på id-kolumnen först och sedan på tidsintervall, i samma ordning som
+# indexen (signal, timestamp) och (unique_id, time).
+ts_tables = {
+    "acurve": ("public.acurve_ts", "signal", "timestamp"),
+    "flow": ("flowcalc_schema.flow_ts", "unique_id", "time"),
+}
+
+
+def build_ts_query(kind, many=False, window=True, limit=False, downsample=False, arrays=False,
+                   since=False):
+    """
+    Build a parameterized time-series query.
+
+    The statement only depends on the flags, never on the values, so each
+    shape is prepared once per pooled connection and its plan is reused.
+
+    Parameters:
+        kind (str): "acurve" or "flow", see ts_tables.
+        many (bool): Match several ids with = ANY($1) instead of = $1.
+        window (bool): Restrict to start_time <= time <= end_time.
+        limit (bool): Add a LIMIT.
+        downsample (bool): Return min and max of equal-width time buckets
+            instead of every row. Requires window.
+        arrays (bool): Select only (time, value) as timestamp and float8,
+            with NULL values as NaN, for the binary COPY decoder.
+        since (bool): Restrict to time > since, instead of a window.
+
+    Returns:
+        tuple: (statement name, SQL with $n placeholders, parameter names)
+    """
+    table, id_col, time_col = ts_tables[kind]
+    if downsample and not window:
+        raise ValueError("downsample requires a time window")
+    if since and window:
+        raise ValueError("since and window are mutually exclusive")
+
+    params = ["selected_id"]
+    where = f"{id_col} = ANY($1)" if many else f"{id_col} = $1"
+    if window:
+        params += ["start_time", "end_time"]
+        where += f" AND {time_col} >= $2 AND {time_col} <= $3"
+    if since:
+        params.append("since")
+        where += f" AND {time_col} > $2"
+
+    if downsample:
+        # Min och max per tidsbucket, beräknat i databasen så att bara
+        # några tusen rader skickas till klienten oavsett tidsupplösning
+        params.append("buckets")
+        query = f"""
+            SELECT {id_col}, {time_col}, value FROM (
+                SELECT {id_col}, {time_col}, value,
+                       row_number() OVER (PARTITION BY {id_col}, bucket ORDER BY value ASC, {time_col}) AS rn_min,
+                       row_number() OVER (PARTITION BY {id_col}, bucket ORDER BY value DESC, {time_col}) AS rn_max
+                FROM (
+                    SELECT {id_col}, {time_col}, value,
+                           width_bucket(extract(epoch FROM {time_col}),
+                                        extract(epoch FROM $2::timestamp),
+                                        extract(epoch FROM $3::timestamp),
+                                        $4::integer) AS bucket
+                    FROM {table}
+                    WHERE {where}
+                    AND value IS NOT NULL
+                ) AS bucketed
+            ) AS ranked
+            WHERE rn_min = 1 OR rn_max = 1
+            ORDER BY {id_col}, {time_col}
+        """
+    elif arrays:
+        query = f"""
+            SELECT {time_col}::timestamp, COALESCE(value::float8, 'NaN'::float8) FROM {table}
+            WHERE {where}
+            ORDER BY {id_col}, {time_col}
+        """
+    else:
+        query = f"""
+            SELECT {id_col}, {time_col}, value FROM {table}
+            WHERE {where}
+            ORDER BY {id_col}, {time_col}
+        """
+    if limit and not downsample:
+        params.append("samples")
+        query += f" LIMIT ${len(params)}"
+
+    name = "_".join(["ts", kind, "many" if many else "one"]
+                    + [flag for flag, on in (("window", window), ("limit", limit),
+                                             ("downsample", downsample), ("arrays", arrays),
+                                             ("since", since)) if on])
+    return name, query, params
+
+
+def execute_prepared(conn, cur, name, query, values):
+    """
+    Execute query as a server-side prepared statement.
+
+    The statement is prepared the first time it is used on a pooled
+    connection and remembered in the connection's info dict, so later
+    calls on the same connection only send EXECUTE with bound values.
+    Set DB_PREPARED_STATEMENTS=0 when running behind a transaction-pooling
+    proxy such as pgbouncer.
+    """
+    if not use_prepared_statements:
+        # $n -> %(pn)s, samma parameter kan förekomma flera gånger
+        cur.execute(re.sub(r"\$(\d+)", r"%(p\1)s", query),
+                    {f"p{i + 1}": value for i, value in enumerate(values)})
+        return
+
+    prepared = conn.info.setdefault("prepared_statements", set())
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {query}")
+        prepared.add(name)
+    placeholders = ", ".join(["%s"] * len(values))
+    cur.execute(f"EXECUTE {name} ({placeholders})" if values else f"EXECUTE {name}", values)
+
+
+# En rad i binärt COPY-format med två fält som inte är NULL:
+# antal fält, längd + timestamp (int64 µs sedan 2000-01-01), längd + float8
+_copy_row_dtype = np.dtype([("fields", ">i2"), ("time_len", ">i4"), ("time", ">i8"),
+                            ("value_len", ">i4"), ("value", ">f8")])
+_copy_signature = b"PGCOPY\n\xff\r\n\x00"
+_pg_epoch_offset_us = 946_684_800_000_000  # 2000-01-01 i µs sedan 1970-01-01
+
+
+def decode_binary_copy(buffer, unit="ms"):
+    """
+    Decode a binary COPY stream of (timestamp, float8) rows into NumPy arrays.
+
+    Parameters:
+        buffer (bytes-like): The COPY stream.
+        unit (str): "ms" or "us", precision of the returned times.
+
+    Returns:
+        tuple: (datetime64[unit] array, float64 array)
+    """
+    buffer = memoryview(buffer)
+    if bytes(buffer[:11]) != _copy_signature:
+        raise ValueError("Not a binary COPY stream")
+    header_len = 19 + int.from_bytes(buffer[15:19], "big")
+    n_rows = (len(buffer) - header_len - 2) // _copy_row_dtype.itemsize
+    rows = np.frombuffer(buffer, dtype=_copy_row_dtype, count=n_rows, offset=header_len)
+    if n_rows and (np.any(rows["fields"] != 2) or np.any(rows["value_len"] != 8)):
+        raise ValueError("Unexpected row layout in COPY stream")
+
+    if unit not in ("ms", "us"):
+        raise ValueError(f"Unknown time unit '{unit}'")
+    times = np.empty(n_rows, dtype=f"M8[{unit}]")
+    values = np.empty(n_rows, dtype=np.float64)
+    np.floor_divide(rows["time"] + _pg_epoch_offset_us, 1000 if unit == "ms" else 1,
+                    out=times.view(np.int64))
+    values[:] = rows["value"]
+    return times, values
+
+
+def fetch_ts_arrays(kind, selected_id, start_time=None, end_time=None, all_data=False, samples=None,
+                    since=None, unit="ms"):
+    """
+    Fetch one time series as NumPy arrays, skipping pandas entirely.
+
+    The rows are streamed with COPY ... TO STDOUT (FORMAT binary) and decoded
+    with decode_binary_copy, so no Python object is created per row.
+
+    Parameters:
+        kind (str): "acurve" or "flow", see ts_tables.
+        selected_id (str): Signal ID or calculation unique_id.
+        start_time, end_time, all_data, samples: As for get_ts_from_id.
+        since (datetime): Only rows strictly after this time, replaces the
+            window. samples then limits the number of rows, see
+            iter_ts_arrays.
+        unit (str): "ms" or "us", precision of the returned times.
+
+    Returns:
+        tuple: (datetime64[unit] array, float64 array) sorted by time.
+    """
+    if since is not None:
+        all_data = True
+    name, query, param_names = build_ts_query(
+        kind, window=not all_data, limit=bool(samples) and (not all_data or since is not None),
+        arrays=True, since=since is not None)
+    values = {"selected_id": str(selected_id), "start_time": start_time,
+              "end_time": end_time, "samples": samples, "since": since}
+
+    with get_connection() as conn, conn.cursor() as cur:
+        # COPY tar inte parametrar, värdena binds med mogrify
+        query = cur.mogrify(re.sub(r"\$(\d+)", r"%(p\1)s", query),
+                            {f"p{i + 1}": values[p] for i, p in enumerate(param_names)}).decode()
+        buffer = io.BytesIO()
+        cur.copy_expert(f"COPY ({query}) TO STDOUT (FORMAT binary)", buffer)
+
+    return decode_binary_copy(buffer.getbuffer(), unit)
+
+
+def iter_ts_arrays(kind, selected_id, since=None, chunk_rows=None):
+    """
+    Stream a whole time series in time order as NumPy chunks.
+
+    Each chunk is one keyset query (time > last time seen ... LIMIT
+    chunk_rows) over the (id, time) primary key, on its own pooled
+    connection, so memory and connection time are bounded by the chunk size
+    whatever the length of the series.
+
+    Parameters:
+        kind (str): "acurve" or "flow", see ts_tables.
+        selected_id (str): Signal ID or calculation unique_id.
+        since (datetime): Start after this time, None for the full history.
+        chunk_rows (int): Rows per chunk, default TS_CHUNK_ROWS.
+
+    Yields:
+        tuple: (datetime64[ms] array, float64 array), non-empty.
+    """
+    chunk_rows = chunk_rows or ts_chunk_rows
+    last = since if since is not None else datetime.datetime(1, 1, 1)
+    while True:
+        # Nyckeln är tiden med full µs-upplösning, avkortad till ms skulle
+        # rader inom samma ms som chunkens sista rad hoppas över
+        times, values = fetch_ts_arrays(kind, selected_id, samples=chunk_rows, since=last, unit="us")
+        if not len(times):
+            return
+        last = times[-1].astype(datetime.datetime)
+        yield times.astype("M8[ms]"), values
+        if len(times) < chunk_rows:
+            return
+
+
+def _arrays_to_frame(kind, selected_id, times, values):
+    # Samma form som pivot gav: en kolumn per id, tidsindex
+    table, id_col, time_col = ts_tables[kind]
+    columns = pd.Index([str(selected_id)], name=id_col)
+    index = pd.DatetimeIndex(times, name=time_col)
+    return pd.DataFrame(values.reshape(-1, 1), index=index, columns=columns, copy=False)
+
+
+def _query_ts(kind, selected_ids, start_time=None, end_time=None, all_data=False,
+              samples=None, max_points=None, method="minmax"):
+    # Returnerar långt format: (id, tid, värde)
+    table, id_col, time_col = ts_tables[kind]
+    many = not isinstance(selected_ids, str)
+    downsample = bool(max_points) and not all_data
+    if downsample:
+        if method not in ("minmax", "lttb"):
+            raise ValueError(f"Unknown downsampling method '{method}'")
+        if end_time <= start_time:
+            raise ValueError("end_time must be after start_time")
+        # Långa fönster läses ur aggregaten med grövsta tillräckliga upplösning
+        resolution = rollup_resolution(start_time, end_time, max_points)
+        if use_rollups and resolution and method == "minmax" and not many:
+            df = _query_rollup(kind, selected_ids, start_time, end_time, max_points, resolution)
+            if df is not None:
+                return df
+
+    name, query, param_names = build_ts_query(
+        kind, many=many, window=not all_data,
+        limit=bool(samples) and not all_data and not downsample,
+        downsample=downsample)
+
+    # LTTB väljer punkter bland min/max-kandidaterna från databasen
+    candidates = max_points * 4 if method == "lttb" else max_points
+    values = {
+        "selected_id": [str(i) for i in selected_ids] if many else str(selected_ids),
+        "start_time": start_time,
+        "end_time": end_time,
+        "samples": samples,
+        "buckets": max(candidates // 2 - 1, 1) if downsample else None,
+    }
+    with get_connection() as conn, conn.cursor() as cur:
+        execute_prepared(conn, cur, name, query, [values[p] for p in param_names])
+        rows = cur.fetchall()
+
+    df = pd.DataFrame(rows, columns=[id_col, time_col, 'value'])
+    if downsample and method == "lttb":
+        parts = []
+        for _, group in df.groupby(id_col, sort=False):
+            if len(group) > max_points:
+                group = group.iloc[lttb(group[time_col].values, group["value"].values, max_points)]
+            parts.append(group)
+        df = pd.concat(parts) if parts else df
+    return df
+
+
+def get_ts_from_id(selected_id, start_time, end_time, all_data=False, samples=None,
+                   max_points=None, method="minmax"):
+    """
+    Fetch the level time series of a signal from public.acurve_ts.
+
+    Parameters:
+        selected_id (str): Signal ID.
+        start_time, end_time (datetime): Time window, ignored if all_data.
+        all_data (bool): Fetch the full history.
+        samples (int): Return at most this many rows (truncates the window).
+        max_points (int): Downsample the window in the database to at most
+            this many points, e.g. plot_max_points(figure).
+        method (str): "minmax" keeps min and max of each time bucket,
+            "lttb" further reduces those with Largest-Triangle-Three-Buckets.
+    """
     logging.info("Hämtar tidsserie...")
     try:
-        engine = create_engine(f"postgresql://{db_user}:{passw}@{host}:{port}/{db_name}")
-        conn = engine.connect()
-
-        if all_data:
-            query = f"""
-                SELECT * FROM public.acurve_ts
-                WHERE signal IN ('{selected_id}')
-                ;
-            """
-
-        elif samples:
-            query = f"""
-                SELECT * FROM public.acurve_ts
-                WHERE signal IN ('{selected_id}')
-                AND timestamp BETWEEN '{start_time.strftime("%Y-%m-%d %H:%M:%S")}' AND '{end_time.strftime("%Y-%m-%d %H:%M:%S")}'
-                LIMIT {samples}
-                ;
-            """
+        if max_points and not all_data:
+            df = _query_ts("acurve", selected_id, start_time, end_time,
+                           max_points=max_points, method=method)
+            df = df.pivot(index='timestamp', columns=['signal'], values='value')
         else:
-            query = f"""
-                SELECT * FROM public.acurve_ts
-                WHERE signal IN ('{selected_id}')
-                AND timestamp BETWEEN '{start_time.strftime("%Y-%m-%d %H:%M:%S")}' AND '{end_time.strftime("%Y-%m-%d %H:%M:%S")}'
-                ;
-            """
-
-        df = pd.read_sql(sqlalchemy.text(query), conn).pivot(index='timestamp', columns=['signal'], values='value')
+            times, values = fetch_ts_arrays("acurve", selected_id, start_time, end_time,
+                                            all_data=all_data, samples=samples)
+            df = _arrays_to_frame("acurve", selected_id, times, values)
 
         logging.info("Tidsserie hämtades.")
         return df
@@ -167,40 +798,24 @@ def get_ts_from_id(selected_id, start_time, end_time, all_data=False, samples=No
             logging.exception("Exception occured")
             raise ValueError(f"Error: {Argument}") from Argument
 
-    finally:
-        conn.close()
-        engine.dispose()
 
+def get_flow_ts_from_id(selected_id, start_time, end_time, all_data=False, samples=None,
+                        max_points=None, method="minmax"):
+    """
+    Fetch a calculated flow time series from flowcalc_schema.flow_ts.
 
-def get_flow_ts_from_id(selected_id, start_time, end_time, all_data=False, samples=None):
+    Takes the same arguments as get_ts_from_id.
+    """
     logging.info("Tidsserie hämtas...")
     try:
-        engine = create_engine(f"postgresql://{db_user}:{passw}@{host}:{port}/{db_name}")
-        conn = engine.connect()
-
-        if all_data:
-            query = f"""
-                SELECT * FROM flowcalc_schema.flow_ts
-                WHERE unique_id IN ('{selected_id}')
-                ;
-            """
-
-        elif samples:
-            query = f"""
-                SELECT * FROM flowcalc_schema.flow_ts
-                WHERE unique_id IN ('{selected_id}')
-                AND time BETWEEN '{start_time.strftime("%Y-%m-%d %H:%M:%S")}' AND '{end_time.strftime("%Y-%m-%d %H:%M:%S")}'
-                LIMIT {samples}
-                ;
-            """
+        if max_points and not all_data:
+            df = _query_ts("flow", selected_id, start_time, end_time,
+                           max_points=max_points, method=method)
+            df = df.pivot(index='time', columns=['unique_id'], values='value')
         else:
-            query = f"""
-                SELECT * FROM flowcalc_schema.flow_ts
-                WHERE unique_id IN ('{selected_id}')
-                AND time BETWEEN '{start_time.strftime("%Y-%m-%d %H:%M:%S")}' AND '{end_time.strftime("%Y-%m-%d %H:%M:%S")}'
-                ;
-            """
-        df = pd.read_sql(sqlalchemy.text(query), conn).pivot(index='time', columns=['unique_id'], values='value')
+            times, values = fetch_ts_arrays("flow", selected_id, start_time, end_time,
+                                            all_data=all_data, samples=samples)
+            df = _arrays_to_frame("flow", selected_id, times, values)
 
         logging.info("Tidsserie hämtades.")
         return df
@@ -209,9 +824,118 @@ def get_flow_ts_from_id(selected_id, start_time, end_time, all_data=False, sampl
             logging.exception("Exception occured")
             raise ValueError(f"Error: {Argument}") from Argument
 
-    finally:
-        conn.close()
-        engine.dispose()
+
+def get_ts_from_ids(selected_ids, start_time, end_time, all_data=False, max_points=None):
+    """
+    Fetch several level time series from public.acurve_ts in one round trip.
+
+    Parameters:
+        selected_ids (list of str): Signal IDs.
+        start_time, end_time, all_data, max_points: As for get_ts_from_id.
+
+    Returns:
+        pandas.DataFrame: One column per signal, indexed by timestamp.
+    """
+    logging.info("Hämtar tidsserier...")
+    try:
+        df = _query_ts("acurve", list(selected_ids), start_time, end_time,
+                       all_data=all_data, max_points=max_points)
+        df = df.pivot(index='timestamp', columns=['signal'], values='value')
+
+        logging.info("Tidsserier hämtades.")
+        return df
+
+    except Exception as Argument:
+        logging.exception("Exception occured")
+        raise ValueError(f"Error: {Argument}") from Argument
+
+
+def get_flow_ts_from_ids(selected_ids, start_time, end_time, all_data=False, max_points=None):
+    """
+    Fetch several calculated flow time series from flowcalc_schema.flow_ts
+    in one round trip.
+
+    Takes the same arguments as get_ts_from_ids.
+    """
+    logging.info("Hämtar tidsserier...")
+    try:
+        df = _query_ts("flow", list(selected_ids), start_time, end_time,
+                       all_data=all_data, max_points=max_points)
+        df = df.pivot(index='time', columns=['unique_id'], values='value')
+
+        logging.info("Tidsserier hämtades.")
+        return df
+
+    except Exception as Argument:
+        logging.exception("Exception occured")
+        raise ValueError(f"Error: {Argument}") from Argument
+
+
+def get_ts_extent(kind, selected_id):
+    """
+    First and last timestamp of a time series, read from the ends of the
+    (id, time) index.
+
+    Parameters:
+        kind (str): "acurve" or "flow".
+        selected_id (str or list of str): Signal ID or unique_id. For a
+            list, the span of all the series, still in one round trip.
+
+    Returns:
+        tuple: (first, last) as datetime, (None, None) for an empty series.
+    """
+    try:
+        table, id_col, time_col = ts_tables[kind]
+        with get_connection() as conn, conn.cursor() as cur:
+            if isinstance(selected_id, str):
+                cur.execute(f"SELECT min({time_col}), max({time_col}) FROM {table} WHERE {id_col} = %s;",
+                            (str(selected_id),))
+            else:
+                # En delfråga per serie, så att var och en läser indexets ändar i stället för alla rader
+                cur.execute(f"""
+                    SELECT min(e.first_time), max(e.last_time)
+                    FROM unnest(%s::text[]) AS ids(id),
+                    LATERAL (SELECT min({time_col}) AS first_time, max({time_col}) AS last_time
+                             FROM {table} WHERE {id_col} = ids.id) AS e;
+                """, ([str(i) for i in selected_id],))
+            return cur.fetchone()
+
+    except Exception as Argument:
+        logging.exception("Exception occured")
+        raise ValueError(f"Error: {Argument}") from Argument
+
+
+def _insert_calc_metadata(cur, unique_id, name, original_signal_id, calc_type, unit, parameters):
+    # Används av store_calc_metadata och publish_calculation, committar inte
+    check_unique_id = "SELECT COUNT(*) FROM flowcalc_schema.flow_meta WHERE unique_id = %s;"
+    cur.execute(check_unique_id, (unique_id,))
+    count = cur.fetchone()[0]
+
+    if count > 0:
+        raise ValueError(f"Duplicate unique_id '{unique_id}'. Entry already exists in the table.")
+
+    if calc_type == "overfall":
+        
+        ski_height, ski_width = parameters
+        overfall_insert = """
+            INSERT INTO flowcalc_schema.flow_meta (unique_id, name, original_signal_id, calc_type, unit, 
+            ski_width, ski_height)
+            VALUES (%s, %s, %s, %s, %s, %s, %s);
+        """
+        cur.execute(overfall_insert, (str(unique_id), str(name), str(original_signal_id), str(calc_type), str(unit), float(ski_width), float(ski_height)))
+        
+        
+    elif calc_type == "rorberakning":
+        slope, diameter, roughness, *options = parameters
+        solve_loss = bool(options[0]) if options else False
+        ror_insert = """
+            INSERT INTO flowcalc_schema.flow_meta (unique_id, name, original_signal_id, calc_type, unit,
+            slope, diameter, roughness, solve_loss)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
+        """
+        cur.execute(ror_insert, (unique_id, name, original_signal_id, calc_type, unit,
+                                  slope, diameter, roughness, solve_loss))
+
 
 def store_calc_metadata(unique_id, name, original_signal_id, calc_type, 
                         unit, parameters):
@@ -225,64 +949,76 @@ def store_calc_metadata(unique_id, name, original_signal_id, calc_type,
         calc_type (str): Calculation type. Either "overfall" or "rorberakning".
         unit (str): Unit. l/s or m3/s
         parameters (tuple): Calculation parameters. 
-        Either (ski_width, ski_height) or (slope, diameter, roughness) depending on calc_type
+        Either (ski_width, ski_height) or (slope, diameter, roughness[, solve_loss]) depending on calc_type
     """
     logging.info("Skriver metadata till databas...")
     try:
-        conn = psycopg2.connect(
-            host=host,
-            database=db_name,
-            user=db_user,
-            password=passw
-        )
-        cur = conn.cursor()
-        check_unique_id = "SELECT COUNT(*) FROM flowcalc_schema.flow_meta WHERE unique_id = %s;"
-        cur.execute(check_unique_id, (unique_id,))
-        count = cur.fetchone()[0]
+        ensure_schema()
+        with get_connection() as conn, conn.cursor() as cur:
+            _insert_calc_metadata(cur, unique_id, name, original_signal_id, calc_type, unit, parameters)
 
-        if count > 0:
-            raise ValueError(f"Duplicate unique_id '{unique_id}'. Entry already exists in the table.")
-
-        if calc_type == "overfall":
-            
-            ski_height, ski_width = parameters
-            overfall_insert = """
-                INSERT INTO flowcalc_schema.flow_meta (unique_id, name, original_signal_id, calc_type, unit, 
-                ski_width, ski_height)
-                VALUES (%s, %s, %s, %s, %s, %s, %s);
-            """
-            cur.execute(overfall_insert, (str(unique_id), str(name), str(original_signal_id), str(calc_type), str(unit), float(ski_width), float(ski_height)))
-            
+            # Commit the transaction
+            conn.commit()
             
-        elif calc_type == "rorberakning":
-            slope, diameter, roughness = parameters
-            ror_insert = """
-                INSERT INTO flowcalc_schema.flow_meta (unique_id, name, original_signal_id, calc_type, unit,
-                slope, diameter, roughness)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-            """
-            cur.execute(ror_insert, (unique_id, name, original_signal_id, calc_type, unit,
-                                      slope, diameter, roughness))
-
-        # Commit the transaction
-        conn.commit()
-        
-        if cur.rowcount != 1:
-            logging.error("Insertion failed")
-            raise ValueError("Insertion failed.")
+            if cur.rowcount != 1:
+                logging.error("Insertion failed")
+                raise ValueError("Insertion failed.")
 
-        df = get_flow_meta_data()
         logging.info("Metadata har skrivits till databas.")
 
     except Exception as Argument:
+        # en ej committad transaktion rullas tillbaka när anslutningen lämnas tillbaka till poolen
         logging.exception("Exception occured")
-        conn.rollback()
         raise ValueError(f"Error during insertion: {Argument}") from Argument
 
-    finally:
-        cur.close()
-        conn.close()
-    
+
+def publish_calculation(staging_id, unique_id, name, original_signal_id, calc_type, unit, parameters,
+                        last_input_time=None, replace=False):
+    """
+    Give a calculation written under staging_id its real ID and metadata,
+    in one transaction.
+
+    calculations.incremental.create_calculation writes the time series and
+    rollups under a staging ID without a flow_meta row, so the half-written
+    calculation is never listed or refreshed. With replace=True the existing
+    calculation is deleted in the same transaction as the swap, so readers
+    see either the old or the new calculation, and a cancelled or failed
+    recalculation leaves the old one as it was.
+
+    Parameters:
+        staging_id (str): ID the time series was written under.
+        unique_id, name, original_signal_id, calc_type, unit, parameters:
+            As for store_calc_metadata.
+        last_input_time (datetime): High-water mark of the staged series,
+            see store_calc_arrays.
+        replace (bool): Replace an existing calculation with the same ID.
+    """
+    logging.info("Publicerar beräkning...")
+    try:
+        ensure_schema()
+        with get_connection() as conn, conn.cursor() as cur:
+            if replace:
+                _delete_calculation(cur, unique_id)
+            _insert_calc_metadata(cur, unique_id, name, original_signal_id, calc_type, unit, parameters)
+            if cur.rowcount != 1:
+                raise ValueError("Insertion failed.")
+
+            cur.execute("UPDATE flowcalc_schema.flow_ts SET unique_id = %s WHERE unique_id = %s;",
+                        (unique_id, staging_id))
+            cur.execute("UPDATE flowcalc_schema.flow_rollup SET unique_id = %s WHERE unique_id = %s;",
+                        (unique_id, staging_id))
+            cur.execute("UPDATE flowcalc_schema.rollup_state SET id = %s WHERE kind = 'flow' AND id = %s;",
+                        (unique_id, staging_id))
+            if last_input_time is not None:
+                _set_high_water_mark(cur, unique_id, last_input_time)
+            conn.commit()
+        _notify_write(unique_id)
+        logging.info("Beräkningen har publicerats.")
+
+    except Exception as Argument:
+        logging.exception("Exception occured")
+        raise ValueError(f"Error publishing '{unique_id}': {Argument}") from Argument
+
 
 def store_calc_ts(data):
     """
@@ -293,46 +1029,510 @@ def store_calc_ts(data):
     """
     logging.info("Skriver tidsserie till databas...")
     try:
-        conn = psycopg2.connect(
-            host=host,
-            database=db_name,
-            user=db_user,
-            password=passw
-        )
-        cur = conn.cursor()
+        ensure_schema()
+        with get_connection() as conn, conn.cursor() as cur:
 
-        def insert_data_batch(conn, cur, data):
-            try:
-                # Define the SQL statement for batch insertion
-                insert_query = """
-                INSERT INTO flowcalc_schema.flow_ts (time, value, unique_id)
-                VALUES %s
-                ON CONFLICT (time, unique_id) DO UPDATE
-                SET value = EXCLUDED.value
-                """
-                psycopg2.extras.execute_values(cur, insert_query, data)
+            def insert_data_batch(conn, cur, data):
+                try:
+                    # Define the SQL statement for batch insertion
+                    insert_query = """
+                    INSERT INTO flowcalc_schema.flow_ts (time, value, unique_id)
+                    VALUES %s
+                    ON CONFLICT (time, unique_id) DO UPDATE
+                    SET value = EXCLUDED.value
+                    """
+                    psycopg2.extras.execute_values(cur, insert_query, data)
+
+                    # Commit the transaction
+                    conn.commit()
+                    logging.info("Batch skrevs till databas.")       
 
-                # Commit the transaction
-                conn.commit()
-                logging.info("Batch skrevs till databas.")       
+                except (Exception, psycopg2.Error) as Argument:
+                    logging.exception("Exception occured") 
+                    conn.rollback()
 
-            except (Exception, psycopg2.Error) as Argument:
-                logging.exception("Exception occured") 
-                conn.rollback()
+            # Define batch size for batch insertion
+            batch_size = 100_000
+            for i in range(0, len(data), batch_size):
+                batch = data[i:i+batch_size]
+                insert_data_batch(conn, cur, batch)
 
-        # Define batch size for batch insertion
-        batch_size = 100_000
-        for i in range(0, len(data), batch_size):
-            batch = data[i:i+batch_size]
-            insert_data_batch(conn, cur, batch)
+            # Aggregaten för de skrivna tidsintervallen
+            for unique_id, group in pd.DataFrame(data, columns=["time", "value", "unique_id"]).groupby("unique_id"):
+                _update_flow_rollups(cur, unique_id, group["time"].values)
+            conn.commit()
 
     except (Exception, psycopg2.Error) as Argument:
         logging.exception("Exception occured")
 
     finally:
+        for unique_id in {row[2] for row in data}:
+            _notify_write(unique_id)
         logging.info("Tidsserie skrevs till databas.")  
-        cur.close()
-        conn.close()
+
+
+def _encode_binary_copy(times, values, unique_id):
+    # Bygger en binär COPY-ström (time, value, unique_id) direkt från arrayer
+    id_bytes = str(unique_id).encode()
+    if not id_bytes:
+        raise ValueError("unique_id must not be empty")
+    row_dtype = np.dtype([("fields", ">i2"), ("time_len", ">i4"), ("time", ">i8"),
+                          ("value_len", ">i4"), ("value", ">f8"),
+                          ("id_len", ">i4"), ("id", f"S{len(id_bytes)}")])
+    rows = np.empty(len(values), dtype=row_dtype)
+    rows["fields"] = 3
+    rows["time_len"] = 8
+    rows["time"] = times.astype("M8[us]").view(np.int64) - _pg_epoch_offset_us
+    rows["value_len"] = 8
+    rows["value"] = values
+    rows["id_len"] = len(id_bytes)
+    rows["id"] = id_bytes
+    return b"".join([_copy_signature, b"\x00" * 8, rows.tobytes(), b"\xff\xff"])
+
+
+def store_calc_arrays(times, values, unique_id, chunk_size=1_000_000, high_water_mark=None):
+    """
+    Store a calculated time series with binary COPY.
+
+    The arrays are streamed with COPY ... FROM STDIN (FORMAT binary) into a
+    temporary (unlogged) staging table in chunks of chunk_size rows, and then
+    merged into flowcalc_schema.flow_ts with a single INSERT ... SELECT ...
+    ON CONFLICT statement, all in one transaction together with the
+    affected buckets of the rollup tables.
+
+    Parameters:
+        times (array): Timestamps, datetime64.
+        values (array): Values, float.
+        unique_id (str): Unique ID of the calculation.
+        high_water_mark (datetime): Newest input sample the values were
+            calculated from. Stored in flow_meta.last_input_time in the same
+            transaction, see calculations.incremental.
+
+    Returns:
+        dict: rows, seconds and rows_per_s.
+    """
+    logging.info("Skriver tidsserie till databas...")
+    start = time.perf_counter()
+    try:
+        times = np.asarray(times, dtype="M8[us]")
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(times) != len(values):
+            raise ValueError("times and values must have the same length")
+        valid = ~np.isnat(times)
+        times, values = times[valid], values[valid]
+        ensure_schema()
+
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS flow_ts_stage (
+                    time timestamp, value float8, unique_id text
+                ) ON COMMIT DELETE ROWS;
+            """)
+            for i in range(0, len(values), chunk_size):
+                stream = _encode_binary_copy(times[i:i + chunk_size], values[i:i + chunk_size], unique_id)
+                cur.copy_expert("COPY flow_ts_stage (time, value, unique_id) FROM STDIN (FORMAT binary)",
+                                io.BytesIO(stream))
+
+            cur.execute("""
+                INSERT INTO flowcalc_schema.flow_ts (time, value, unique_id)
+                SELECT time, value, unique_id FROM flow_ts_stage
+                ON CONFLICT (time, unique_id) DO UPDATE
+                SET value = EXCLUDED.value;
+            """)
+            _update_flow_rollups(cur, unique_id, times)
+            if high_water_mark is not None:
+                _set_high_water_mark(cur, unique_id, high_water_mark)
+            conn.commit()
+        _notify_write(unique_id)
+
+        seconds = time.perf_counter() - start
+        stats = {"rows": len(values), "seconds": seconds,
+                 "rows_per_s": len(values) / seconds if seconds > 0 else float("inf")}
+        logging.info(f"Tidsserie skrevs till databas: {stats['rows']} rader, {stats['rows_per_s']:.0f} rader/s.")
+        return stats
+
+    except Exception as Argument:
+        logging.exception("Exception occured")
+        raise ValueError(f"Error: {Argument}") from Argument
+
+
+def store_calc_dataframe(df, unique_id, high_water_mark=None):
+    """
+    Store the first column of a calculation result DataFrame (time index)
+    with store_calc_arrays. Replaces dataframe_to_input_data + store_calc_ts.
+    """
+    return store_calc_arrays(df.index.values, df[df.columns[0]].values, unique_id,
+                             high_water_mark=high_water_mark)
+
+
+_schema_checked = False
+
+
+def ensure_schema():
+    """
+    Add the columns and tables this module needs, once per process.
+
+    flow_meta.last_input_time is the high-water mark of the incremental
+    recalculation: the newest input sample a calculation has been computed for.
+    The rollup tables hold hourly, daily and monthly aggregates of acurve_ts
+    and flow_ts, see refresh_rollups.
+    """
+    global _schema_checked
+    if _schema_checked:
+        return
+    try:
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                ALTER TABLE flowcalc_schema.flow_meta
+                ADD COLUMN IF NOT EXISTS last_input_time timestamp;
+            """)
+            cur.execute("""
+                ALTER TABLE flowcalc_schema.flow_meta
+                ADD COLUMN IF NOT EXISTS solve_loss boolean NOT NULL DEFAULT false;
+            """)
+            for kind, rollup in rollup_tables.items():
+                cur.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {rollup} (
+                        {ts_tables[kind][1]} text NOT NULL,
+                        resolution text NOT NULL,
+                        bucket timestamp NOT NULL,
+                        min float8,
+                        max float8,
+                        sum float8,
+                        count bigint NOT NULL,
+                        PRIMARY KEY ({ts_tables[kind][1]}, resolution, bucket)
+                    );
+                """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS flowcalc_schema.rollup_state (
+                    kind text NOT NULL,
+                    id text NOT NULL,
+                    rolled_up_to timestamp NOT NULL,
+                    PRIMARY KEY (kind, id)
+                );
+            """)
+            conn.commit()
+        _schema_checked = True
+
+    except Exception as Argument:
+        logging.exception("Exception occured")
+        raise ValueError(f"Error: {Argument}") from Argument
+
+
+def _set_high_water_mark(cur, unique_id, high_water_mark):
+    # ensure_schema() måste ha körts innan transaktionen öppnades
+    # Märket flyttas bara framåt
+    cur.execute("""
+        UPDATE flowcalc_schema.flow_meta
+        SET last_input_time = GREATEST(COALESCE(last_input_time, %(mark)s), %(mark)s)
+        WHERE unique_id = %(unique_id)s;
+    """, {"mark": pd.Timestamp(high_water_mark).to_pydatetime(), "unique_id": str(unique_id)})
+
+
+# Aggregattabeller per tidsserietabell, skapas av ensure_schema
+rollup_tables = {
+    "acurve": "flowcalc_schema.acurve_rollup",
+    "flow": "flowcalc_schema.flow_rollup",
+}
+# Upplösning och ungefärlig längd i sekunder, från finast till grövst
+rollup_resolutions = [("hour", 3600), ("day", 86400), ("month", 30.44 * 86400)]
+
+
+def _refresh_rollups(cur, kind, selected_id, first_time=None, last_time=None):
+    # Räknar om alla buckets som berör [first_time, last_time], None är öppet.
+    # Timmar aggregeras från rådata, dagar från timmar och månader från dagar,
+    # så en skrivning läser bara om sina egna rader. NaN och NULL räknas inte.
+    table, id_col, time_col = ts_tables[kind]
+    rollup = rollup_tables[kind]
+    values = {"id": str(selected_id), "first": first_time, "last": last_time}
+    source = None
+    for resolution, _ in rollup_resolutions:
+        lo = f"COALESCE(date_trunc('{resolution}', %(first)s::timestamp), '-infinity'::timestamp)"
+        hi = (f"COALESCE(date_trunc('{resolution}', %(last)s::timestamp) + interval '1 {resolution}', "
+              f"'infinity'::timestamp)")
+        cur.execute(f"""
+            DELETE FROM {rollup}
+            WHERE {id_col} = %(id)s AND resolution = '{resolution}'
+            AND bucket >= {lo} AND bucket < {hi};
+        """, values)
+        if source is None:
+            cur.execute(f"""
+                INSERT INTO {rollup} ({id_col}, resolution, bucket, min, max, sum, count)
+                SELECT {id_col}, '{resolution}', date_trunc('{resolution}', {time_col}),
+                       min(value), max(value), sum(value), count(*)
+                FROM {table}
+                WHERE {id_col} = %(id)s AND {time_col} >= {lo} AND {time_col} < {hi}
+                AND value <> 'NaN'
+                GROUP BY {id_col}, date_trunc('{resolution}', {time_col});
+            """, values)
+        else:
+            cur.execute(f"""
+                INSERT INTO {rollup} ({id_col}, resolution, bucket, min, max, sum, count)
+                SELECT {id_col}, '{resolution}', date_trunc('{resolution}', bucket),
+                       min(min), max(max), sum(sum), sum(count)
+                FROM {rollup}
+                WHERE {id_col} = %(id)s AND resolution = '{source}'
+                AND bucket >= {lo} AND bucket < {hi}
+                GROUP BY {id_col}, date_trunc('{resolution}', bucket);
+            """, values)
+        source = resolution
+
+
+def _advance_rollup_state(cur, kind, selected_id, first_time, last_time):
+    # rolled_up_to: alla värden till och med den tiden finns i aggregaten.
+    # Läget flyttas bara fram när det inte finns oaggregerade rader mellan
+    # det gamla läget och den här skrivningen, t.ex. historik som skrevs
+    # innan tabellerna fanns. Sådana serier fylls i av refresh_rollups.
+    table, id_col, time_col = ts_tables[kind]
+    cur.execute(f"""
+        INSERT INTO flowcalc_schema.rollup_state (kind, id, rolled_up_to)
+        SELECT %(kind)s, %(id)s, %(last)s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {table}
+            WHERE {id_col} = %(id)s AND {time_col} < %(first)s
+            AND {time_col} > COALESCE((SELECT rolled_up_to FROM flowcalc_schema.rollup_state
+                                       WHERE kind = %(kind)s AND id = %(id)s), '-infinity'::timestamp)
+        )
+        ON CONFLICT (kind, id) DO UPDATE
+        SET rolled_up_to = GREATEST(rollup_state.rolled_up_to, EXCLUDED.rolled_up_to);
+    """, {"kind": kind, "id": str(selected_id), "first": first_time, "last": last_time})
+
+
+def _update_flow_rollups(cur, unique_id, times):
+    # Anropas i samma transaktion som skrivningen till flow_ts
+    if len(times) == 0:
+        return
+    first_time = pd.Timestamp(np.min(times)).to_pydatetime()
+    last_time = pd.Timestamp(np.max(times)).to_pydatetime()
+    _refresh_rollups(cur, "flow", unique_id, first_time, last_time)
+    _advance_rollup_state(cur, "flow", unique_id, first_time, last_time)
+
+
+def _rollup_ids(cur, kind):
+    if kind == "flow":
+        cur.execute("SELECT unique_id FROM flowcalc_schema.flow_meta ORDER BY unique_id;")
+    else:
+        # Lös indexskanning över (signal, timestamp) i stället för DISTINCT över hela tabellen
+        cur.execute("""
+            WITH RECURSIVE signals AS (
+                (SELECT signal FROM public.acurve_ts ORDER BY signal LIMIT 1)
+                UNION ALL
+                SELECT (SELECT signal FROM public.acurve_ts WHERE signal > signals.signal
+                        ORDER BY signal LIMIT 1)
+                FROM signals WHERE signals.signal IS NOT NULL
+            )
+            SELECT signal FROM signals WHERE signal IS NOT NULL;
+        """)
+    return [row[0] for row in cur.fetchall()]
+
+
+def refresh_rollups(kind, selected_ids=None, rebuild=False):
+    """
+    Bring the hourly, daily and monthly rollup tables of acurve_ts or
+    flow_ts up to date.
+
+    flow_ts rollups are updated by store_calc_arrays and store_calc_ts in
+    the same transaction as the write, so this is only needed for acurve_ts,
+    which is written by other systems, and to backfill calculations stored
+    before the rollup tables existed. Each series is refreshed from the
+    hour bucket of its rollup_state.rolled_up_to mark, so late rows older
+    than that are only picked up with rebuild=True. Scheduled in app.py and
+    run by `python -m calculations.batch_runner --rollups`. An advisory lock
+    lets one process at a time refresh a kind, the others return 0.
+
+    Parameters:
+        kind (str): "acurve" or "flow".
+        selected_ids (list of str): Series to refresh, None for all.
+        rebuild (bool): Recompute the full history of every series.
+
+    Returns:
+        int: Number of series that were refreshed.
+    """
+    logging.info(f"Uppdaterar aggregat för {kind}...")
+    try:
+        ensure_schema()
+        with get_connection() as lock_conn, lock_conn.cursor() as lock_cur:
+            # Med flera arbetsprocesser schemalägger alla samma uppdatering, bara en kör åt gången
+            lock_cur.execute("SELECT pg_try_advisory_lock(hashtext(%s));", (f"refresh_rollups:{kind}",))
+            if not lock_cur.fetchone()[0]:
+                lock_conn.commit()
+                logging.info(f"Aggregaten för {kind} uppdateras redan av en annan process.")
+                return 0
+            try:
+                ids = list(selected_ids) if selected_ids is not None else _rollup_ids(lock_cur, kind)
+                lock_conn.commit()
+                refreshed = _refresh_rollup_ids(kind, ids, rebuild)
+            finally:
+                lock_conn.rollback()
+                lock_cur.execute("SELECT pg_advisory_unlock(hashtext(%s));", (f"refresh_rollups:{kind}",))
+                lock_conn.commit()
+
+        logging.info(f"Aggregat uppdaterade för {refreshed} av {len(ids)} serier ({kind}).")
+        return refreshed
+
+    except Exception as Argument:
+        logging.exception("Exception occured")
+        raise ValueError(f"Error: {Argument}") from Argument
+
+
+def _refresh_rollup_ids(kind, ids, rebuild):
+    table, id_col, time_col = ts_tables[kind]
+    rollup = rollup_tables[kind]
+    refreshed = 0
+    for selected_id in ids:
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"SELECT max({time_col}) FROM {table} WHERE {id_col} = %s;", (str(selected_id),))
+            last_time = cur.fetchone()[0]
+            cur.execute("SELECT rolled_up_to FROM flowcalc_schema.rollup_state WHERE kind = %s AND id = %s;",
+                        (kind, str(selected_id)))
+            row = cur.fetchone()
+            rolled_up_to = None if rebuild or row is None else row[0]
+
+            if last_time is None:
+                cur.execute(f"DELETE FROM {rollup} WHERE {id_col} = %s;", (str(selected_id),))
+                cur.execute("DELETE FROM flowcalc_schema.rollup_state WHERE kind = %s AND id = %s;",
+                            (kind, str(selected_id)))
+            elif rolled_up_to is None or rolled_up_to < last_time:
+                _refresh_rollups(cur, kind, selected_id, rolled_up_to, None)
+                cur.execute("""
+                    INSERT INTO flowcalc_schema.rollup_state (kind, id, rolled_up_to)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (kind, id) DO UPDATE SET rolled_up_to = EXCLUDED.rolled_up_to;
+                """, (kind, str(selected_id), last_time))
+                refreshed += 1
+            conn.commit()
+    return refreshed
+
+
+def rollup_resolution(start_time, end_time, max_points):
+    """
+    Coarsest rollup resolution that still fills max_points, i.e. gives at
+    least max_points / 2 buckets (a min and a max point each) in the window.
+
+    Returns:
+        str: "hour", "day" or "month", or None when the window is so short
+        that the raw rows should be downsampled instead.
+    """
+    seconds = (pd.Timestamp(end_time) - pd.Timestamp(start_time)).total_seconds()
+    chosen = None
+    for resolution, length in rollup_resolutions:
+        if seconds / length >= max_points / 2:
+            chosen = resolution
+    return chosen
+
+
+def get_rollup(kind, selected_id, resolution, start_time=None, end_time=None):
+    """
+    Fetch aggregates of a time series, e.g. daily min/mean/max flow.
+
+    Parameters:
+        kind (str): "acurve" or "flow".
+        selected_id (str): Signal ID or unique_id.
+        resolution (str): "hour", "day" or "month".
+        start_time, end_time (datetime): Bucket window, None for all.
+
+    Returns:
+        pandas.DataFrame: min, mean, max, sum and count, indexed by bucket
+        start. Only covers data up to rollup_state.rolled_up_to.
+    """
+    logging.info("Hämtar aggregat...")
+    try:
+        if resolution not in dict(rollup_resolutions):
+            raise ValueError(f"Unknown resolution '{resolution}'")
+        ensure_schema()
+        table, id_col, time_col = ts_tables[kind]
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT bucket, min, sum / NULLIF(count, 0), max, sum, count
+                FROM {rollup_tables[kind]}
+                WHERE {id_col} = %(id)s AND resolution = %(resolution)s
+                AND bucket >= COALESCE(%(start)s::timestamp, '-infinity'::timestamp)
+                AND bucket <= COALESCE(%(end)s::timestamp, 'infinity'::timestamp)
+                ORDER BY bucket;
+            """, {"id": str(selected_id), "resolution": resolution, "start": start_time, "end": end_time})
+            rows = cur.fetchall()
+
+        df = pd.DataFrame(rows, columns=["bucket", "min", "mean", "max", "sum", "count"]).set_index("bucket")
+        logging.info("Aggregat hämtades.")
+        return df
+
+    except Exception as Argument:
+        logging.exception("Exception occured")
+        raise ValueError(f"Error: {Argument}") from Argument
+
+
+def _query_rollup(kind, selected_id, start_time, end_time, max_points, resolution):
+    # Min och max per bucket fram till rolled_up_to, resten av fönstret
+    # nedsamplas från rådata. None om serien inte är aggregerad i fönstret.
+    ensure_schema()
+    table, id_col, time_col = ts_tables[kind]
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT rolled_up_to FROM flowcalc_schema.rollup_state WHERE kind = %s AND id = %s;",
+                    (kind, str(selected_id)))
+        row = cur.fetchone()
+        if row is None or row[0] <= start_time:
+            return None
+        covered = min(row[0], end_time)
+        # Bucketen som start_time ligger i räknas med, den börjar före fönstret
+        cur.execute(f"""
+            SELECT bucket, min, max FROM {rollup_tables[kind]}
+            WHERE {id_col} = %s AND resolution = %s
+            AND bucket >= date_trunc(%s, %s::timestamp) AND bucket <= %s
+            ORDER BY bucket;
+        """, (str(selected_id), resolution, resolution, start_time, covered))
+        rows = cur.fetchall()
+
+    buckets = np.array([r[0] for r in rows], dtype="M8[us]")
+    length = np.timedelta64(int(dict(rollup_resolutions)[resolution]), "s")
+    # Min i början och max i mitten av den del av varje bucket som ligger i
+    # [start_time, covered), så att tiderna stiger strikt och slutar före rådatasvansen
+    first = np.maximum(buckets, np.datetime64(start_time, "us"))
+    last = np.minimum(buckets + length, np.datetime64(covered, "us"))
+    inside = first < last
+    first, last = first[inside], last[inside]
+    times = np.column_stack([first, first + (last - first) // 2]).ravel()
+    values = np.array([(r[1], r[2]) for r in rows], dtype=np.float64).reshape(-1, 2)[inside].ravel()
+    df = pd.DataFrame({id_col: str(selected_id), time_col: times, "value": values})
+
+    if covered < end_time:
+        share = (pd.Timestamp(end_time) - pd.Timestamp(covered)) / (pd.Timestamp(end_time) - pd.Timestamp(start_time))
+        tail = _query_ts(kind, selected_id, covered, end_time, max_points=max(int(max_points * share), 4))
+        df = pd.concat([df, tail], ignore_index=True)
+    if len(df) > max_points:
+        # Upplösningen kan ge upp till 30 gånger fler buckets än som behövs
+        df = df.iloc[minmax_downsample(df[time_col].values, df["value"].values, max_points)]
+    return df
+
+
+def _delete_calculation(cur, unique_id):
+    # ensure_schema() måste ha körts innan transaktionen öppnades
+    # Define the SQL statement to delete data from flowcalc_schema.flow_ts
+    delete_ts_query = """
+    DELETE FROM flowcalc_schema.flow_ts
+    WHERE unique_id = %s
+    """
+
+    # Execute the delete query for flowcalc_schema.flow_ts with the provided unique_id
+    cur.execute(delete_ts_query, (unique_id,))
+
+    # Define the SQL statement to delete data from flowcalc_schema.flow_meta
+    delete_meta_query = """
+    DELETE FROM flowcalc_schema.flow_meta
+    WHERE unique_id = %s
+    """
+
+    # Execute the delete query for flowcalc_schema.flow_meta with the provided unique_id
+    cur.execute(delete_meta_query, (unique_id,))
+
+    # Aggregaten för beräkningen
+    cur.execute("""
+    DELETE FROM flowcalc_schema.flow_rollup
+    WHERE unique_id = %s
+    """, (unique_id,))
+    cur.execute("""
+    DELETE FROM flowcalc_schema.rollup_state
+    WHERE kind = 'flow' AND id = %s
+    """, (unique_id,))
 
 
 def delete_data_by_id(unique_id):
@@ -344,40 +1544,15 @@ def delete_data_by_id(unique_id):
     """
     logging.info("Raderar beräkning från databas...")
     try:
-        conn = psycopg2.connect(
-            host=host,
-            database=db_name,
-            user=db_user,
-            password=passw
-        )
-        cur = conn.cursor()
+        ensure_schema()
+        with get_connection() as conn, conn.cursor() as cur:
+            _delete_calculation(cur, unique_id)
 
-        # Define the SQL statement to delete data from flowcalc_schema.flow_ts
-        delete_ts_query = """
-        DELETE FROM flowcalc_schema.flow_ts
-        WHERE unique_id = %s
-        """
-        
-        # Execute the delete query for flowcalc_schema.flow_ts with the provided unique_id
-        cur.execute(delete_ts_query, (unique_id,))
-        
-        # Define the SQL statement to delete data from flowcalc_schema.flow_meta
-        delete_meta_query = """
-        DELETE FROM flowcalc_schema.flow_meta
-        WHERE unique_id = %s
-        """
-
-        # Execute the delete query for flowcalc_schema.flow_meta with the provided unique_id
-        cur.execute(delete_meta_query, (unique_id,))
-
-        # Commit the transaction
-        conn.commit()
+            # Commit the transaction
+            conn.commit()
+        _notify_write(unique_id)
         logging.info("All data för vald beräkning har raderats.")
         #print(f"All data for ID '{unique_id}' deleted successfully.")
 
     except (Exception, psycopg2.Error) as Argument:
         logging.exception("Exception occured")
-
-    finally:
-        cur.close()
-        conn.close()
\ No newline at end of file
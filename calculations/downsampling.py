@@ -0,0 +1,123 @@
+import logging
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+logger.propagate = False
+
+# Antal punkter per pixel som skickas till Bokeh
+points_per_pixel = 2
+default_plot_width = 1000
+
+
+def plot_max_points(fig, points_per_pixel=points_per_pixel):
+    """
+    Number of points worth sending to a Bokeh figure.
+
+    Uses the rendered inner width when the browser has reported it, otherwise
+    the configured width of the figure.
+    """
+    width = None
+    for attr in ("inner_width", "width"):
+        try:
+            # inner_width saknar värde tills webbläsaren har ritat figuren
+            width = getattr(fig, attr, None)
+        except Exception:
+            width = None
+        if width:
+            break
+    return int((width or default_plot_width) * points_per_pixel)
+
+
+def _as_float(x):
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype("M8[ms]").astype(np.int64).astype(np.float64)
+    return x.astype(np.float64)
+
+
+def minmax_downsample(x, y, n_out):
+    """
+    Reduce a series to the min and max sample of n_out // 2 equal-width buckets.
+
+    Parameters:
+        x (array): Sorted x values (numbers or datetime64).
+        y (array): Values.
+        n_out (int): Maximum number of points returned.
+
+    Returns:
+        numpy.ndarray: Sorted indices of the kept samples.
+    """
+    n = len(y)
+    n_buckets = max(n_out // 2, 1)
+    if n <= n_out:
+        return np.arange(n)
+
+    xf = _as_float(x)
+    edges = np.linspace(xf[0], xf[-1], n_buckets + 1)
+    starts = np.searchsorted(xf, edges[:-1], side="left")
+    starts = np.unique(starts)
+
+    # NaN ska inte väljas som min eller max
+    y = np.asarray(y, dtype=np.float64)
+    y_low = np.where(np.isnan(y), np.inf, y)
+    y_high = np.where(np.isnan(y), -np.inf, y)
+
+    bucket_of = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, n)))
+    min_val = np.minimum.reduceat(y_low, starts)
+    max_val = np.maximum.reduceat(y_high, starts)
+    is_min = y_low == min_val[bucket_of]
+    is_max = y_high == max_val[bucket_of]
+
+    # första förekomsten av min respektive max i varje bucket
+    min_idx = np.full(len(starts), n)
+    max_idx = np.full(len(starts), n)
+    np.minimum.at(min_idx, bucket_of[is_min], np.flatnonzero(is_min))
+    np.minimum.at(max_idx, bucket_of[is_max], np.flatnonzero(is_max))
+    idx = np.concatenate([min_idx, max_idx])
+    return np.unique(idx[idx < n])
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+
+    Parameters:
+        x (array): Sorted x values (numbers or datetime64).
+        y (array): Values, NaN is not allowed.
+        n_out (int): Number of points returned, at least 3.
+
+    Returns:
+        numpy.ndarray: Sorted indices of the kept samples.
+    """
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+
+    xf = _as_float(x)
+    yf = np.asarray(y, dtype=np.float64)
+
+    # första och sista punkten behålls alltid, resten delas i n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_stop = edges[i + 1], edges[i + 2]
+            avg_x = xf[next_start:next_stop].mean()
+            avg_y = yf[next_start:next_stop].mean()
+        else:
+            avg_x, avg_y = xf[-1], yf[-1]
+
+        area = np.abs(
+            (xf[a] - avg_x) * (yf[start:stop] - yf[a])
+            - (xf[a] - xf[start:stop]) * (avg_y - yf[a])
+        )
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+
+    return selected
@@ -3,49 +3,43 @@ import logging.config
 from os import path
 import numpy as np
 import pandas as pd
+from calculations.flow_kernels import overfall_flow, cole_white_flow
+from calculations.rating_tables import get_rating_table
 
 
 logger = logging.getLogger(__name__)
 logger.propagate = False
 
-def overfall(level, skibordshojd, skibordsbredd, unit, dataframe=False):
+def overfall(level, skibordshojd, skibordsbredd, unit, dataframe=False, out=None):
     # Beräkning från https://pub.epsilon.slu.se/11781/11/persson_j_etal_150203.pdf
     logging.info("Utför överfallsberäkning")
     try:
-        np.seterr(divide='ignore', invalid='ignore')
-        g = 9.81  # m/s^2
         b = float(skibordsbredd)  # m
         p = float(skibordshojd)  # m
-        h = np.array(level) - p  # nivå minus skibordshöjd, vattennivå över skibord
-        h[h < 0] = 0  # inget flöde över, negativa höjder tas bort
-        Ce = 0.602 + 0.083 * h / p  # har även sätt 0.075 * h / p användas
+        # Ce = 0.602 + 0.083 * h / p, har även sätt 0.075 * h / p användas
+        # h = nivå minus skibordshöjd, negativa höjder (inget flöde över) blir 0
+        Q = overfall_flow(level, p, b, scale=1000 if unit == "l/s" else 1, out=out)  # 1 m3/s = 1000 l/s
 
         # Går att lägga till ytterligare i app för att hantera detta vid behov
-        if np.any(h/p > 1):
+        h_max = np.nanmax(np.asarray(level, dtype=np.float64), initial=-np.inf) - p
+        if p > 0 and h_max > p:
             logging.info("Nivå över skibordshöjd är \
             lika stor som skibordshöjd i någon punkt")
         if b < 0.3:
             logging.info("Vald skibordsbredd mindre än 30 cm, borde vara minst 30 cm för att beräkning ska fungera")
         if p < 0.3:
             logging.info("Vald skibordshöjd mindre än 30 cm, borde vara minst 30 cm för att beräkning ska fungera")
-        if np.any(h) > 0.75:
+        if h_max > 0.75:
             logging.info("Nivå över skibordshöjd över 75 cm, beräkning kanske inte stämmer.")
         # "h skall vara minst 3 cm och högst 75 cm" ska minst 3 cm verkligen tas med?
         #  if np.any(h) < 0.03:
         #    print("Varning: Nivå över skibordshöjd under 3 cm, beräkning kanske inte stämmer")
 
-        # with np.errstate(divide='ignore', invalid='ignore'):
-        Q = Ce * 2/3 * np.sqrt(2*g)*b*h**1.5
-        Q[np.isnan(Q)] = 0.0  # Convert NaNs to 0.0
-
-        if unit == "l/s":
-            Q *= 1000 # 1 m3/s = 1000 l/s
-
         if dataframe:
             result_df = pd.DataFrame(Q, index=level.index, columns=[f'Flödes ({unit})'])
             return result_df
         logging.info("Överfallsberäkning utfördes")
-        return Q.flatten()
+        return Q
     
     except Exception as Argument:
         logging.exception("Exception occured")
@@ -55,57 +49,57 @@ def overfall(level, skibordshojd, skibordsbredd, unit, dataframe=False):
 def cole_white_flow_calc(level, slope, diameter, roughness, unit, dataframe=True, velocity_output=False):
     logging.info("Utför rörberäkning")
     try:
-        np.seterr(divide='ignore', invalid='ignore')
-        # print("min level", min(level))
-
-        # konstanter
-        g = 9.81
-        v = 1.0034
-
-        # inputparameterar
-        r = float(diameter) / 2 # enhet?
-        k = float(roughness) # enhet?
-        S = float(slope) # enhet?
-        h = np.array(level)
-
-        # definera shape output array
-        Q = np.zeros(np.shape(h))
-
-        # runt rör
-        # for full pipe
-        A = np.pi * r**2
-        R = r / 2  # "hydraulic raduis of a full pipe is simply half of its radius"
-        Q[h > 2 * r] = np.sqrt(32*g*R*S) * A * np.log10(
-            k / (14.83 * R) + 2.52 * v / (R*np.sqrt(128*g*R*S))
-        )
-
-        # partially full
-        θ = (2 * np.arccos((r - h[h <= 2 * r]) / r)) # arc length 
-        A = r**2 * (θ - np.sin(θ)) / 2
-        P = r * θ
-        R = A / P
-        Q[h <= 2 * r] = np.sqrt(32*g*4*R*S) * A * np.log10(k / (14.83 * 4*R) + 2.52 * v / (R*np.sqrt(128*g*R*S)))
-
-        Q[np.isinf(Q)] = np.nan  # ifall det finns oänliga värden, konvertera dem till NaN
-
-        if unit == "l/s":
-            Q *= 1000  # 1 m3/s = 1000 l/s
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # print("min level", min(level))
+
+            # konstanter
+            g = 9.81
+            v = 1.0034
+
+            # inputparameterar
+            r = float(diameter) / 2 # enhet?
+            k = float(roughness) # enhet?
+            S = float(slope) # enhet?
+            h = np.array(level)
+
+            # definera shape output array
+            Q = np.zeros(np.shape(h))
+
+            # runt rör
+            # for full pipe
+            A = np.pi * r**2
+            R = r / 2  # "hydraulic raduis of a full pipe is simply half of its radius"
+            Q[h > 2 * r] = np.sqrt(32*g*R*S) * A * np.log10(
+                k / (14.83 * R) + 2.52 * v / (R*np.sqrt(128*g*R*S))
+            )
+
+            # partially full
+            θ = (2 * np.arccos((r - h[h <= 2 * r]) / r)) # arc length 
+            A = r**2 * (θ - np.sin(θ)) / 2
+            P = r * θ
+            R = A / P
+            Q[h <= 2 * r] = np.sqrt(32*g*4*R*S) * A * np.log10(k / (14.83 * 4*R) + 2.52 * v / (R*np.sqrt(128*g*R*S)))
+
+            Q[np.isinf(Q)] = np.nan  # ifall det finns oänliga värden, konvertera dem till NaN
+
+            if unit == "l/s":
+                Q *= 1000  # 1 m3/s = 1000 l/s
             
-        if velocity_output:
-            if np.all(h) <= 2 * r:
-                A = np.pi * r**2
-            #print("Ashape", A)
-            #print(Q*A.item())
-            return (Q/A.item())#.flatten() #
+            if velocity_output:
+                if np.all(h) <= 2 * r:
+                    A = np.pi * r**2
+                #print("Ashape", A)
+                #print(Q*A.item())
+                return (Q/A.item())#.flatten() #
         
-        if dataframe:
-            result_df = pd.DataFrame(Q, index=level.index, columns=[f'Flöde ({unit})'])
-            return result_df
+            if dataframe:
+                result_df = pd.DataFrame(Q, index=level.index, columns=[f'Flöde ({unit})'])
+                return result_df
         
         
     
-        logging.info("Rörberäkning utfördes")
-        return Q.flatten()
+            logging.info("Rörberäkning utfördes")
+            return Q.flatten()
     
 
     except Exception as Argument:
@@ -117,136 +111,281 @@ def cole_white_flow_calc(level, slope, diameter, roughness, unit, dataframe=True
 def cole_white_new(level, slope, diameter, roughness, unit, dataframe=True, velocity_output=False, index=None):
     logging.info("Utför rörberäkning")
     try:
-        np.seterr(divide='ignore', invalid='ignore')
-
-        # Constants
-        g = 9.81 # m/s^2
-        v = 1.0034e-6  # kinematic viscosity in m^2/s, corrected unit
-
-        # Input parameters
-        r = float(diameter) / 2 / 1000 # expected input is in mm converting to m, dividing by 2 for radius
-        k = float(roughness) / 1000 # expected input is in mm converting to m
-        S = float(slope) / 1000 # expected input is in per mil. 
-        h = np.array(level) # expected input is in m
-
-        # Define shape output array
-        Q = np.zeros(np.shape(h))
-
-        # Full pipe condition
-        A_full = np.pi * r**2
-        R_full = r / 2
-        full_pipe = h > 2 * r
-
-        θ = 2 * np.arccos((r - h[~full_pipe]) / r)
-        A_partial = r**2 * (θ - np.sin(θ)) / 2 # positiv
-        P_partial = r * θ
-        R_partial = A_partial / P_partial
-
-        if velocity_output:
-            velocity = np.zeros_like(Q)
-            velocity[full_pipe] = np.abs((
-                np.sqrt(32 * g * R_full * S) * np.log10(
+        with np.errstate(divide='ignore', invalid='ignore'):
+
+            # Constants
+            g = 9.81 # m/s^2
+            v = 1.0034e-6  # kinematic viscosity in m^2/s, corrected unit
+
+            # Input parameters
+            r = float(diameter) / 2 / 1000 # expected input is in mm converting to m, dividing by 2 for radius
+            k = float(roughness) / 1000 # expected input is in mm converting to m
+            S = float(slope) / 1000 # expected input is in per mil. 
+            h = np.array(level) # expected input is in m
+
+            # Define shape output array
+            Q = np.zeros(np.shape(h))
+
+            # Full pipe condition
+            A_full = np.pi * r**2
+            R_full = r / 2
+            full_pipe = h > 2 * r
+
+            θ = 2 * np.arccos((r - h[~full_pipe]) / r)
+            A_partial = r**2 * (θ - np.sin(θ)) / 2 # positiv
+            P_partial = r * θ
+            R_partial = A_partial / P_partial
+
+            if velocity_output:
+                velocity = np.zeros_like(Q)
+                velocity[full_pipe] = np.abs((
+                    np.sqrt(32 * g * R_full * S) * np.log10(
+                        k / (14.83 * R_full) + 2.52 * v / (R_full * np.sqrt(128 * g * R_full * S))
+                    )))
+
+                velocity[~full_pipe] = np.abs((
+                    np.sqrt(32 * g * R_partial * S) * np.log10(
+                        k / (14.83 * R_partial) + 2.52 * v / (R_partial * np.sqrt(128 * g * R_partial * S))
+                    )))
+                return velocity
+        
+            Q[full_pipe] = (
+                np.abs(np.sqrt(32 * g * R_full * S) * A_full * np.log10(
                     k / (14.83 * R_full) + 2.52 * v / (R_full * np.sqrt(128 * g * R_full * S))
                 )))
-
-            velocity[~full_pipe] = np.abs((
-                np.sqrt(32 * g * R_partial * S) * np.log10(
+            Q[~full_pipe] = (
+                np.abs(np.sqrt(32 * g * R_partial * S) * A_partial * np.log10(
                     k / (14.83 * R_partial) + 2.52 * v / (R_partial * np.sqrt(128 * g * R_partial * S))
                 )))
-            return velocity
         
-        Q[full_pipe] = (
-            np.abs(np.sqrt(32 * g * R_full * S) * A_full * np.log10(
-                k / (14.83 * R_full) + 2.52 * v / (R_full * np.sqrt(128 * g * R_full * S))
-            )))
-        Q[~full_pipe] = (
-            np.abs(np.sqrt(32 * g * R_partial * S) * A_partial * np.log10(
-                k / (14.83 * R_partial) + 2.52 * v / (R_partial * np.sqrt(128 * g * R_partial * S))
-            )))
-        
-        Q[np.isinf(Q)] = np.nan  # Convert infinite values to NaN
+            Q[np.isinf(Q)] = np.nan  # Convert infinite values to NaN
 
-        if unit == "l/s":
-            Q *= 1000  # Convert m^3/s to l/s
+            if unit == "l/s":
+                Q *= 1000  # Convert m^3/s to l/s
 
-        if dataframe:
-            if index is not None:
-                result_df = pd.DataFrame(Q, index=index, columns=[f'Flöde ({unit})'])
-            else:
-                result_df = pd.DataFrame(Q, index=level.index, columns=[f'Flöde ({unit})'])
-            return result_df
+            if dataframe:
+                if index is not None:
+                    result_df = pd.DataFrame(Q, index=index, columns=[f'Flöde ({unit})'])
+                else:
+                    result_df = pd.DataFrame(Q, index=level.index, columns=[f'Flöde ({unit})'])
+                return result_df
 
-        logging.info("Rörberäkning utfördes")
-        print("Rörberäkning utfördes")
-        return Q.flatten()
+            logging.info("Rörberäkning utfördes")
+            print("Rörberäkning utfördes")
+            return Q.flatten()
 
     except Exception as Argument:
         print(f"exception {Argument}")
         logging.exception("Exception occured")
         raise ValueError(f"Error: {Argument}") from Argument
 
-def cole_white_with_loss(level, slope, diameter, roughness, unit, dataframe=True):
-    g = 9.82
-     
-    h = np.array(level)
-    v = cole_white_new(level, slope, diameter, roughness, unit, velocity_output=True)
-    #print(v)
-    h_calc = 1.5 * v**2 / ( 2 * g)
-    #print("h calc", h_calc)
-    
-    h = h - h_calc
-    #print(h)
-    
-    Q = cole_white_new(level, slope, diameter, roughness, unit, index=level.index, dataframe=dataframe)
-    #print(Q)
+def cole_white_kernel(level, slope, diameter, roughness, unit, out=None):
+    """
+    Colebrook-White flow, velocity and loss-corrected level in one pass.
+
+    Same model and units as cole_white_new, but the geometry and the
+    arccos/log10 terms are evaluated once per sample and written into three
+    arrays, without the intermediate arrays and boolean-mask copies (see
+    flow_kernels).
+
+    Parameters:
+        level (array): Level (m).
+        slope (float): Slope (per mil).
+        diameter (float): Diameter (mm).
+        roughness (float): Roughness (mm).
+        unit (str): Unit of the flow. l/s or m3/s
+        out (tuple): Optional preallocated float64 arrays (Q, velocity, head),
+            each with the same number of elements as level.
+
+    Returns:
+        tuple: (Q, velocity, head) where Q is the flow at the measured level,
+            velocity is in m/s and head is level minus the velocity head loss
+            1.5 * velocity**2 / (2 * g).
+    """
+    logging.info("Utför rörberäkning")
+    try:
+        # Input parameters, se cole_white_new
+        r = float(diameter) / 2 / 1000
+        k = float(roughness) / 1000
+        S = float(slope) / 1000
+        Q, velocity, head = cole_white_flow(level, r, k, S, scale=1000 if unit == "l/s" else 1, out=out)
+        logging.info("Rörberäkning utfördes")
+        return Q, velocity, head
+
+    except Exception as Argument:
+        logging.exception("Exception occured")
+        raise ValueError(f"Error: {Argument}") from Argument
+
+
+def cole_white_with_loss(level, slope, diameter, roughness, unit, dataframe=True, out=None, solve_loss=False):
+    """
+    Flow for the measured level from a single cole_white_kernel pass. The
+    velocity and loss-corrected level are computed in the same pass but, as
+    before, the flow is not recalculated from the corrected level.
+
+    Parameters:
+        out (tuple): Optional preallocated (Q, velocity, head) buffers, see
+            cole_white_kernel.
+        solve_loss (bool): Calculate the flow at the level where the velocity
+            head loss balances (solve_head_loss) instead of the measured level.
+            Chosen in the pipe-flow form and stored in flow_meta.solve_loss,
+            see pipe_parameters.
+    """
+    if solve_loss:
+        solution = solve_head_loss(level, slope, diameter, roughness)
+        Q, velocity, head = cole_white_kernel(solution["head"], slope, diameter, roughness, unit, out=out)
+    else:
+        Q, velocity, head = cole_white_kernel(level, slope, diameter, roughness, unit, out=out)
+    if dataframe:
+        return pd.DataFrame(Q, index=getattr(level, "index", None), columns=[f'Flöde ({unit})'])
     return Q
 
 
-def iteration_test(level, slope, diameter, roughness, unit):
+def calculate_flow(level, calc_type, parameters, unit, rating_table=False):
+    """
+    Calculate flow for a stored calculation.
+
+    Parameters:
+        level (array): Level (m).
+        calc_type (str): Calculation type. Either "overfall" or "rorberakning".
+        parameters (tuple): (ski_height, ski_width) for "overfall" or
+            (slope, diameter, roughness[, solve_loss]) for "rorberakning", in
+            the same order as store_calc_metadata, see pipe_parameters.
+        unit (str): Unit. l/s or m3/s
+        rating_table (bool): Interpolate in a cached rating table
+            (calculations.rating_tables) instead of evaluating the model for
+            every sample. Falls back to the model for parameters that cannot
+            be tabulated.
+
+    Returns:
+        numpy.ndarray: Flow, one value per level sample.
+    """
+    level = np.asarray(level, dtype=np.float64).ravel()
+    if rating_table:
+        try:
+            return get_rating_table(calc_type, parameters, unit).evaluate(level)
+        except ValueError as e:
+            logging.info(f"Ingen avkastningstabell, beräknar direkt: {e}")
+    if calc_type == "overfall":
+        ski_height, ski_width = parameters
+        return overfall(level, ski_height, ski_width, unit)
+    if calc_type == "rorberakning":
+        slope, diameter, roughness, solve_loss = pipe_parameters(parameters)
+        return cole_white_with_loss(level, slope, diameter, roughness, unit, dataframe=False,
+                                    solve_loss=solve_loss)
+    raise ValueError(f"Unknown calc_type '{calc_type}'")
+
+
+def pipe_parameters(parameters):
+    """
+    (slope, diameter, roughness, solve_loss) from the parameters of a
+    "rorberakning" calculation. solve_loss is optional and defaults to
+    False, the flow at the measured level.
+    """
+    slope, diameter, roughness, *options = parameters
+    return slope, diameter, roughness, bool(options[0]) if options else False
+
+
+def calc_parameters(meta):
+    """
+    Parameters tuple for calculate_flow from a flowcalc_schema.flow_meta row.
+    """
+    if meta["calc_type"] == "overfall":
+        return (float(meta["ski_height"]), float(meta["ski_width"]))
+    if meta["calc_type"] == "rorberakning":
+        solve_loss = meta.get("solve_loss")
+        return (float(meta["slope"]), float(meta["diameter"]), float(meta["roughness"]),
+                bool(solve_loss) if solve_loss is not None and not pd.isna(solve_loss) else False)
+    raise ValueError(f"Unknown calc_type '{meta['calc_type']}'")
+
+
+def solve_head_loss(level, slope, diameter, roughness, tol=1e-6, max_iter=50):
+    """
+    Solve h = h_org - 1.5 * v(h)**2 / (2 * g) for every sample, where v is
+    the Colebrook-White velocity at level h (cole_white_kernel).
+
+    The root lies in [0, h_org] since the residual is negative at 0 and
+    non-negative at h_org. Each sample is solved with Newton steps (finite
+    difference derivative), falling back to bisection of its bracket when a
+    step leaves it. Converged samples are dropped from the working set, so
+    the cost follows the slowest samples only.
+
+    Used by cole_white_with_loss(solve_loss=True), i.e. by pipe-flow
+    calculations stored with flow_meta.solve_loss.
+
+    Parameters:
+        level (array): Measured level h_org (m).
+        slope (float): Slope (per mil).
+        diameter (float): Diameter (mm).
+        roughness (float): Roughness (mm).
+        tol (float): Convergence tolerance on the step (m).
+        max_iter (int): Max number of iterations per sample.
+
+    Returns:
+        dict: "head" loss-corrected level (m), "velocity" at that level (m/s),
+            "converged" (bool array), "iterations" (int array) and
+            "residual" |h + 1.5 * v(h)**2 / (2 * g) - h_org| (m) at the
+            returned head.
+            Samples with level <= 0 have no loss and count as converged, NaN
+            samples stay NaN and do not converge.
+    """
     g = 9.82
-    
-    h_org = np.array(level)
-    h = h_org
-    i = 0
-    while True:
-        v = cole_white_new(h, slope, diameter, roughness, unit, velocity_output=True)
-        print("v", v)
-        h_loss = 1.5 * v**2 / (2 * g)
-        if np.abs(np.sum(h) - np.sum(h_org - h_loss)) < 0.005:
-            return h
-            #break
-        h = h_org - h_loss
-        print("h", h)
-        
-        if i > 150:
-            print("did not converge")
-            return None
-        i += 1
-        
-    #print(v)
-   
-    print("h calc", h_calc)
-    i = 0
-    
-    h = h - h_calc
-    print(h)
-    
-    #Q = cole_white_new(h, 3, 330, 1, "m3/s", index=level.index)
-    #print(Q)
-    h_org 
-    while np.any(np.abs(h - h_calc)) > 0.03:
-        h = h - h_calc
-        print("h original", h)
-        #h = h_calc
-        v = cole_white_new(h, slope, diameter, roughness, unit, velocity_output=True)
-        h_calc = 1.5 * v**2 / ( 2 * g)
-        print("h calc", h_calc)
-        print("v:", v)
-        #print("h_calc", h_calc)
-        #print(np.abs(h-h_calc))
-        i += 1
-        if i > 4:
-            break
-            
-#h= 0.1 * np.random.rand(1, size=(100)) #0.1 m           
-#iteration_test(h, 3, 330, 1, "m3/s")
\ No newline at end of file
+    loss_factor = 1.5 / (2 * g)
+    h_org = np.asarray(level, dtype=np.float64).ravel()
+    n = h_org.size
+
+    head = h_org.copy()
+    velocity = np.zeros(n)
+    converged = ~np.isnan(h_org) & (h_org <= 0)
+    iterations = np.zeros(n, dtype=np.int64)
+    residual = np.zeros(n)
+    velocity[np.isnan(h_org)] = np.nan
+    residual[np.isnan(h_org)] = np.nan
+
+    def loss(h):
+        Q, v, _ = cole_white_kernel(h, slope, diameter, roughness, "m3/s")
+        v[h <= 0] = 0.0  # tomt rör, ingen hastighet (kärnan ger 0/0)
+        return loss_factor * v**2, v
+
+    idx = np.flatnonzero(h_org > 0)
+    lo = np.zeros(idx.size)
+    hi = h_org[idx].copy()
+    # Startgissning: ett fixpunktssteg från uppmätt nivå
+    h = np.clip(hi - loss(hi)[0], lo, hi)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(1, max_iter + 1):
+            if idx.size == 0:
+                break
+            f_loss, v = loss(h)
+            f = h + f_loss - h_org[idx]
+            eps = np.maximum(h, 1e-4) * 1e-6
+            df = (eps + loss(h + eps)[0] - f_loss) / eps
+
+            # Krymp intervallet runt roten och ta Newtonsteg inom det
+            above = f > 0
+            hi[above] = h[above]
+            lo[~above] = h[~above]
+            h_new = h - f / df
+            outside = ~((h_new > lo) & (h_new < hi))
+            h_new[outside] = 0.5 * (lo[outside] + hi[outside])
+
+            done = (np.abs(h_new - h) < tol) | (f == 0)
+            iterations[idx] = i
+            head[idx] = np.where(f == 0, h, h_new)
+            converged[idx[done]] = True
+
+            keep = ~done
+            idx, h, lo, hi = idx[keep], h_new[keep], lo[keep], hi[keep]
+
+        # Hastighet och residual vid den nivå som returneras
+        solved = np.flatnonzero(h_org > 0)
+        f_loss, v = loss(head[solved])
+        velocity[solved] = v
+        residual[solved] = np.abs(head[solved] + f_loss - h_org[solved])
+
+    if idx.size:
+        logging.info(f"Förlustberäkningen konvergerade inte för {idx.size} av {n} värden "
+                     f"efter {max_iter} iterationer")
+    return {"head": head, "velocity": velocity, "converged": converged,
+            "iterations": iterations, "residual": residual}
@@ -0,0 +1,179 @@
+import datetime
+import logging
+import time
+import uuid
+from contextlib import nullcontext
+import numpy as np
+import pandas as pd
+from calculations.database_queries import (ensure_schema, get_flow_meta, get_flow_meta_data,
+                                           iter_ts_arrays, store_calc_arrays,
+                                           publish_calculation, delete_data_by_id)
+from calculations.flow_calculations import calculate_flow, calc_parameters, pipe_parameters
+from calculations.jobs import JobCancelled
+
+
+logger = logging.getLogger(__name__)
+logger.propagate = False
+
+# create_calculation skriver under unique_id + staging_suffix + slumpdel tills beräkningen är klar
+staging_suffix = "~staging~"
+
+
+def refresh_calculation(meta, since=None, db_slot=None, rating_table=False, chunk_rows=None,
+                        progress=None):
+    """
+    Bring one calculation up to date with its input signal.
+
+    Only acurve_ts samples newer than the calculation's high-water mark
+    (flow_meta.last_input_time) are fetched, calculated and appended. The
+    input is streamed in time-ordered chunks (iter_ts_arrays), and every
+    chunk is calculated and written in its own transaction together with the
+    new mark, so memory does not grow with the length of the history and a
+    failed refresh continues from the last written chunk next time. Samples
+    that arrive with a timestamp older than the mark are not picked up,
+    recreate the calculation to include them.
+
+    Parameters:
+        meta (dict or pandas.Series): Row of flowcalc_schema.flow_meta.
+        since (datetime): Recalculate from this time instead of the stored
+            mark. None and no stored mark means the full history.
+        db_slot: Lock or semaphore held while talking to the database, to
+            bound the number of concurrent database jobs (see batch_runner).
+        rating_table (bool): Calculate with a cached rating table, see
+            calculate_flow.
+        chunk_rows (int): Input rows per chunk, default TS_CHUNK_ROWS.
+        progress (callable): Called as progress(samples, first_time,
+            last_time) after each written chunk. May raise JobCancelled to
+            stop between chunks.
+
+    Returns:
+        int: Number of samples calculated.
+    """
+    unique_id = str(meta["unique_id"])
+    if since is None:
+        since = meta.get("last_input_time")
+    if since is not None and pd.isna(since):
+        since = None
+    if since is not None:
+        since = pd.Timestamp(since).to_pydatetime()
+
+    db_slot = db_slot or nullcontext()
+    parameters = calc_parameters(meta)
+    start = time.perf_counter()
+    samples = 0
+    try:
+        chunks = iter_ts_arrays("acurve", meta["original_signal_id"], since=since, chunk_rows=chunk_rows)
+        first_time = None
+        while True:
+            with db_slot:
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            times, level = chunk
+            if first_time is None:
+                first_time = times[0]
+
+            Q = calculate_flow(level, meta["calc_type"], parameters, meta["unit"], rating_table=rating_table)
+            with db_slot:
+                store_calc_arrays(times, Q, unique_id, high_water_mark=times[-1])
+            samples += len(times)
+            if progress is not None:
+                progress(samples, first_time, times[-1])
+
+        if samples == 0:
+            logging.info(f"{unique_id}: inga nya värden.")
+        else:
+            logging.info(f"{unique_id}: {samples} nya värden beräknades på "
+                         f"{time.perf_counter() - start:.2f} s.")
+        return samples
+
+    except JobCancelled:
+        raise
+    except Exception as Argument:
+        logging.exception("Exception occured")
+        raise ValueError(f"Error refreshing '{unique_id}': {Argument}") from Argument
+
+
+def create_calculation(unique_id, name, original_signal_id, calc_type, unit, parameters,
+                       replace=False, job=None):
+    """
+    Store a new calculation and calculate its full history, streamed chunk
+    by chunk (see refresh_calculation).
+
+    The series is written under a staging ID and swapped in with its
+    metadata in one transaction when it is complete (publish_calculation).
+    Until then the calculation being replaced is untouched, and a cancelled
+    or failed run only deletes the staged rows.
+
+    Parameters:
+        unique_id, name, original_signal_id, calc_type, unit, parameters:
+            As for store_calc_metadata.
+        replace (bool): Replace an existing calculation with the same ID.
+        job (calculations.jobs.Job): Report progress to this job and stop
+            between chunks if it is cancelled.
+
+    Returns:
+        int: Number of samples calculated.
+    """
+    if not replace and get_flow_meta(unique_id) is not None:
+        raise ValueError(f"Duplicate unique_id '{unique_id}'. Entry already exists in the table.")
+
+    staging_id = f"{unique_id}{staging_suffix}{uuid.uuid4().hex[:8]}"
+    meta = {"unique_id": staging_id, "original_signal_id": original_signal_id,
+            "calc_type": calc_type, "unit": unit, "last_input_time": None}
+    if calc_type == "overfall":
+        meta["ski_height"], meta["ski_width"] = parameters
+    else:
+        meta["slope"], meta["diameter"], meta["roughness"], meta["solve_loss"] = pipe_parameters(parameters)
+
+    written = {"last_time": None}
+
+    def progress(samples, first_time, last_time):
+        written["last_time"] = last_time
+        if job is None:
+            return
+        job.check_cancelled()
+        # Andel av tiden från första värdet till nu
+        span = np.datetime64(datetime.datetime.now(), "ms") - first_time
+        done = (last_time - first_time) / span if span > np.timedelta64(0, "ms") else 1.0
+        job.update(min(float(done), 1.0), f"Beräknar och sparar... ({samples} värden)")
+
+    try:
+        samples = refresh_calculation(meta, progress=progress)
+        if job is not None:
+            # Sista chansen att avbryta, efter bytet finns bara den nya beräkningen
+            job.check_cancelled()
+            job.update(1.0, "Publicerar beräkningen...")
+        last_time = written["last_time"]
+        publish_calculation(staging_id, unique_id, name, original_signal_id, calc_type, unit, parameters,
+                            last_input_time=None if last_time is None else last_time.astype(datetime.datetime),
+                            replace=replace)
+        return samples
+    except Exception:
+        delete_data_by_id(staging_id)
+        raise
+
+
+def refresh_calculations(unique_ids=None):
+    """
+    Incrementally refresh all (or the given) calculations in flow_meta.
+
+    A failing calculation is logged and skipped so it does not stop the rest.
+
+    Returns:
+        dict: unique_id -> number of new samples, or None if it failed.
+    """
+    ensure_schema()
+    meta_df = get_flow_meta_data()
+    if unique_ids is not None:
+        meta_df = meta_df[meta_df["unique_id"].isin([str(i) for i in unique_ids])]
+
+    results = {}
+    for _, meta in meta_df.iterrows():
+        try:
+            results[meta["unique_id"]] = refresh_calculation(meta)
+        except ValueError:
+            results[meta["unique_id"]] = None
+    logging.info(f"{len(results)} beräkningar uppdaterades, "
+                 f"{sum(n or 0 for n in results.values())} nya värden.")
+    return results
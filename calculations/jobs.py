@@ -0,0 +1,198 @@
+import datetime
+import itertools
+import logging
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+logger.propagate = False
+
+# Antal avslutade jobb som sparas per användare
+finished_jobs_kept = 20
+
+
+class JobCancelled(Exception):
+    """Raised inside a job function when the job has been cancelled."""
+
+
+class Job:
+    """
+    A background calculation. The job function receives the Job and reports
+    progress with update() and calls check_cancelled() between steps.
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, user, name, on_update=None):
+        self.id = next(self._ids)
+        self.user = user
+        self.name = name
+        self.status = "queued"
+        self.progress = 0.0
+        self.message = "I kö"
+        self.error = None
+        self.traceback = None
+        self.created = datetime.datetime.now()
+        self.started = None
+        self.finished = None
+        self.on_update = on_update
+        self.manager = None
+        self.future = None
+        self._cancel = threading.Event()
+
+    @property
+    def done(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def update(self, progress=None, message=None):
+        if progress is not None:
+            self.progress = progress
+        if message is not None:
+            self.message = message
+        self._notify()
+
+    def cancel(self):
+        """
+        Request cancellation. A queued job never starts, a running job stops
+        at its next check_cancelled().
+        """
+        self._cancel.set()
+        if self.future is not None and self.future.cancel():
+            self._finish("cancelled", "Avbruten")
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def snapshot(self):
+        return {"id": self.id, "name": self.name, "status": self.status,
+                "progress": self.progress, "message": self.message, "error": self.error,
+                "traceback": self.traceback, "created": self.created, "started": self.started,
+                "finished": self.finished}
+
+    def _finish(self, status, message, error=None, traceback=None):
+        self.status = status
+        self.message = message
+        self.error = error
+        self.traceback = traceback
+        self.finished = datetime.datetime.now()
+        if status == "done":
+            self.progress = 1.0
+        self._notify()
+
+    def _notify(self):
+        if self.on_update is not None:
+            try:
+                self.on_update(self)
+            except Exception:
+                logging.exception("Exception occured")
+        if self.manager is not None:
+            self.manager._job_changed(self)
+
+
+class JobManager:
+    """
+    Runs jobs on a process-wide thread pool, off the Bokeh event loop, and
+    keeps a per-user list of jobs.
+    """
+
+    def __init__(self, max_workers=2):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="calc-job")
+        self._jobs = {}
+        self._watchers = {}
+        self._lock = threading.Lock()
+
+    def _after_fork(self):
+        # Trådarna och jobben tillhör föräldern, barnet börjar med en tom kö
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="calc-job")
+        self._jobs = {}
+        self._watchers = {}
+        self._lock = threading.Lock()
+
+    def watch(self, user, callback):
+        """
+        Call callback(job) whenever one of user's jobs is submitted or
+        changes state, from the thread that changed it. See unwatch.
+        """
+        with self._lock:
+            self._watchers.setdefault(user, []).append(callback)
+
+    def unwatch(self, user, callback):
+        with self._lock:
+            callbacks = self._watchers.get(user, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._watchers.pop(user, None)
+
+    def _job_changed(self, job):
+        with self._lock:
+            callbacks = list(self._watchers.get(job.user, []))
+        for callback in callbacks:
+            try:
+                callback(job)
+            except Exception:
+                logging.exception("Exception occured")
+
+    def submit(self, user, name, func, *args, on_update=None):
+        """
+        Queue func(job, *args).
+
+        Parameters:
+            user (str): Owner of the job.
+            name (str): Shown in the job list.
+            func (callable): Job function, runs on a worker thread and must
+                not touch Bokeh models.
+            on_update (callable): Called with the Job, from the worker
+                thread, whenever its state changes.
+
+        Returns:
+            Job
+        """
+        job = Job(user, name, on_update=on_update)
+        job.manager = self
+        with self._lock:
+            jobs = self._jobs.setdefault(user, [])
+            jobs.append(job)
+            finished = [j for j in jobs if j.done]
+            for old in finished[:max(len(finished) - finished_jobs_kept, 0)]:
+                jobs.remove(old)
+        # Bevakarna får se jobbet i kö innan en arbetstråd kan starta det
+        self._job_changed(job)
+        job.future = self._executor.submit(self._run, job, func, args)
+        return job
+
+    def _run(self, job, func, args):
+        if job._cancel.is_set():
+            job._finish("cancelled", "Avbruten")
+            return
+        job.status = "running"
+        job.started = datetime.datetime.now()
+        job.update(message="Startar...")
+        try:
+            func(job, *args)
+            job._finish("done", "Klar")
+        except JobCancelled:
+            logging.info(f"Jobb {job.id} ({job.name}) avbröts.")
+            job._finish("cancelled", "Avbruten")
+        except Exception as e:
+            logging.exception("Exception occured")
+            job._finish("failed", "Misslyckades", error=str(e), traceback=traceback.format_exc())
+
+    def jobs_for(self, user):
+        with self._lock:
+            return list(self._jobs.get(user, []))
+
+    def cancel(self, user, job_id):
+        for job in self.jobs_for(user):
+            if job.id == job_id:
+                job.cancel()
+                return True
+        return False
+
+
+job_manager = JobManager(max_workers=int(os.getenv("CALC_JOB_WORKERS", "2")))
+os.register_at_fork(after_in_child=job_manager._after_fork)
@@ -0,0 +1,166 @@
+"""
+Rating tables: flow as a tabulated function of level.
+
+For fixed parameters the overfall and pipe flows depend on the level only,
+so a series can be evaluated by linear interpolation in a table Q(h) that
+is built once per parameter set. The table grid is refined where the curve
+bends until the interpolation error, checked at the quarter points of every
+interval, is within atol + rtol * |Q|.
+"""
+import logging
+from functools import lru_cache
+from os import path
+import numpy as np
+import pandas as pd
+from calculations.flow_kernels import overfall_flow, cole_white_flow
+
+
+logger = logging.getLogger(__name__)
+logger.propagate = False
+
+default_rtol = 1e-4
+default_atol = 1e-9  # m3/s
+# Överfallstabellen täcker skibordshöjd till skibordshöjd + 2 m, högre nivåer beräknas direkt
+overfall_table_head = 2.0
+initial_points = 257
+max_table_points = 200_000
+# Kontrollpunkter på 1/4, 1/2 och 3/4 av varje intervall, mitten blir ny knutpunkt
+check_points = np.array([0.25, 0.5, 0.75])
+
+
+def _unit_scale(unit):
+    return 1000 if unit == "l/s" else 1
+
+
+def _tabulate(func, lo, hi, rtol, atol):
+    x = np.linspace(lo, hi, initial_points)
+    y = func(x)
+    check = np.ones(x.size - 1, dtype=bool)
+    while check.any():
+        idx = np.flatnonzero(check)
+        x_check = x[idx, None] + check_points * (x[idx + 1] - x[idx])[:, None]
+        y_check = func(x_check.ravel()).reshape(x_check.shape)
+        y_line = y[idx, None] + check_points * (y[idx + 1] - y[idx])[:, None]
+        bad = (np.abs(y_check - y_line) > atol + rtol * np.abs(y_check)).any(axis=1)
+        mid, y_mid = x_check[:, 1], y_check[:, 1]
+        if not bad.any():
+            break
+        if x.size + bad.sum() > max_table_points:
+            logging.info(f"Avkastningstabellen nådde max {max_table_points} punkter")
+            break
+        split = np.zeros(x.size - 1, dtype=bool)
+        split[idx[bad]] = True
+        x = np.insert(x, idx[bad] + 1, mid[bad])
+        y = np.insert(y, idx[bad] + 1, y_mid[bad])
+        # Bara de nya halvorna behöver kontrolleras i nästa varv
+        check = np.repeat(split, 1 + split)
+    return x, y
+
+
+class RatingTable:
+    """
+    Q(h) for one calculation type and parameter set, see get_rating_table.
+    """
+
+    def __init__(self, calc_type, parameters, unit, levels, flows):
+        self.calc_type = calc_type
+        self.parameters = parameters
+        self.unit = unit
+        self.levels = levels
+        self.flows = flows
+
+    def __len__(self):
+        return self.levels.size
+
+    def evaluate(self, level, out=None):
+        """
+        Flow for every level sample, with the same results as overfall /
+        cole_white_kernel within the table tolerance.
+
+        Parameters:
+            level (array): Level (m).
+            out (numpy.ndarray): Optional float64 output buffer.
+
+        Returns:
+            numpy.ndarray: Q
+        """
+        level = np.asarray(level, dtype=np.float64).ravel()
+        Q = np.empty_like(level) if out is None else out
+        Q[:] = np.interp(level, self.levels, self.flows)
+
+        if self.calc_type == "overfall":
+            # Under skibordet: interp ger vänstra värdet 0. NaN ger 0 som i overfall.
+            Q[np.isnan(level)] = 0.0
+            above = level > self.levels[-1]
+            if above.any():
+                height, width = self.parameters
+                Q[above] = overfall_flow(level[above], height, width, _unit_scale(self.unit))
+        else:
+            # Fullt rör ger konstant flöde, interp håller sista värdet. Tomt rör ger NaN.
+            Q[level <= 0] = np.nan
+        return Q
+
+    def to_frame(self):
+        return pd.DataFrame({"level": self.levels, f"Flöde ({self.unit})": self.flows})
+
+    def export(self, file_path):
+        """
+        Write the table to .csv or .xlsx for inspection.
+        """
+        if path.splitext(file_path)[1].lower() == ".xlsx":
+            self.to_frame().to_excel(file_path, index=False)
+        else:
+            self.to_frame().to_csv(file_path, index=False)
+
+
+@lru_cache(maxsize=64)
+def _build_rating_table(calc_type, parameters, unit, rtol, atol):
+    scale = _unit_scale(unit)
+    if calc_type == "overfall":
+        height, width = parameters
+        if height <= 0:
+            raise ValueError("overfall rating table requires skibordshöjd > 0")
+        levels, flows = _tabulate(lambda h: overfall_flow(h, height, width, scale),
+                                  height, height + overfall_table_head, rtol, atol * scale)
+    elif calc_type == "rorberakning":
+        slope, diameter, roughness, *options = parameters
+        if options and options[0]:
+            # Flödet vid jämviktsnivån tabelleras inte, calculate_flow räknar direkt
+            raise ValueError("rorberakning with solve_loss has no rating table")
+        r = diameter / 2 / 1000
+
+        def pipe(h):
+            Q = cole_white_flow(h, r, roughness / 1000, slope / 1000, scale)[0]
+            Q[h <= 0] = 0.0  # gränsvärdet, kärnan ger 0/0 för tomt rör
+            return Q
+        levels, flows = _tabulate(pipe, 0.0, 2 * r, rtol, atol * scale)
+    else:
+        raise ValueError(f"Unknown calc_type '{calc_type}'")
+
+    if not np.all(np.isfinite(flows)):
+        raise ValueError(f"Parameters {parameters} do not give a finite rating curve")
+    levels.flags.writeable = False
+    flows.flags.writeable = False
+    logging.info(f"Avkastningstabell {calc_type} {parameters} byggd med {levels.size} punkter")
+    return RatingTable(calc_type, parameters, unit, levels, flows)
+
+
+def get_rating_table(calc_type, parameters, unit, rtol=default_rtol, atol=default_atol):
+    """
+    Rating table for a calculation, built on first use and cached per
+    parameter set.
+
+    Parameters:
+        calc_type (str): "overfall" or "rorberakning".
+        parameters (tuple): (ski_height, ski_width) or (slope, diameter,
+            roughness[, solve_loss]), as for calculate_flow. solve_loss=True
+            is not tabulated and raises ValueError.
+        unit (str): Unit. l/s or m3/s
+        rtol (float): Relative interpolation tolerance.
+        atol (float): Absolute interpolation tolerance (m3/s).
+
+    Returns:
+        RatingTable
+    """
+    parameters = tuple(float(p) for p in parameters)
+    return _build_rating_table(calc_type, parameters, unit, float(rtol), float(atol))
@@ -0,0 +1,38 @@
+"""
+Periodic tasks of the Panel server.
+
+Panel refuses to schedule callbacks defined in the served script (its
+bokeh_app_* module), so the tasks live here and app.py only calls
+schedule_tasks().
+"""
+import logging
+import os
+import panel as pn
+from calculations.async_queries import run_query
+from calculations.database_queries import refresh_rollups
+
+
+logger = logging.getLogger(__name__)
+logger.propagate = False
+
+# Hur ofta aggregaten för acurve_ts räknas om, t.ex. "15m" eller "1h"
+rollup_refresh_period = os.getenv("ROLLUP_REFRESH_PERIOD", "15m")
+
+
+async def refresh_rollups_task():
+    # acurve_ts skrivs av andra system, flow_ts-aggregaten fylls bara i för
+    # beräkningar som sparades innan aggregattabellerna fanns. Körs på
+    # frågetrådpoolen, threaded=True kräver att config.nthreads är satt
+    for kind in ("acurve", "flow"):
+        try:
+            await run_query(refresh_rollups, kind)
+        except ValueError:
+            pass  # loggat i refresh_rollups, nästa körning försöker igen
+
+
+def schedule_tasks():
+    """
+    Schedule the periodic tasks, once per process. Calls from later
+    sessions reuse the already scheduled tasks.
+    """
+    pn.state.schedule_task("refresh_rollups", refresh_rollups_task, period=rollup_refresh_period)
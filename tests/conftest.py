@@ -0,0 +1,63 @@
+"""
+Shared fixtures. Tests that take the db fixture run against the database in
+the DB_* environment variables and are skipped when they are not set. They
+write rows with IDs starting with "pytest_" and remove them again, use a
+throwaway database.
+"""
+import io
+import os
+import numpy as np
+import pytest
+
+db_vars = ("DB_ADDR", "DB_DATABASE", "DB_PASSWORD", "DB_PORT", "DB_USER")
+test_prefix = "pytest_"
+
+
+def _drop_test_rows(database_queries):
+    with database_queries.get_connection() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM public.acurve_ts WHERE signal LIKE %s", (test_prefix + "%",))
+        cur.execute("DELETE FROM flowcalc_schema.acurve_rollup WHERE signal LIKE %s", (test_prefix + "%",))
+        cur.execute("DELETE FROM flowcalc_schema.rollup_state WHERE id LIKE %s", (test_prefix + "%",))
+        cur.execute("SELECT unique_id FROM flowcalc_schema.flow_meta WHERE unique_id LIKE %s",
+                    (test_prefix + "%",))
+        unique_ids = [row[0] for row in cur.fetchall()]
+        cur.execute("DELETE FROM flowcalc_schema.flow_ts WHERE unique_id LIKE %s", (test_prefix + "%",))
+        cur.execute("DELETE FROM flowcalc_schema.flow_rollup WHERE unique_id LIKE %s", (test_prefix + "%",))
+        conn.commit()
+    for unique_id in unique_ids:
+        database_queries.delete_data_by_id(unique_id)
+
+
+@pytest.fixture(scope="session")
+def db():
+    """
+    The database_queries module, connected to the test database.
+    """
+    if any(os.getenv(var) is None for var in db_vars):
+        pytest.skip("DB_* environment variables are not set")
+    from calculations import database_queries
+    database_queries.ensure_schema()
+    _drop_test_rows(database_queries)
+    yield database_queries
+    _drop_test_rows(database_queries)
+
+
+@pytest.fixture
+def seed_acurve(db):
+    """
+    Write (times, values) to public.acurve_ts as signal pytest_<name>, returns
+    the signal ID. The rows are removed after the test.
+    """
+    def seed(name, times, values):
+        signal_id = test_prefix + name
+        with db.get_connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM public.acurve_ts WHERE signal = %s", (signal_id,))
+            cur.copy_expert("COPY public.acurve_ts (timestamp, value, signal) FROM STDIN (FORMAT binary)",
+                            io.BytesIO(db._encode_binary_copy(np.asarray(times, dtype="M8[us]"),
+                                                              np.asarray(values, dtype=np.float64),
+                                                              signal_id)))
+            conn.commit()
+        return signal_id
+
+    yield seed
+    _drop_test_rows(db)
@@ -0,0 +1,75 @@
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+
+month = datetime.datetime(2021, 3, 1)
+
+
+@pytest.fixture
+def cache(db):
+    from calculations.caches import MonthWindowCache
+    cache = MonthWindowCache(max_bytes=10 ** 6, current_month_ttl=60, prefetch_workers=1)
+    yield cache
+    cache._prefetcher.shutdown(wait=True)
+
+
+def fake_fetcher(loads, during_load=None):
+    def fetch(selected_id, start_time, end_time, max_points=None):
+        loads.append(selected_id)
+        if during_load is not None:
+            during_load(len(loads))
+        index = pd.DatetimeIndex([start_time], name="time")
+        return pd.DataFrame({selected_id: [float(len(loads))]}, index=index)
+    return fetch
+
+
+def test_get_chunk_is_cached(cache):
+    loads = []
+    cache._fetchers = {"flow": fake_fetcher(loads)}
+    first = cache.get_chunk("flow", "pytest_q", month, 64)
+    second = cache.get_chunk("flow", "pytest_q", month, 64)
+    assert loads == ["pytest_q"]
+    np.testing.assert_array_equal(first[1], second[1])
+
+
+@pytest.mark.parametrize("invalidate", [("flow", "pytest_q"), (None, None)])
+def test_write_during_load_is_not_cached(cache, invalidate):
+    loads = []
+
+    def write_during_first_load(n):
+        # Som när store_calc_ts/delete_data_by_id skriver medan biten läses
+        if n == 1:
+            cache.invalidate(*invalidate)
+
+    cache._fetchers = {"flow": fake_fetcher(loads, write_during_first_load)}
+    assert cache.get_chunk("flow", "pytest_q", month, 64)[1][0] == 1.0
+    assert cache.stats()["chunks"] == 0
+    # Nästa anrop läser om biten och sparar den
+    assert cache.get_chunk("flow", "pytest_q", month, 64)[1][0] == 2.0
+    assert cache.get_chunk("flow", "pytest_q", month, 64)[1][0] == 2.0
+    assert len(loads) == 2
+
+
+def test_write_to_other_series_during_load_is_cached(cache):
+    loads = []
+    cache._fetchers = {"flow": fake_fetcher(loads, lambda n: cache.invalidate("flow", "pytest_other"))}
+    cache.get_chunk("flow", "pytest_q", month, 64)
+    assert cache.stats()["chunks"] == 1
+
+
+def test_signal_catalog_copies_are_independent(db):
+    from calculations import caches
+    first = caches.get_signal_catalog()
+    version = caches.signal_catalog_version()
+    first["pytest_column"] = 1
+    first.drop(columns=["Search"], inplace=True)
+
+    second = caches.get_signal_catalog()
+    assert second is not first
+    assert "pytest_column" not in second and "Search" in second
+    assert caches.signal_catalog_version() == version
+
+    caches.invalidate_signal_catalog()
+    caches.get_signal_catalog()
+    assert caches.signal_catalog_version() == version + 1
@@ -0,0 +1,134 @@
+import datetime
+import re
+import numpy as np
+import pandas as pd
+import pytest
+
+start = datetime.datetime(2021, 3, 1)
+
+
+def minute_series(n, offset=0.0):
+    times = np.datetime64(start, "ms") + np.arange(n) * np.timedelta64(60_000, "ms")
+    values = offset + np.sin(np.arange(n) / 50.0)
+    return times, values
+
+
+@pytest.mark.parametrize("flags, name, params", [
+    ({}, "ts_acurve_one_window", ["selected_id", "start_time", "end_time"]),
+    ({"many": True}, "ts_acurve_many_window", ["selected_id", "start_time", "end_time"]),
+    ({"limit": True}, "ts_acurve_one_window_limit", ["selected_id", "start_time", "end_time", "samples"]),
+    ({"downsample": True}, "ts_acurve_one_window_downsample",
+     ["selected_id", "start_time", "end_time", "buckets"]),
+    ({"many": True, "downsample": True}, "ts_acurve_many_window_downsample",
+     ["selected_id", "start_time", "end_time", "buckets"]),
+    ({"window": False, "arrays": True}, "ts_acurve_one_arrays", ["selected_id"]),
+    ({"window": False, "since": True, "limit": True, "arrays": True}, "ts_acurve_one_limit_arrays_since",
+     ["selected_id", "since", "samples"]),
+])
+def test_build_ts_query_shapes(db, flags, name, params):
+    stmt_name, query, param_names = db.build_ts_query("acurve", **flags)
+    assert stmt_name == name
+    assert param_names == params
+    # Varje parameter har en platshållare och inga andra förekommer
+    assert {int(n) for n in re.findall(r"\$(\d+)", query)} == set(range(1, len(params) + 1))
+    assert ("signal = ANY($1)" in query) == bool(flags.get("many"))
+    assert ("LIMIT" in query) == bool(flags.get("limit"))
+
+
+def test_build_ts_query_flow_table(db):
+    name, query, _ = db.build_ts_query("flow", many=True)
+    assert name == "ts_flow_many_window"
+    assert "flowcalc_schema.flow_ts" in query and "unique_id = ANY($1)" in query
+
+
+@pytest.mark.parametrize("flags", [{"window": False, "downsample": True}, {"since": True}])
+def test_build_ts_query_rejects_invalid_flags(db, flags):
+    with pytest.raises(ValueError):
+        db.build_ts_query("acurve", **flags)
+
+
+def _prepared_names(cur):
+    cur.execute("SELECT name FROM pg_prepared_statements")
+    return {row[0] for row in cur.fetchall()}
+
+
+@pytest.mark.parametrize("prepared", [True, False])
+def test_execute_prepared(db, seed_acurve, monkeypatch, prepared):
+    monkeypatch.setattr(db, "use_prepared_statements", prepared)
+    signal_id = seed_acurve("prep", *minute_series(100))
+    name, query, param_names = db.build_ts_query("acurve")
+    values = [signal_id, start, start + datetime.timedelta(minutes=9)]
+
+    db.dispose_pool()
+    with db.get_connection() as conn, conn.cursor() as cur:
+        for _ in range(2):
+            db.execute_prepared(conn, cur, name, query, values)
+            rows = cur.fetchall()
+            assert len(rows) == 10
+            assert rows[0][1] == start
+        assert (name in _prepared_names(cur)) == prepared
+        assert (name in conn.info.get("prepared_statements", set())) == prepared
+
+
+def test_execute_prepared_after_reconnect(db, seed_acurve, monkeypatch):
+    monkeypatch.setattr(db, "use_prepared_statements", True)
+    signal_id = seed_acurve("reprep", *minute_series(100))
+    name, query, _ = db.build_ts_query("acurve")
+    values = [signal_id, start, start + datetime.timedelta(minutes=9)]
+
+    db.dispose_pool()
+    with db.get_connection() as conn, conn.cursor() as cur:
+        db.execute_prepared(conn, cur, name, query, values)
+        cur.fetchall()
+        cur.execute("SELECT pg_backend_pid()")
+        old_pid = cur.fetchone()[0]
+        # Poolen kopplar upp på nytt, den nya serveranslutningen har inga förberedda satser
+        conn.invalidate()
+
+    with db.get_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT pg_backend_pid()")
+        assert cur.fetchone()[0] != old_pid
+        assert name not in conn.info.get("prepared_statements", set())
+        db.execute_prepared(conn, cur, name, query, values)
+        assert len(cur.fetchall()) == 10
+        assert name in _prepared_names(cur)
+
+
+@pytest.mark.parametrize("prepared", [True, False])
+@pytest.mark.parametrize("max_points", [None, 50])
+def test_get_ts_from_ids_matches_single(db, seed_acurve, monkeypatch, prepared, max_points):
+    monkeypatch.setattr(db, "use_prepared_statements", prepared)
+    monkeypatch.setattr(db, "use_rollups", False)
+    times_a, values_a = minute_series(600)
+    times_b, values_b = minute_series(400, offset=2.0)
+    values_a[17] = np.nan
+    ids = [seed_acurve("multi_a", times_a, values_a), seed_acurve("multi_b", times_b[::3], values_b[::3])]
+    end = start + datetime.timedelta(minutes=500)
+
+    wide = db.get_ts_from_ids(ids, start, end, max_points=max_points)
+    assert list(wide.columns) == ids
+    for signal_id in ids:
+        single = db.get_ts_from_id(signal_id, start, end, max_points=max_points)[signal_id]
+        column = wide[signal_id]
+        column.index = column.index.as_unit("ms")
+        single.index = single.index.as_unit("ms")
+        # Den breda tabellen har alla seriers tider, varje kolumn har sina egna värden på sina tider
+        pd.testing.assert_series_equal(column.reindex(single.index), single, check_names=False)
+        assert column.dropna().index.isin(single.index).all()
+
+
+@pytest.mark.parametrize("chunk_rows", [2, 3, 1000])
+def test_iter_ts_arrays_sub_ms_times(db, seed_acurve, chunk_rows):
+    # Flera rader inom samma ms, också över chunkgränserna
+    offsets_us = np.array([0, 100, 200, 300, 400, 1000, 1500, 2000, 2001, 2999, 60_000_000])
+    times = np.datetime64(start, "us") + offsets_us.astype("m8[us]")
+    values = np.arange(len(times), dtype=np.float64)
+    signal_id = seed_acurve("sub_ms", times, values)
+
+    chunks = list(db.iter_ts_arrays("acurve", signal_id, chunk_rows=chunk_rows))
+    assert all(len(chunk_times) for chunk_times, _ in chunks)
+    np.testing.assert_array_equal(np.concatenate([v for _, v in chunks]), values)
+    np.testing.assert_array_equal(np.concatenate([t for t, _ in chunks]), times.astype("M8[ms]"))
+
+    since_times, since_values = db.fetch_ts_arrays("acurve", signal_id, since=start, unit="us")
+    np.testing.assert_array_equal(since_times, times[1:])
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from calculations.flow_calculations import (solve_head_loss, cole_white_kernel, cole_white_with_loss,
+                                            calculate_flow, calc_parameters, pipe_parameters)
+
+g = 9.82
+pipes = [(3.0, 1000.0, 1.0), (20.0, 300.0, 0.02), (0.5, 2000.0, 0.5)]
+
+
+def head_residual(head, level, slope, diameter, roughness):
+    _, velocity, _ = cole_white_kernel(head, slope, diameter, roughness, "m3/s")
+    return np.abs(head + 1.5 * velocity**2 / (2 * g) - level)
+
+
+@pytest.mark.parametrize("slope, diameter, roughness", pipes)
+def test_solve_head_loss_converges(slope, diameter, roughness):
+    level = np.linspace(0, diameter / 1000, 501)[1:]
+    tol = 1e-6
+    solution = solve_head_loss(level, slope, diameter, roughness, tol=tol)
+
+    assert solution["converged"].all()
+    assert solution["iterations"].max() < 10
+    head = solution["head"]
+    assert ((head >= 0) & (head <= level)).all()
+    # Jämvikten håller vid den returnerade nivån, oberoende beräknat
+    assert head_residual(head, level, slope, diameter, roughness).max() < tol
+    # Diagnostiken gäller den returnerade nivån
+    np.testing.assert_allclose(solution["residual"], head_residual(head, level, slope, diameter, roughness),
+                               rtol=1e-12, atol=1e-15)
+    _, velocity, _ = cole_white_kernel(head, slope, diameter, roughness, "m3/s")
+    np.testing.assert_allclose(solution["velocity"], velocity, rtol=1e-12)
+
+
+def test_solve_head_loss_edge_values():
+    solution = solve_head_loss(np.array([0.0, -1.0, np.nan, 0.5]), *pipes[0])
+    np.testing.assert_array_equal(solution["converged"], [True, True, False, True])
+    np.testing.assert_array_equal(solution["head"][:2], [0.0, -1.0])
+    assert np.isnan(solution["head"][2]) and np.isnan(solution["residual"][2])
+    np.testing.assert_array_equal(solution["iterations"][:3], 0)
+
+
+def test_solve_head_loss_reports_non_convergence():
+    level = np.linspace(0.01, 1.0, 50)
+    solution = solve_head_loss(level, 20.0, 1000.0, 0.02, max_iter=1)
+    assert not solution["converged"].any()
+    assert (solution["iterations"] == 1).all()
+    np.testing.assert_allclose(solution["residual"],
+                               head_residual(solution["head"], level, 20.0, 1000.0, 0.02), rtol=1e-12)
+
+
+def test_pipe_parameters():
+    assert pipe_parameters((3, 1000, 1)) == (3, 1000, 1, False)
+    assert pipe_parameters((3, 1000, 1, True)) == (3, 1000, 1, True)
+    meta = {"calc_type": "rorberakning", "slope": 3, "diameter": 1000, "roughness": 1}
+    assert calc_parameters(meta) == (3.0, 1000.0, 1.0, False)
+    assert calc_parameters({**meta, "solve_loss": True})[3] is True
+    assert calc_parameters({**meta, "solve_loss": np.nan})[3] is False
+
+
+@pytest.mark.parametrize("rating_table", [False, True])
+def test_calculate_flow_with_solve_loss(rating_table):
+    level = np.linspace(0.05, 0.9, 20)
+    solved = cole_white_with_loss(level, *pipes[0], "l/s", dataframe=False, solve_loss=True)
+    measured = cole_white_with_loss(level, *pipes[0], "l/s", dataframe=False)
+    expected, _, _ = cole_white_kernel(solve_head_loss(level, *pipes[0])["head"], *pipes[0], "l/s")
+    np.testing.assert_allclose(solved, expected)
+    assert (solved < measured).all()
+
+    # Utan rating table för solve_loss räknar calculate_flow med modellen
+    np.testing.assert_array_equal(
+        calculate_flow(level, "rorberakning", (*pipes[0], True), "l/s", rating_table=rating_table), solved)
+    np.testing.assert_array_equal(calculate_flow(level, "rorberakning", (*pipes[0], False), "l/s"), measured)
@@ -0,0 +1,66 @@
+"""
+Parity of the kernels in calculations.flow_kernels with the original array
+implementations: the overfall formula as it was before flow_kernels
+(reference_overfall) and cole_white_new, which is unchanged, see
+benchmarks/flow_references.py. The loop kernel runs as plain Python on a
+small sample when numba is missing.
+"""
+import numpy as np
+import pytest
+from benchmarks.flow_references import reference_overfall, reference_pipe, synthetic_level
+from calculations import flow_kernels
+
+overfall_cases = [(0.5, 1.0), (0.3, 0.3), (1.2, 2.5), (0.0, 1.0)]
+pipe_cases = [(3, 330, 1), (0.5, 1000, 0.1), (20, 150, 2), (50, 100, 0.01)]
+units = [("l/s", 1000), ("m3/s", 1)]
+
+
+def sample_size(use_compiled):
+    # Utan numba är loopen vanlig Python, ett mindre urval räcker
+    return 10_000 if flow_kernels.compiled or not use_compiled else 2_000
+
+
+@pytest.mark.parametrize("use_compiled", [False, True])
+@pytest.mark.parametrize("height, width", overfall_cases)
+@pytest.mark.parametrize("unit, scale", units)
+def test_overfall_flow_parity(use_compiled, height, width, unit, scale):
+    level = synthetic_level(sample_size(use_compiled), height + 1.0)
+    expected = reference_overfall(level, height, width, unit)
+    actual = flow_kernels.overfall_flow(level, height, width, scale, use_compiled=use_compiled)
+    np.testing.assert_allclose(actual, expected, rtol=1e-12, equal_nan=True)
+
+
+@pytest.mark.parametrize("use_compiled", [False, True])
+@pytest.mark.parametrize("slope, diameter, roughness", pipe_cases)
+@pytest.mark.parametrize("unit, scale", units)
+def test_cole_white_flow_parity(use_compiled, slope, diameter, roughness, unit, scale):
+    level = synthetic_level(sample_size(use_compiled), diameter / 1000)
+    expected = reference_pipe(level, slope, diameter, roughness, unit)
+    actual = flow_kernels.cole_white_flow(level, diameter / 2000, roughness / 1000, slope / 1000,
+                                          scale, use_compiled=use_compiled)
+    for a, e in zip(actual, expected):
+        np.testing.assert_allclose(a, e, rtol=1e-10, atol=1e-15, equal_nan=True)
+
+
+@pytest.mark.parametrize("use_compiled", [False, True])
+def test_kernels_write_into_out_buffers(use_compiled):
+    level = synthetic_level(1_000, 0.5)
+    out = np.empty(level.size), np.empty(level.size), np.empty(level.size)
+    Q = flow_kernels.overfall_flow(level, 0.3, 1.0, out=out[0], use_compiled=use_compiled)
+    assert Q is out[0]
+    result = flow_kernels.cole_white_flow(level, 0.25, 0.001, 0.003, out=out, use_compiled=use_compiled)
+    assert all(a is b for a, b in zip(result, out))
+    with pytest.raises(ValueError):
+        flow_kernels.overfall_flow(level, 0.3, 1.0, out=np.empty(10))
+
+
+def test_default_kernel_is_numpy_without_numba(monkeypatch):
+    # Utan numba är loopen många gånger långsammare än NumPy och får inte vara standard
+    def fail(*args):
+        raise AssertionError("loop kernel used by default")
+    monkeypatch.setattr(flow_kernels, "compiled", False)
+    monkeypatch.setattr(flow_kernels, "_overfall_loop", fail)
+    monkeypatch.setattr(flow_kernels, "_cole_white_loop", fail)
+    level = synthetic_level(100, 0.5)
+    flow_kernels.overfall_flow(level, 0.3, 1.0)
+    flow_kernels.cole_white_flow(level, 0.25, 0.001, 0.003)
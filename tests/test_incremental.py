@@ -0,0 +1,120 @@
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+from calculations.jobs import Job, JobCancelled
+
+start = datetime.datetime(2021, 3, 1)
+n_samples = 500
+
+
+@pytest.fixture
+def incremental(db, monkeypatch):
+    from calculations import incremental
+    # Många små bitar, så att avbrott och fel kommer mitt i skrivningen
+    monkeypatch.setattr(db, "ts_chunk_rows", 100)
+    return incremental
+
+
+@pytest.fixture
+def level_signal(seed_acurve):
+    times = np.datetime64(start, "us") + np.arange(n_samples) * np.timedelta64(60, "s")
+    return seed_acurve("level", times, 0.5 + 0.2 * np.sin(np.arange(n_samples) / 30.0))
+
+
+def create(incremental, signal_id, ski_height, **kwargs):
+    return incremental.create_calculation("pytest_calc", "Test", signal_id, "overfall", "l/s",
+                                          (ski_height, 1.0), **kwargs)
+
+
+def stored(db):
+    meta = db.get_flow_meta("pytest_calc")
+    times, values = db.fetch_ts_arrays("flow", "pytest_calc", all_data=True)
+    return meta, times, values
+
+
+def staged_rows(db):
+    with db.get_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM flowcalc_schema.flow_ts WHERE unique_id LIKE %s",
+                    ("pytest_calc~%",))
+        return cur.fetchone()[0]
+
+
+def assert_unchanged(db, before):
+    meta, times, values = stored(db)
+    assert meta == before[0]
+    np.testing.assert_array_equal(times, before[1])
+    np.testing.assert_array_equal(values, before[2])
+    assert staged_rows(db) == 0
+
+
+def test_create_calculation(db, incremental, level_signal):
+    assert create(incremental, level_signal, 0.3) == n_samples
+    meta, times, values = stored(db)
+    assert meta["ski_height"] == 0.3
+    assert len(times) == n_samples
+    assert pd.Timestamp(meta["last_input_time"]) == pd.Timestamp(start) + pd.Timedelta(minutes=n_samples - 1)
+    assert staged_rows(db) == 0
+
+    with pytest.raises(ValueError, match="Duplicate"):
+        create(incremental, level_signal, 0.4)
+    assert db.get_flow_meta("pytest_calc")["ski_height"] == 0.3
+
+
+def test_replace_calculation(db, incremental, level_signal):
+    create(incremental, level_signal, 0.3)
+    _, _, old_values = stored(db)
+
+    create(incremental, level_signal, 0.4, replace=True)
+    meta, times, values = stored(db)
+    assert meta["ski_height"] == 0.4
+    assert len(times) == n_samples and not np.array_equal(values, old_values)
+    assert staged_rows(db) == 0
+
+
+def test_cancelled_replace_keeps_original(db, incremental, level_signal):
+    create(incremental, level_signal, 0.3)
+    before = stored(db)
+
+    def cancel_after_first_chunk(job):
+        if "värden" in job.message:
+            job.cancel()
+
+    with pytest.raises(JobCancelled):
+        create(incremental, level_signal, 0.4, replace=True,
+               job=Job("pytest", "pytest_calc", on_update=cancel_after_first_chunk))
+    assert_unchanged(db, before)
+
+
+def test_failed_replace_keeps_original(db, incremental, level_signal, monkeypatch):
+    create(incremental, level_signal, 0.3)
+    before = stored(db)
+
+    calculate_flow = incremental.calculate_flow
+    calls = []
+
+    def fail_on_third_chunk(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 3:
+            raise RuntimeError("beräkningen misslyckades")
+        return calculate_flow(*args, **kwargs)
+
+    monkeypatch.setattr(incremental, "calculate_flow", fail_on_third_chunk)
+    with pytest.raises(ValueError, match="misslyckades"):
+        create(incremental, level_signal, 0.4, replace=True)
+    assert_unchanged(db, before)
+
+
+def test_solve_loss_is_stored_and_reproduced(db, incremental, level_signal):
+    from calculations.flow_calculations import calculate_flow, calc_parameters
+    parameters = (3.0, 1000.0, 1.0, True)
+    incremental.create_calculation("pytest_calc", "Test", level_signal, "rorberakning", "l/s", parameters)
+    meta, times, values = stored(db)
+    assert meta["solve_loss"] is True
+    assert calc_parameters(meta) == parameters
+
+    level = db.fetch_ts_arrays("acurve", level_signal, all_data=True)[1]
+    np.testing.assert_allclose(values, calculate_flow(level, "rorberakning", parameters, "l/s"))
+    # Omräkning från lagrad metadata ger samma serie
+    assert incremental.refresh_calculation(meta, since=start) == n_samples - 1
+    np.testing.assert_array_equal(stored(db)[2], values)
@@ -0,0 +1,61 @@
+import threading
+import pytest
+from calculations.jobs import JobManager
+
+
+@pytest.fixture
+def manager():
+    manager = JobManager(max_workers=1)
+    yield manager
+    manager._executor.shutdown(wait=True)
+
+
+def test_failed_job_keeps_traceback(manager):
+    def fail(job):
+        raise RuntimeError("trasig indata")
+
+    job = manager.submit("pytest", "fail", fail)
+    job.future.result()
+    state = job.snapshot()
+    assert state["status"] == "failed" and state["error"] == "trasig indata"
+    assert "Traceback" in state["traceback"] and "RuntimeError: trasig indata" in state["traceback"]
+
+
+def test_watchers_follow_the_users_jobs(manager):
+    seen, other = [], []
+    manager.watch("pytest", lambda job: seen.append(job.status))
+    manager.watch("someone else", other.append)
+    release = threading.Event()
+
+    job = manager.submit("pytest", "wait", lambda job: release.wait(5))
+    release.set()
+    job.future.result()
+    # Inlagt, startat och klart
+    assert seen[0] == "queued" and "running" in seen and seen[-1] == "done"
+    assert other == []
+
+
+def test_unwatch(manager):
+    seen = []
+    manager.watch("pytest", seen.append)
+    manager.unwatch("pytest", seen.append)
+    manager.submit("pytest", "noop", lambda job: None).future.result()
+    assert seen == [] and manager._watchers == {}
+
+
+def test_job_queue_widget_is_pushed(db, manager, monkeypatch):
+    # Widgetmodulen importerar calculations.incremental och därmed databasmodulen
+    from widgets import job_queue_widget
+    monkeypatch.setattr(job_queue_widget, "job_manager", manager)
+    widget = job_queue_widget.JobQueueWidget()
+    assert not widget.layout.visible
+
+    job = manager.submit(widget.user, "pushed", lambda job: job.update(0.5, "Halvvägs"))
+    job.future.result()
+    # Utan serversession körs uppdateringen direkt på jobbets tråd
+    assert widget.layout.visible
+    assert widget.table.value.loc[0, "name"] == "pushed"
+    assert widget.table.value.loc[0, "status"] == "Klar"
+
+    widget.close()
+    assert manager._watchers == {}
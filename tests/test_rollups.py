@@ -0,0 +1,54 @@
+import datetime
+import io
+import numpy as np
+import pandas as pd
+
+start = datetime.datetime(2021, 3, 1)
+rolled_minutes = 12 * 1440 + 11  # slutar på en 10-minuters tid mitt i en timme
+tail_minutes = 2 * 1440
+
+
+def append_acurve(db, signal_id, times, values):
+    # Rader efter rolled_up_to, aggregaten uppdateras inte
+    with db.get_connection() as conn, conn.cursor() as cur:
+        cur.copy_expert("COPY public.acurve_ts (timestamp, value, signal) FROM STDIN (FORMAT binary)",
+                        io.BytesIO(db._encode_binary_copy(np.asarray(times, dtype="M8[us]"),
+                                                          np.asarray(values, dtype=np.float64),
+                                                          signal_id)))
+        conn.commit()
+
+
+def seed_rolled_up_with_tail(db, seed_acurve):
+    minutes = np.arange(rolled_minutes + tail_minutes)
+    times = np.datetime64(start, "us") + minutes * np.timedelta64(60, "s")
+    values = np.sin(minutes / 50.0)
+    values[40] = -100.0  # i timmen som fönstret börjar mitt i
+    values[rolled_minutes:] += 50.0
+    signal_id = seed_acurve("rollup_tail", times[:rolled_minutes], values[:rolled_minutes])
+    db.refresh_rollups("acurve", [signal_id])
+    append_acurve(db, signal_id, times[rolled_minutes:], values[rolled_minutes:])
+    covered = pd.Timestamp(times[rolled_minutes - 1])
+    return signal_id, covered, pd.Timestamp(times[-1])
+
+
+def test_rollup_window_with_raw_tail(db, seed_acurve, monkeypatch):
+    monkeypatch.setattr(db, "use_rollups", True)
+    signal_id, covered, end = seed_rolled_up_with_tail(db, seed_acurve)
+    window_start = start + datetime.timedelta(minutes=30)
+    assert db.rollup_resolution(window_start, end, 400) == "hour"
+
+    # Utan nedsampling syns ordningen mellan aggregat och rådata direkt
+    df = db._query_rollup("acurve", signal_id, window_start, end.to_pydatetime(), 10 ** 6, "hour")
+    times = pd.DatetimeIndex(df["timestamp"])
+    # Strikt stigande tider inom fönstret, även där aggregat och rådata möts
+    assert times.is_monotonic_increasing and times.is_unique
+    assert times[0] >= pd.Timestamp(window_start) and times[-1] == end
+    # Den påbörjade första timmen är med
+    assert df["value"].min() == -100.0
+    # Rådatasvansen efter rolled_up_to är med, rad för rad
+    assert (times > covered).sum() == tail_minutes
+    assert df["value"].max() > 50.0
+
+    wide = db.get_ts_from_id(signal_id, window_start, end.to_pydatetime(), max_points=400)
+    assert wide.index.is_monotonic_increasing
+    assert wide[signal_id].min() == -100.0
@@ -6,6 +6,7 @@ import param
 from bokeh.models import RadioButtonGroup
 from widgets.overfall_subwidget import OverfallSubWidget
 from widgets.pipeflow_subwidget import PipeflowSubWidget
+from calculations.flow_calculations import pipe_parameters
 #from calculations.flow_calculations import cole_white_flow_calc, overfall
 #from calculations.database_queries import update_data, get_ts_from_id, store_calc_metadata, store_calc_ts, dataframe_to_input_data, delete_data_by_id
 #import pandas as pd
@@ -87,7 +88,7 @@ class EditCalculationWidget(param.Parameterized):
         if calc_type == "overfall":
             self.ski_width, self.ski_height = parameters
         if calc_type == "rorberakning":
-            self.slope, self.diameter, self.roughness = parameters
+            self.slope, self.diameter, self.roughness, self.solve_loss = pipe_parameters(parameters)
 
         self.init_ui()
 
@@ -147,5 +148,6 @@ class EditCalculationWidget(param.Parameterized):
                     slope=self.slope,
                     diameter=self.diameter,
                     roughness=self.roughness,
+                    solve_loss=self.solve_loss,
                     edit_mode=True
                 ).layout)
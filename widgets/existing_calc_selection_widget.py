@@ -1,13 +1,14 @@
 import logging
 import logging.config
 from os import path
-import datetime
-from dateutil.relativedelta import relativedelta
 from bokeh.plotting import figure
-from bokeh.models import DatetimeTickFormatter
 import panel as pn
 import param
-from calculations.database_queries import get_flow_meta_data, get_flow_ts_from_id #update_data
+import pandas as pd
+from calculations.async_queries import query_flow_meta, get_flow_meta
+from calculations.database_queries import get_flow_meta_values, flow_meta_list_columns #update_data
+from widgets.job_queue_widget import run_in_session
+from widgets.time_series_viewer import TimeSeriesViewer, max_compare
 #import pandas as pd
 #import numpy as np
 #from bokeh.layouts import layout, column, row
@@ -18,6 +19,8 @@ from calculations.database_queries import get_flow_meta_data, get_flow_ts_from_i
 logger = logging.getLogger(__name__)
 logger.propagate = False
 
+page_size = 50
+
 
 class ExistingCalcSelectionWidget(param.Parameterized):
     df = param.DataFrame()
@@ -27,61 +30,98 @@ class ExistingCalcSelectionWidget(param.Parameterized):
     
     def __init__(self, open_modal_callback=None, **params):
         super().__init__(**params)
-        self.df = get_flow_meta_data()
+        self.page = 1
+        self.total = 0
         self.open_modal_callback = open_modal_callback
         self.init_ui()
+        run_in_session(self.load_page)
+
+    def filters_changed(self, *events):
+        self.page = 1
+        run_in_session(self.load_page)
+
+    async def load_page(self):
+        # Filter, sortering och sidindelning görs i databasen, tabellen får bara en sida
+        self.df, self.total = await query_flow_meta(self.df_widget.filters, self.df_widget.sorters,
+                                                    self.page, page_size)
+        self.df_widget.value = self.df
+        self.df_widget.selection = []
+        pages = max((self.total + page_size - 1) // page_size, 1)
+        self.page_text.value = f"Sida {self.page} av {pages} ({self.total} beräkningar)"
+
+    def refresh(self):
+        """
+        Reload the current page when the view is shown again, so calculations
+        saved or deleted meanwhile appear without rebuilding the widget.
+        """
+        run_in_session(self.load_page)
+
+    def load_prev_page(self, event):
+        if self.page > 1:
+            self.page -= 1
+            run_in_session(self.load_page)
+
+    def load_next_page(self, event):
+        if self.page * page_size < self.total:
+            self.page += 1
+            run_in_session(self.load_page)
 
     def update_plot(self):
-        self.plot.renderers.clear()
-        self.plot.yaxis.axis_label = f"{self.df.loc[self.idx, 'unit']}"
-        self.plot.title.text = f"{self.selected_data_id}, {self.df.loc[self.idx, 'name']}"
-        self.plot.line(x=self.selected_data.index, y=self.selected_data, line_width=2)
-        self.plot.xaxis.formatter = DatetimeTickFormatter(days="%Y-%m-%d")
-
-    def load_ts_prev_month(self, event):
-        new_start_time = self.start_time - relativedelta(months=1)
-        if new_start_time <= datetime.datetime.now():
-            self.start_time = new_start_time
-            self.end_time = self.start_time + relativedelta(months=1) - datetime.timedelta(days=1)
-            self.selected_data = get_flow_ts_from_id(self.selected_data_id, self.start_time, self.end_time)
-            self.date_text.value = f"{self.start_time.strftime('%Y-%m-%d')} - {self.end_time.strftime('%Y-%m-%d')}"
-            self.update_plot()
-
-    def load_ts_next_month(self, event):
-        new_start_time = self.start_time + relativedelta(months=1)
-        if new_start_time <= datetime.datetime.now():
-            self.start_time = new_start_time
-            self.end_time = self.start_time + relativedelta(months=1) - datetime.timedelta(days=1)
-            self.selected_data = get_flow_ts_from_id(self.selected_data_id, self.start_time, self.end_time)
-            self.date_text.value = f"{self.start_time.strftime('%Y-%m-%d')} - {self.end_time.strftime('%Y-%m-%d')}"
-            self.update_plot()
+        self.plot.yaxis.axis_label = f"{self.meta['unit']}"
+        self.plot.title.text = f"{self.selected_data_id}, {self.meta['name']}"
+
+    def window_loaded(self, start_time, end_time):
+        self.start_time, self.end_time = start_time, end_time
+        self.selected_data = self.viewer.data
+        self.date_text.value = f"{start_time.strftime('%Y-%m-%d')} - {end_time.strftime('%Y-%m-%d')}"
+
+    def load_ts_prev_window(self, event):
+        run_in_session(self.viewer.pan, -1)
+
+    def load_ts_next_window(self, event):
+        run_in_session(self.viewer.pan, 1)
+
+    def compare_handler(self, event):
+        run_in_session(self.compare_calculations)
+
+    async def compare_calculations(self):
+        # Markerade rader på sidan, t.ex. efter filtrering på insignal
+        unique_ids = self.df.iloc[self.df_widget.selection]["unique_id"].astype(str).tolist()
+        if not unique_ids:
+            return
+        if len(unique_ids) > max_compare:
+            logging.info(f"Bara de {max_compare} första av {len(unique_ids)} markerade beräkningarna jämförs.")
+        self.plot.yaxis.axis_label = ", ".join(sorted(set(self.df.iloc[self.df_widget.selection]["unit"])))
+        self.plot.title.text = f"Jämförelse av {min(len(unique_ids), max_compare)} beräkningar"
+        await self.viewer.compare(unique_ids)
 
     def selection_handler(self, event):
+        run_in_session(self.select_calculation, event)
+
+    async def select_calculation(self, event):
         self.idx = event.row
         idx = event.row
-        self.selected_data_id = str(self.df.loc[idx, "unique_id"])
-        self.selected_data_name = self.df.loc[idx, 'name']
-        self.calc_type = self.df.loc[idx, 'calc_type']
-        self.original_signal_id = str(self.df.loc[idx, "original_signal_id"])
+        # Listan har bara visningskolumnerna, parametrarna hämtas för vald rad
+        self.meta = await get_flow_meta(self.df.loc[idx, "unique_id"])
+        if self.meta is None:
+            await self.load_page()
+            return
+        self.selected_data_id = str(self.meta["unique_id"])
+        self.selected_data_name = self.meta['name']
+        self.calc_type = self.meta['calc_type']
+        self.original_signal_id = str(self.meta["original_signal_id"])
 
         # not shown
-        self.diameter = self.df.loc[idx, 'diameter']
-        self.roughness = self.df.loc[idx, 'roughness']
-        self.slope = self.df.loc[idx, 'slope']
-        self.ski_width = self.df.loc[idx, 'ski_width']
-        self.ski_height = self.df.loc[idx, "ski_height"]
-        self.unit = self.df.loc[idx, 'unit']
-
-        now = datetime.datetime.now()
-        self.start_time = (now - relativedelta(months=1))
-        self.end_time = now
-        self.selected_data = get_flow_ts_from_id(self.selected_data_id, self.start_time, self.end_time)
-
-        self.plot.renderers.clear()
-        self.plot.line(x=self.selected_data.index, y=self.selected_data, line_width=2)
-        self.plot.title.text = f"{self.selected_data_id}, {self.df.loc[idx, 'name']}"
-        self.plot.yaxis.axis_label = f"{self.df.loc[idx, 'unit']}"
-        self.plot.xaxis.formatter = DatetimeTickFormatter(days="%Y-%m-%d")
+        self.diameter = self.meta['diameter']
+        self.roughness = self.meta['roughness']
+        self.slope = self.meta['slope']
+        self.solve_loss = bool(self.meta.get('solve_loss'))
+        self.ski_width = self.meta['ski_width']
+        self.ski_height = self.meta["ski_height"]
+        self.unit = self.meta['unit']
+
+        self.update_plot()
+        await self.viewer.show(self.selected_data_id)
 
         column = event.column
         if column == 'Edit':
@@ -108,18 +148,19 @@ class ExistingCalcSelectionWidget(param.Parameterized):
                                              "rorberakning",
                                              self.unit,
                                              self.original_signal_id,
-                                             (self.slope, self.diameter, self.roughness)))
+                                             (self.slope, self.diameter, self.roughness, self.solve_loss)))
 
     def init_ui(self):
         empty_plot = figure(title="",
                             min_width=200, height=300, 
-                            sizing_mode="scale_width",)
+                            sizing_mode="scale_width", x_axis_type="datetime")
         self.plot = empty_plot
+        self.viewer = TimeSeriesViewer("flow", self.plot, on_update=self.window_loaded)
 
         backward = pn.widgets.Button(name='\u25c0', width=50)
         forward = pn.widgets.Button(name='\u25b6', width=50)
-        backward.on_click(self.load_ts_prev_month)
-        forward.on_click(self.load_ts_next_month)
+        backward.on_click(self.load_ts_prev_window)
+        forward.on_click(self.load_ts_next_window)
         self.date_text = pn.widgets.StaticText(value='-')
 
         header_filters = {
@@ -127,21 +168,22 @@ class ExistingCalcSelectionWidget(param.Parameterized):
             'name': {'type': 'input', 'func': 'like', 'placeholder': ''},
             'original_signal_id': {'type': 'input', 'func': 'like',
                                    'placeholder': ''},
-            'calc_type': {'type': 'list', 'func': 'in', 'valuesLookup': True,
+            # Värdena hämtas från hela tabellen, inte bara sidan som visas
+            'calc_type': {'type': 'list', 'func': 'in', 'values': get_flow_meta_values('calc_type'),
                           'sort': 'asc', 'multiselect': True},
-            'unit': {'type': 'list', 'func': 'in', 'valuesLookup': True,
+            'unit': {'type': 'list', 'func': 'in', 'values': get_flow_meta_values('unit'),
                      'sort': 'asc', 'multiselect': True}
         }
 
         df_widget = pn.widgets.Tabulator(
-            self.df[['unique_id', 'name', "original_signal_id",
-                     'calc_type', "unit"]],
+            pd.DataFrame(columns=flow_meta_list_columns),
             show_index=False,
             min_width=200,
             height=600,
             sizing_mode="scale_width",
             buttons={'Edit': "<b style='color:Green !important;'>Redigera</b>"},
             disabled=True,  # Make cells non-editable
+            selectable='checkbox',  # Markerade rader jämförs i samma plot
             header_filters=header_filters,
             titles={'unique_id': 'ID',
                     'name': 'Namn',
@@ -150,8 +192,19 @@ class ExistingCalcSelectionWidget(param.Parameterized):
                     'unit': 'Enhet'}
         )
         df_widget.on_click(self.selection_handler)
+        df_widget.param.watch(self.filters_changed, ['filters', 'sorters'])
+        self.df_widget = df_widget
+
+        prev_page = pn.widgets.Button(name='\u25c0', width=50)
+        next_page = pn.widgets.Button(name='\u25b6', width=50)
+        prev_page.on_click(self.load_prev_page)
+        next_page.on_click(self.load_next_page)
+        self.page_text = pn.widgets.StaticText(value='-')
+        compare_button = pn.widgets.Button(name='Jämför markerade', width=150)
+        compare_button.on_click(self.compare_handler)
 
         self.layout = pn.Row(
-            df_widget,
+            pn.Column(df_widget, pn.Row(prev_page, self.page_text, next_page, compare_button),
+                      sizing_mode="scale_width"),
             pn.Column(self.plot, pn.Row(backward, self.date_text, forward))
         )
\ No newline at end of file
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+from functools import partial
+import pandas as pd
+import panel as pn
+import param
+from calculations.incremental import create_calculation
+from calculations.jobs import job_manager
+
+
+logger = logging.getLogger(__name__)
+logger.propagate = False
+
+status_labels = {"queued": "I kö", "running": "Pågår", "done": "Klar",
+                 "failed": "Misslyckades", "cancelled": "Avbruten"}
+
+
+def session_user():
+    # Inloggad användare (basic auth), alla oinloggade delar kö
+    return pn.state.user or "anonym"
+
+
+def on_session_thread(func):
+    """
+    Wrap func so that calls from a worker thread run on the event loop of
+    the session that created the wrapper, where Bokeh models may be changed.
+    """
+    doc = pn.state.curdoc
+
+    def wrapper(*args):
+        if doc is None or doc.session_context is None:
+            func(*args)
+        else:
+            doc.add_next_tick_callback(partial(func, *args))
+    return wrapper
+
+
+def run_in_session(func, *args):
+    """
+    Run the coroutine function func(*args) as a next tick callback of the
+    current session. Bokeh holds the session's document lock until it
+    returns, so it may change Bokeh models after every await, while the
+    event loop serves other sessions during the awaits. Without a server
+    session (scripts, tests) it runs to completion before returning.
+    """
+    doc = pn.state.curdoc
+
+    async def callback():
+        try:
+            await func(*args)
+        except Exception:
+            logging.exception("Exception occured")
+
+    if doc is not None and doc.session_context is not None:
+        doc.add_next_tick_callback(callback)
+        return
+    try:
+        asyncio.get_running_loop().create_task(callback())
+    except RuntimeError:
+        asyncio.run(callback())
+
+
+class CalculationJobMixin:
+    """
+    Saving a calculation as a background job, shared by OverfallSubWidget
+    and PipeflowSubWidget. The widget sets calc_type and error_text and has
+    load_display, confirm_button, cancel_button and status_text.
+    """
+    calc_type = None
+    error_text = "Ett fel uppstod."
+
+    def submit_calculation(self, calc):
+        """
+        Run create_calculation for the validated form values calc (unique_id,
+        name, input_id, unit, parameters, edit_mode) as a background job, so
+        that the session is not locked.
+        """
+        self.load_display('on')
+        self.confirm_button.disabled = True
+        self.cancel_button.visible = True
+        update_ui = on_session_thread(self.job_update)
+        self.job = job_manager.submit(session_user(), calc["unique_id"], self.calculation_job, calc,
+                                      on_update=lambda job: update_ui(job.snapshot()))
+
+    def calculation_job(self, job, calc):
+        # Körs på en arbetstråd, får inte röra Bokeh-modellerna
+        # Indata läses, beräknas och sparas i bitar, så minnet växer inte med historikens längd
+        job.update(0.0, "Beräknar och sparar...")
+        # Om Id inte har blivit ändrat i fältet ersätts den gamla beräkningen när den nya är klar
+        # Om Id ändras tas inte den gamla beräkningen bort
+        create_calculation(
+            calc["unique_id"],
+            calc["name"],
+            calc["input_id"],
+            self.calc_type,
+            calc["unit"],
+            calc["parameters"],
+            replace=calc["edit_mode"],
+            job=job,
+        )
+
+    def job_update(self, state):
+        if state["status"] in ("queued", "running"):
+            self.status_text.text = f"<b style='color:black;'>{state['message']} ({state['progress']:.0%})</b>"
+            return
+
+        if state["status"] == "done":
+            self.status_text.text = "<b style='color:green;'>Insättning lyckades</b>"
+        elif state["status"] == "cancelled":
+            self.status_text.text = "<b style='color:black;'>Beräkningen avbröts</b>"
+        else:
+            logger.error(f"Beräkningsjobb {state['id']} ({state['name']}) misslyckades: "
+                         f"{state['error']}\n{state['traceback']}")
+            self.status_text.text = f"<b style='color:red;'>{self.error_text}</b>"
+        self.load_display('off')
+        self.confirm_button.disabled = False
+        self.cancel_button.visible = False
+
+    def cancel_button_callback(self, values):
+        if self.job is not None and not self.job.done:
+            self.status_text.text = "<b style='color:black;'>Avbryter...</b>"
+            self.job.cancel()
+
+
+class JobQueueWidget(param.Parameterized):
+    """
+    The current user's background calculations, with cancel buttons.
+
+    The table is refreshed when job_manager reports a change to one of the
+    user's jobs, there is no polling. Changes that arrive while a refresh
+    is already queued for the session are covered by that refresh.
+    """
+
+    def __init__(self, **params):
+        super().__init__(**params)
+        self.user = session_user()
+        self.init_ui()
+        self.refresh()
+        self._refresh_queued = False
+        self._refresh_on_session = on_session_thread(self._queued_refresh)
+        job_manager.watch(self.user, self._job_changed)
+        if pn.state.curdoc is not None and pn.state.curdoc.session_context is not None:
+            pn.state.on_session_destroyed(lambda session_context: self.close())
+
+    def close(self):
+        """
+        Stop following the user's jobs.
+        """
+        job_manager.unwatch(self.user, self._job_changed)
+
+    def _job_changed(self, job):
+        # Anropas från jobbets tråd, högst en uppdatering i taget köas till sessionen
+        if not self._refresh_queued:
+            self._refresh_queued = True
+            self._refresh_on_session()
+
+    def _queued_refresh(self):
+        self._refresh_queued = False
+        self.refresh()
+
+    def refresh(self):
+        jobs = sorted(job_manager.jobs_for(self.user), key=lambda job: job.id, reverse=True)
+        rows = [{"id": job.id,
+                 "name": job.name,
+                 "status": status_labels[job.status],
+                 "progress": round(job.progress * 100),
+                 "message": job.error or job.message} for job in jobs]
+        df = pd.DataFrame(rows, columns=["id", "name", "status", "progress", "message"])
+        if not df.equals(self.table.value):
+            self.table.value = df
+        self.layout.visible = bool(rows)
+
+    def cancel_handler(self, event):
+        if event.column == "cancel":
+            job_id = int(self.table.value.loc[event.row, "id"])
+            job_manager.cancel(self.user, job_id)
+            self.refresh()
+
+    def init_ui(self):
+        self.table = pn.widgets.Tabulator(
+            pd.DataFrame(columns=["id", "name", "status", "progress", "message"]),
+            show_index=False,
+            disabled=True,
+            hidden_columns=["id"],
+            buttons={"cancel": "<b style='color:Red !important;'>Avbryt</b>"},
+            formatters={"progress": {"type": "progress", "max": 100}},
+            titles={"name": "Beräkning", "status": "Status", "progress": "Förlopp",
+                    "message": "Meddelande"},
+            sizing_mode="stretch_width",
+            max_height=300,
+        )
+        self.table.on_click(self.cancel_handler)
+        self.layout = pn.Column(pn.pane.Markdown("**Mina beräkningsjobb**"), self.table,
+                                sizing_mode="stretch_width")
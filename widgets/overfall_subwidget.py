@@ -9,25 +9,29 @@ import panel as pn
 import param
 from bokeh.layouts import column, row
 from bokeh.plotting import figure
-from bokeh.models import (Button, Div, TextInput, Paragraph, RadioGroup,
-                          DatetimeTickFormatter)
+from bokeh.models import Button, Div, TextInput, Paragraph, RadioGroup
 from bokeh.models.widgets import AutocompleteInput
-from calculations.database_queries import (update_data, get_ts_from_id,
-                                           store_calc_metadata, store_calc_ts,
-                                           dataframe_to_input_data,
-                                           delete_data_by_id)
+from calculations.database_queries import delete_data_by_id
 #from panel.widgets import Tabulator
 #from functools import partial
 #import pandas as pd
 #import numpy as np
 #import time
 from calculations.flow_calculations import overfall
+from calculations.async_queries import get_ts_window
+from calculations.caches import get_signal_catalog
+from calculations.downsampling import plot_max_points
+from widgets.job_queue_widget import CalculationJobMixin, run_in_session
+from widgets.time_series_viewer import TimeSeriesViewer
 
 
 logger = logging.getLogger(__name__)
 logger.propagate = False
 
-class OverfallSubWidget(param.Parameterized):
+class OverfallSubWidget(CalculationJobMixin, param.Parameterized):
+    calc_type = "overfall"
+    error_text = "Ett fel uppstod. Kontrollera att ID inte redan finns och att alla fält är ifyllda korrekt."
+
     input_data = param.Parameter()
     input_data_name = param.String()
     input_data_id = param.String()
@@ -46,6 +50,7 @@ class OverfallSubWidget(param.Parameterized):
         self.input_data_name = input_data_name
         self.input_data_id = input_data_id
         self.edit_mode = edit_mode
+        self.job = None
         self.init_ui()
 
         # Predecide input field values if optional parameters are provided
@@ -94,10 +99,16 @@ class OverfallSubWidget(param.Parameterized):
             now = datetime.datetime.now()
             self.start_time = (now - relativedelta(months=1))
             self.end_time = now
+            run_in_session(self.load_input_data)
 
-            self.input_data = get_ts_from_id(self.input_data_id, self.start_time, self.end_time)
+    async def load_input_data(self):
+        self.input_data = await get_ts_window("acurve", self.input_data_id, self.start_time, self.end_time,
+                                              plot_max_points(self.graph))
     
     def preview_button_callback(self, values):
+        run_in_session(self.update_preview)
+
+    async def update_preview(self):
         activated_index = self.unit_button.active
         self.selected_unit = self.unit_button.labels[activated_index]
         print(self.selected_unit)
@@ -105,29 +116,35 @@ class OverfallSubWidget(param.Parameterized):
         display_name = f"{self.input_data_id}, {self.input_data_name}" 
         time_series = self.input_data
 
-        try:
-            self.Q_data = overfall(time_series, self.convert_to_float(self.ski_height.value), self.convert_to_float(self.ski_width.value), self.selected_unit)
+        height, width, unit = (self.convert_to_float(self.ski_height.value),
+                               self.convert_to_float(self.ski_width.value), self.selected_unit)
+
+        def flow(level):
+            return overfall(level, height, width, unit)
 
-            self.graph.renderers.clear()
+        try:
+            # Förhandsgranskningen räknas om för varje fönster som zoomas fram
+            self.Q_data = flow(time_series)
+            if self.viewer.selected_id != self.input_data_id:
+                self.input_data = await self.viewer.show(self.input_data_id, *self.viewer.window_of(time_series),
+                                                         transform=flow)
+            else:
+                self.viewer.set_transform(flow)
             self.graph.title.text = f"Flödesberäkning, {display_name}"
             self.graph.yaxis.axis_label = f"Flöde ({self.selected_unit})"
-            self.graph.line(x=self.input_data.index, y=self.Q_data, line_width=2)
-            self.graph.xaxis.formatter = DatetimeTickFormatter(days="%Y-%m-%d")
 
         except Exception as e:
             print(f"got exception! {e}")
-            self.graph.renderers.clear()
-            self.graph.line(x=list(range(len(time_series))), y=time_series, line_width=2)
-            self.graph.xaxis.formatter = DatetimeTickFormatter(days="%Y-%m-%d")
+            if self.viewer.selected_id is not None:
+                self.viewer.set_transform(None)
             # self.graph.title.text = "Skriv in numeriska värden"
 
+    def window_loaded(self, start_time, end_time):
+        self.start_time, self.end_time = start_time, end_time
+        self.input_data = self.viewer.data
+
     def save_button_callback(self, values):
-        self.load_display('on')
-        self.confirm_button.disabled = True
-        self.loading.name = "Skapar beräkning..."
         self.create_calculation(values)
-        self.load_display('off')
-        self.confirm_button.disabled = False
 
     def no_click_callback(self):
         # return to previous layout
@@ -159,49 +176,22 @@ class OverfallSubWidget(param.Parameterized):
     def create_calculation(self, values):
         input_var= np.array([str(self.ID_textbox.value), str(self.name_textbox.value), str(self.ski_height.value), str(self.ski_width.value)])
         if np.any(input_var==""):
-            self.load_display('off')
             self.status_text.text = "<b style='color:red;'>Alla fällt är inte ifyllda. </b>"
             return
-            
-        try:
-            if self.edit_mode: 
-                delete_data_by_id(self.ID_textbox.value)
-                # Om Id inte har blivit ändrat i fältet, radera den gamla beräkningen 
-                # Om Id ändras tas inte den gamla beräkningen bort
-        except:
-            pass # ingen data att ta bort, nytt id
 
-        try:
-            print(self.input_data_id)
-            full_data = get_ts_from_id(self.input_data_id, None, None, all_data=True)
-            self.selected_unit = self.unit_button.labels[self.unit_button.active]
-
-            Q_data = overfall(
-                full_data, 
-                self.convert_to_float(self.ski_height.value),
-                self.convert_to_float(self.ski_width.value),
-                self.selected_unit,
-                dataframe=True
-            )
-            new_data = dataframe_to_input_data(Q_data, str(self.ID_textbox.value))
-            self.loading.name = "Sparar beräkning, detta kan ta ett tag..."
-            store_calc_metadata(
-                str(self.ID_textbox.value),
-                str(self.name_textbox.value),
-                str(self.input_data_id),
-                "overfall",
-                str(self.selected_unit),
-                (self.convert_to_float(self.ski_height.value),
-                 self.convert_to_float(self.ski_width.value))
-            )
-            store_calc_ts(new_data)
-            
-            self.status_text.text = "<b style='color:green;'>Insättning lyckades</b>"
+        self.selected_unit = self.unit_button.labels[self.unit_button.active]
+        calc = {
+            "unique_id": str(self.ID_textbox.value),
+            "name": str(self.name_textbox.value),
+            "input_id": str(self.input_data_id),
+            "unit": str(self.selected_unit),
+            "parameters": (self.convert_to_float(self.ski_height.value),
+                           self.convert_to_float(self.ski_width.value)),
+            "edit_mode": self.edit_mode,
+        }
 
-        except Exception as e:
-            print("Error:", e)
-            self.load_display('off')
-            self.status_text.text = "<b style='color:red;'>Ett fel uppstod. Kontrollera att ID inte redan finns och att alla fält är ifyllda korrekt.</b>"
+        # Beräkningen körs som bakgrundsjobb så att sessionen inte låses
+        self.submit_calculation(calc)
 
     def init_ui(self):
         # loading bar and text
@@ -235,18 +225,21 @@ class OverfallSubWidget(param.Parameterized):
         # plot
         activated_index = self.unit_button.active
         activated_label = self.unit_button.labels[activated_index]
-        self.graph = figure(min_width=300, height=150, margin=15, y_axis_label=f"Flöde ({activated_label})", sizing_mode="scale_width")
+        self.graph = figure(min_width=300, height=150, margin=15, y_axis_label=f"Flöde ({activated_label})",
+                            sizing_mode="scale_width", x_axis_type="datetime")
+        self.viewer = TimeSeriesViewer("acurve", self.graph, on_update=self.window_loaded)
 
         # Uppdatera, spara knappar
         update_button = Button(label="Förhandsgranska beräkning")
         update_button.on_click(self.preview_button_callback)
         self.confirm_button = Button(label="Spara beräkning", button_type = 'primary') #button_type = 'success') #
         self.confirm_button.on_click(self.save_button_callback)
+        self.cancel_button = Button(label="Avbryt", button_type='warning', visible=False)
+        self.cancel_button.on_click(self.cancel_button_callback)
 
         if self.edit_mode:
             # autocomplete input
-            self.df = update_data()
-            self.df['Search'] = self.df.apply(lambda x: f"{x['SubjectID']} | {x['name']} | {x['unit']} |{x['beskrivning']}", axis=1)
+            self.df = get_signal_catalog()
             completion_list = self.df['Search'].tolist()
             autocomplete_input = AutocompleteInput(completions=completion_list, title="Ändra insignal:", case_sensitive=False,
                                                               search_strategy='includes', min_characters=0, max_completions=10)
@@ -267,7 +260,7 @@ class OverfallSubWidget(param.Parameterized):
             options_column = pn.Row(
                 pn.Column(ID_layout, name_layout, unitchoice_layout),
                 pn.Column(update_button, pn.Row(self.confirm_button, self.delete_button)),
-                pn.Column(self.loading, self.status_text)
+                pn.Column(self.loading, self.status_text, self.cancel_button)
             )
             # slutgiltig layout
             self.layout = pn.Column(
@@ -279,7 +272,7 @@ class OverfallSubWidget(param.Parameterized):
             options_column = pn.Row(
                 pn.Column(ID_layout, name_layout, unitchoice_layout),
                 pn.Column(update_button, self.confirm_button),
-                pn.Column(self.loading, self.status_text)
+                pn.Column(self.loading, self.status_text, self.cancel_button)
             )
             self.layout = pn.Column(
                 title_text,
@@ -9,14 +9,16 @@ import panel as pn
 import param
 from bokeh.layouts import column, row
 from bokeh.plotting import figure
-from bokeh.models import (Button, Div, TextInput, Paragraph, RadioGroup,
-                          DatetimeTickFormatter, Tooltip)
+from bokeh.models import Button, Checkbox, Div, TextInput, Paragraph, RadioGroup, Tooltip
 from bokeh.models.dom import HTML
 from bokeh.models.widgets import AutocompleteInput
-from calculations.database_queries import (update_data, get_ts_from_id,
-                                           store_calc_metadata, store_calc_ts,
-                                           dataframe_to_input_data, delete_data_by_id)
+from calculations.database_queries import delete_data_by_id
 from calculations.flow_calculations import cole_white_with_loss, cole_white_flow_calc
+from calculations.downsampling import plot_max_points
+from calculations.async_queries import get_ts_window
+from calculations.caches import get_signal_catalog
+from widgets.job_queue_widget import CalculationJobMixin, run_in_session
+from widgets.time_series_viewer import TimeSeriesViewer
 #import pandas as pd
 #import numpy as np
 #import time
@@ -38,7 +40,10 @@ info_message = """    <p align="center"><b style='color:black;'>Riktlinje råhet
 """
 
 
-class PipeflowSubWidget(param.Parameterized):
+class PipeflowSubWidget(CalculationJobMixin, param.Parameterized):
+    calc_type = "rorberakning"
+    error_text = "Ett fel uppstod. Kontrollera att ID inte redan finns."
+
     # Vilka här behövs nu egentligen
     input_data = param.Parameter()
     input_data_name = param.String()
@@ -53,7 +58,7 @@ class PipeflowSubWidget(param.Parameterized):
 
     def __init__(self, input_data, input_data_name, input_data_id, 
                  calc_unique_id=None, calc_name=None, unit=None, 
-                 slope=None, diameter=None, roughness=None, edit_mode=False, **params):
+                 slope=None, diameter=None, roughness=None, solve_loss=False, edit_mode=False, **params):
         super().__init__(**params)
         self.input_data = input_data
         self.input_data_name = input_data_name
@@ -63,6 +68,7 @@ class PipeflowSubWidget(param.Parameterized):
         self.start_time = (now - relativedelta(months=1))
         self.end_time = now
         self.clicked_count = 1
+        self.job = None
         self.init_ui()
 
         if calc_unique_id:
@@ -83,6 +89,7 @@ class PipeflowSubWidget(param.Parameterized):
         if roughness:
             self.selected_raa = roughness
             self.raa.value = str(roughness)
+        self.solve_loss.active = bool(solve_loss)
 
     def load_display(self, x):
         if x == 'on':
@@ -112,65 +119,60 @@ class PipeflowSubWidget(param.Parameterized):
             now = datetime.datetime.now()
             self.start_time = (now - relativedelta(months=1))
             self.end_time = now
+            run_in_session(self.load_input_data)
+
+    async def load_input_data(self):
+        self.input_data = await get_ts_window("acurve", self.input_data_id, self.start_time, self.end_time,
+                                              plot_max_points(self.graph))
+
+    def window_loaded(self, start_time, end_time):
+        self.start_time, self.end_time = start_time, end_time
+        self.input_data = self.viewer.data
 
-            self.input_data = get_ts_from_id(self.input_data_id, self.start_time, self.end_time)
-
-    def load_ts_prev_month(self, event):
-        new_start_time = self.start_time - relativedelta(months=1)
-        if new_start_time <= datetime.datetime.now():
-            self.start_time = new_start_time
-            self.end_time = self.start_time + relativedelta(months=1) - datetime.timedelta(days=1)
-            self.input_data = get_ts_from_id(self.input_data_id, self.start_time, self.end_time)
-            # self.date_text.value = f"{self.start_time.strftime('%Y-%m-%d')} - {self.end_time.strftime('%Y-%m-%d')}"
-            self.update_plot()
-
-    def load_ts_next_month(self, event):
-        new_start_time = self.start_time + relativedelta(months=1)
-        if new_start_time <= datetime.datetime.now():
-            self.start_time = new_start_time
-            self.end_time = self.start_time + relativedelta(months=1) - datetime.timedelta(days=1)
-            self.input_data = get_ts_from_id(self.input_data_id, self.start_time, self.end_time)
-            # self.date_text.value = f"{self.start_time.strftime('%Y-%m-%d')} - {self.end_time.strftime('%Y-%m-%d')}"
-            self.update_plot()
-
-    def update_plot(self):
-        self.graph.renderers.clear()
-        # self.graph.title.text = f"Flödesberäkning, {display_name}"
-        self.graph.yaxis.axis_label = f"Flöde ({self.selected_unit})"
-        self.graph.line(x=self.input_data.index, y=self.Q_data, line_width=2)
-        self.graph.xaxis.formatter = DatetimeTickFormatter(days="%Y-%m-%d")
+    def load_ts_prev_window(self, event):
+        run_in_session(self.viewer.pan, -1)
+
+    def load_ts_next_window(self, event):
+        run_in_session(self.viewer.pan, 1)
 
     def preview_button_callback(self, values):
+        run_in_session(self.update_preview)
+
+    async def update_preview(self):
         activated_index = self.unit_button.active
         self.selected_unit = self.unit_button.labels[activated_index]
 
         display_name = f"{self.input_data_id}, {self.input_data_name}" 
         time_series = self.input_data
 
+        slope, diameter, roughness, unit = (self.convert_to_float(self.slope.value),
+                                            self.convert_to_float(self.diameter.value),
+                                            self.convert_to_float(self.raa.value),
+                                            self.selected_unit)
+        solve_loss = self.solve_loss.active
+
+        def flow(level):
+            return cole_white_with_loss(level, slope, diameter, roughness, unit, solve_loss=solve_loss)
+
         try:
-            self.Q_data = cole_white_with_loss(
-                time_series,
-                self.convert_to_float(self.slope.value),
-                self.convert_to_float(self.diameter.value),
-                self.convert_to_float(self.raa.value),
-                self.selected_unit
-            )
-            self.update_plot()
+            # Förhandsgranskningen räknas om för varje fönster som zoomas fram
+            self.Q_data = flow(time_series)
+            if self.viewer.selected_id != self.input_data_id:
+                self.input_data = await self.viewer.show(self.input_data_id, *self.viewer.window_of(time_series),
+                                                         transform=flow)
+            else:
+                self.viewer.set_transform(flow)
+            # self.graph.title.text = f"Flödesberäkning, {display_name}"
+            self.graph.yaxis.axis_label = f"Flöde ({self.selected_unit})"
 
         except Exception as e:
             print(f"got exception! {e}")
-            self.graph.renderers.clear()
-            self.graph.line(x=list(range(len(time_series))), y=time_series, line_width=2)
-            self.graph.xaxis.formatter = DatetimeTickFormatter(days="%Y-%m-%d")
+            if self.viewer.selected_id is not None:
+                self.viewer.set_transform(None)
             # self.graph.title.text = "Fel vid skapande av beräkning, skriv in numeriska värden"
 
     def save_button_callback(self, values):
-        self.load_display('on')
-        self.confirm_button.disabled = True
-        self.loading.name = "Skapar beräkning..."
         self.create_calculation(values)
-        self.load_display('off')
-        self.confirm_button.disabled = False
 
     def no_click_callback(self):
         # return to previous layout
@@ -202,50 +204,24 @@ class PipeflowSubWidget(param.Parameterized):
     def create_calculation(self, values):
         input_var= np.array([str(self.ID_textbox.value), str(self.name_textbox.value), str(self.slope.value), str(self.diameter.value), str(self.raa.value)])
         if np.any(input_var==""):
-            self.load_display('off')
             self.status_text.text = "<b style='color:red;'>Alla fällt är inte ifyllda. </b>"
             return
-        
-        try:
-            if self.edit_mode:
-                delete_data_by_id(self.ID_textbox.value)
-                # Om Id inte har blivit ändrat i fältet, radera den gamla beräkningen 
-                # Om Id ändras tas inte den gamla beräkningen bort
-        except:
-            pass # ingen data att ta bort, nytt id
-
-        try:
-            full_data = get_ts_from_id(self.input_data_id, None, None, all_data=True)
-            self.selected_unit = self.unit_button.labels[self.unit_button.active]
-
-            Q_data = cole_white_with_loss(
-                full_data,
-                self.convert_to_float(self.slope.value),
-                self.convert_to_float(self.diameter.value),
-                self.convert_to_float(self.raa.value),
-                self.selected_unit,
-                dataframe=True
-            )
-            new_data = dataframe_to_input_data(Q_data, str(self.ID_textbox.value))
-            self.loading.name = "Sparar beräkning, detta kan ta ett tag..."
-            store_calc_metadata(
-                str(self.ID_textbox.value),
-                str(self.name_textbox.value),
-                str(self.input_data_id),
-                "rorberakning",
-                str(self.selected_unit),
-                (self.convert_to_float(self.slope.value),
-                 self.convert_to_float(self.diameter.value),
-                 self.convert_to_float(self.raa.value))
-            )
-            store_calc_ts(new_data)
-
-            self.status_text.text = "<b style='color:green;'>Insättning lyckades</b>"
 
-        except Exception as e:
-            print("Error:", e)
-            self.load_display('off')
-            self.status_text.text = "<b style='color:red;'>Ett fel uppstod. Kontrollera att ID inte redan finns.</b>"
+        self.selected_unit = self.unit_button.labels[self.unit_button.active]
+        calc = {
+            "unique_id": str(self.ID_textbox.value),
+            "name": str(self.name_textbox.value),
+            "input_id": str(self.input_data_id),
+            "unit": str(self.selected_unit),
+            "parameters": (self.convert_to_float(self.slope.value),
+                           self.convert_to_float(self.diameter.value),
+                           self.convert_to_float(self.raa.value),
+                           self.solve_loss.active),
+            "edit_mode": self.edit_mode,
+        }
+
+        # Beräkningen körs som bakgrundsjobb så att sessionen inte låses
+        self.submit_calculation(calc)
     
     def open_info_box(self, event):
         if self.clicked_count % 2 == 0:
@@ -271,6 +247,8 @@ class PipeflowSubWidget(param.Parameterized):
         self.info_button = pn.widgets.Button(name='🛈', width=15, margin=1, align=('start', 'center'), button_type="default", button_style='outline')
         self.info_button.on_click(self.open_info_box)
         self.raa = TextInput(value="", title="Råhet (mm)", width=70)
+        # Flödet vid nivån där förlusthöjden 1.5 v²/2g är avdragen, se solve_head_loss
+        self.solve_loss = Checkbox(label="Beräkna med förlusthöjd", active=False)
         self.slope = TextInput(title="Lutning (‰)", width=100)
         self.diameter = TextInput(title="Diameter (mm)", width=100)
 
@@ -295,25 +273,28 @@ class PipeflowSubWidget(param.Parameterized):
 
         activated_index = self.unit_button.active
         activated_label = self.unit_button.labels[activated_index]
-        self.graph = figure(min_width=300, height=150, margin=15, y_axis_label=f"Flöde ({activated_label})", sizing_mode="scale_width")
+        self.graph = figure(min_width=300, height=150, margin=15, y_axis_label=f"Flöde ({activated_label})",
+                            sizing_mode="scale_width", x_axis_type="datetime")
+        self.viewer = TimeSeriesViewer("acurve", self.graph, on_update=self.window_loaded)
 
         # Uppdatera, spara knappar
         update_button = Button(label="Förhandsgranska beräkning")
         update_button.on_click(self.preview_button_callback)
         self.confirm_button = Button(label="Spara beräkning", button_type = 'primary') #button_type = 'success') #
         self.confirm_button.on_click(self.save_button_callback)
+        self.cancel_button = Button(label="Avbryt", button_type='warning', visible=False)
+        self.cancel_button.on_click(self.cancel_button_callback)
 
         # info box and foward, back buttons
         self.info_textbox = pn.pane.Markdown(info_message, styles={'border': "1px solid black"}, height=250, margin=15, max_width=500, align='end')
         
         backward = pn.widgets.Button(name='\u25c0', width=50)
         forward = pn.widgets.Button(name='\u25b6', width=50)
-        backward.on_click(self.load_ts_prev_month)
-        forward.on_click(self.load_ts_next_month)
+        backward.on_click(self.load_ts_prev_window)
+        forward.on_click(self.load_ts_next_window)
 
         if self.edit_mode:
-            self.df = update_data()
-            self.df['Search'] = self.df.apply(lambda x: f"{x['SubjectID']} | {x['name']} | {x['unit']} |{x['beskrivning']}", axis=1)
+            self.df = get_signal_catalog()
             completion_list = self.df['Search'].tolist()
             autocomplete_input = AutocompleteInput(completions=completion_list,
                                                    title="Ändra insignal:",
@@ -337,12 +318,12 @@ class PipeflowSubWidget(param.Parameterized):
 
             options_column = pn.Row(pn.Column(ID_layout, name_layout, layout_unitchoice),
                                     pn.Column(update_button, pn.Row(self.confirm_button, self.delete_button)), 
-                                    pn.Column(self.loading, self.status_text))
+                                    pn.Column(self.loading, self.status_text, self.cancel_button))
 
             self.layout = pn.Column(
                 autocomplete_input,
                 pn.Row(png_pane,
-                       pn.Column(self.slope, self.diameter, pn.Row(self.raa, self.info_button)), self.graph),  #,pn.Row(backward, forward)),
+                       pn.Column(self.slope, self.diameter, pn.Row(self.raa, self.info_button), self.solve_loss), self.graph),  #,pn.Row(backward, forward)),
                 options_column
             )
             #self.layout = column(self.slope, self.diameter, self.raa)
@@ -350,11 +331,11 @@ class PipeflowSubWidget(param.Parameterized):
         else:
             options_column = pn.Row(pn.Column(ID_layout, name_layout, layout_unitchoice),
                                     pn.Column(update_button, self.confirm_button), 
-                                    pn.Column(self.loading, self.status_text))
+                                    pn.Column(self.loading, self.status_text, self.cancel_button))
             self.layout = pn.Column(
                 title_text,
                 pn.Row(png_pane,
-                       pn.Column(self.slope, self.diameter, pn.Row(self.raa, self.info_button)), self.graph),
+                       pn.Column(self.slope, self.diameter, pn.Row(self.raa, self.info_button), self.solve_loss), self.graph),
                 options_column
             )
             #pn.widgets.TooltipIcon(value=Tooltip(content="This is a tooltip using a bokeh.models.Tooltip", position="right")
@@ -0,0 +1,92 @@
+import logging
+from bokeh.models import ColumnDataSource, HoverTool
+from bokeh.plotting import figure
+from calculations.caches import to_web_mercator
+
+
+logger = logging.getLogger(__name__)
+logger.propagate = False
+
+# Startvy över Göteborg och halva bredden (m) av vyn runt en vald mätare
+default_center = (57.70887, 11.97456)
+zoom_half_width = 1500
+
+
+class SignalMap:
+    """
+    Tile map with one marker per signal in the catalog.
+
+    The markers are a single scatter glyph on a ColumnDataSource built once
+    from the catalog's mercator columns. Selecting a signal only changes
+    source.selected.indices and the map ranges, so the browser restyles one
+    marker instead of reloading the map, whatever the size of the catalog.
+    """
+
+    def __init__(self, df, on_select=None, height=600):
+        """
+        Parameters:
+            df (pandas.DataFrame): The signal catalog, see get_signal_catalog.
+            on_select (callable): Called with the catalog position of a
+                marker clicked on the map.
+            height (int): Height of the map in pixels.
+        """
+        self.on_select = on_select
+        self._selecting = False
+        self.source = ColumnDataSource(data=self._marker_data(df))
+
+        self.plot = figure(x_axis_type="mercator", y_axis_type="mercator", height=height, min_width=300,
+                           sizing_mode="stretch_width", match_aspect=True,
+                           tools="pan,wheel_zoom,tap,reset", active_scroll="wheel_zoom")
+        self.plot.add_tile("OpenStreetMap Mapnik")
+        self.plot.axis.visible = False
+        self.plot.grid.visible = False
+        renderer = self.plot.scatter("x", "y", source=self.source, size=12, marker="circle",
+                                     fill_color="blue", line_color="white",
+                                     selection_fill_color="orange", selection_line_color="black",
+                                     nonselection_fill_color="blue", nonselection_fill_alpha=1.0,
+                                     nonselection_line_alpha=1.0)
+        self.plot.add_tools(HoverTool(renderers=[renderer], tooltips=[("ID", "@SubjectID"), ("Namn", "@name")]))
+        self.center_on(*to_web_mercator(*default_center))
+        self.source.selected.on_change("indices", self._tap)
+
+    @staticmethod
+    def _marker_data(df):
+        return {
+            "x": df["mercator_x"].values,
+            "y": df["mercator_y"].values,
+            "SubjectID": df["SubjectID"].astype(str).values,
+            "name": df["name"].astype(str).values,
+        }
+
+    def update_catalog(self, df):
+        """
+        Replace the markers with those of a reloaded catalog, keeping the view.
+        """
+        self._selecting = True
+        try:
+            self.source.selected.indices = []
+            self.source.data = self._marker_data(df)
+        finally:
+            self._selecting = False
+
+    def center_on(self, x, y):
+        x, y = float(x), float(y)
+        self.plot.x_range.update(start=x - zoom_half_width, end=x + zoom_half_width)
+        self.plot.y_range.update(start=y - zoom_half_width, end=y + zoom_half_width)
+
+    def select(self, position):
+        """
+        Highlight the marker at a catalog position and center the map on it.
+        """
+        if self.source.selected.indices != [position]:
+            self._selecting = True
+            try:
+                self.source.selected.indices = [position]
+            finally:
+                self._selecting = False
+        self.center_on(self.source.data["x"][position], self.source.data["y"][position])
+
+    def _tap(self, attr, old, new):
+        # Överlappande markörer ger flera index, den första väljs
+        if new and not self._selecting and self.on_select is not None:
+            self.on_select(new[0])
@@ -0,0 +1,252 @@
+import datetime
+import logging
+import numpy as np
+import pandas as pd
+from bokeh.events import RangesUpdate
+from bokeh.models import ColumnDataSource, DatetimeTickFormatter, Legend, LegendItem, Range1d
+from bokeh.palettes import Category10_10
+from calculations.async_queries import get_ts_window, get_ts_windows, get_ts_extent
+from calculations.downsampling import plot_max_points
+from widgets.job_queue_widget import run_in_session
+
+
+logger = logging.getLogger(__name__)
+logger.propagate = False
+
+# Hämtat fönster = synligt fönster plus så här mycket åt varje håll,
+# så att korta panoreringar inte behöver någon ny fråga
+fetch_margin = 0.5
+# Inzoomning mer än så här gånger mot hämtad upplösning hämtar om fönstret
+zoom_reload_factor = 2
+default_window = datetime.timedelta(days=30)
+# En färg per jämförd serie, den första är linjens standardfärg
+compare_colors = Category10_10
+max_compare = len(compare_colors)
+
+
+def _epoch_ms(times):
+    # Flyttal i ms skickas som binär array, datetime64 skulle konverteras per anrop
+    return np.asarray(times, dtype="M8[ms]").astype(np.int64).astype(np.float64)
+
+
+def _to_datetime(value):
+    # Bokeh skickar datetime-axlar som ms sedan 1970
+    if isinstance(value, (int, float, np.number)):
+        return pd.Timestamp(value, unit="ms").to_pydatetime()
+    return pd.Timestamp(value).to_pydatetime()
+
+
+class TimeSeriesViewer:
+    """
+    Zoom-driven time-series line in a Bokeh figure.
+
+    The figure keeps one line renderer and one ColumnDataSource for its
+    whole life. New windows replace source.data with float64 NumPy arrays,
+    which Bokeh sends as binary buffers, and a new preview transform only
+    replaces the y column. Every pan or zoom (RangesUpdate) requests the visible window with a
+    margin from get_ts_window, at the number of points the figure width can
+    show. Short windows come from the month cache and long ones from the
+    rollup tables, so the whole history can be browsed without ever sending
+    more than a few thousand points. The ◀/▶ buttons call pan().
+
+    show(), pan() and load() are coroutines that await the async query API,
+    so other sessions are served while the database works. They must run
+    with the document lock, e.g. from run_in_session.
+
+    compare() shows up to max_compare series at once. They are fetched in
+    one query, aligned on a shared time axis and drawn from the same
+    source, as the columns y, y1, y2, ... with one line renderer each.
+    """
+
+    def __init__(self, kind, plot, transform=None, on_update=None):
+        """
+        Parameters:
+            kind (str): "acurve" or "flow", see get_ts_window.
+            plot (bokeh.plotting.figure): Figure to draw in.
+            transform (callable): Optional function of the fetched DataFrame
+                giving the plotted values, e.g. a flow preview of a level.
+            on_update (callable): Called with (start_time, end_time) of the
+                visible window after every load.
+        """
+        self.kind = kind
+        self.plot = plot
+        self.transform = transform
+        self.on_update = on_update
+        self.selected_id = None
+        self.compare_ids = None
+        self.data = None
+        self.bounds = None
+        self._loaded = None
+        self._visible = None
+        self.source = ColumnDataSource(data={"x": np.empty(0), "y": np.empty(0)})
+
+        plot.x_range = Range1d(start=datetime.datetime.now() - default_window, end=datetime.datetime.now())
+        plot.xaxis.formatter = DatetimeTickFormatter(days="%Y-%m-%d")
+        self.renderer = plot.line(x="x", y="y", source=self.source, line_width=2)
+        self.compare_renderers = []
+        self.legend = None
+        plot.on_event(RangesUpdate, self._ranges_update)
+
+    async def show(self, selected_id, start_time=None, end_time=None, transform=None):
+        """
+        Show a series, by default the month up to its last sample.
+
+        Returns:
+            pandas.DataFrame: The fetched window, see data.
+        """
+        self.selected_id = selected_id
+        self.compare_ids = None
+        if transform is not None:
+            self.transform = transform
+        self._show_compare_renderers([])
+        first, last = await get_ts_extent(self.kind, selected_id)
+        return await self._show_window(first, last, start_time, end_time)
+
+    async def compare(self, selected_ids, start_time=None, end_time=None):
+        """
+        Show several series in one plot, by default the month up to the last
+        sample of any of them. Without transform.
+
+        Returns:
+            pandas.DataFrame: The fetched window, one column per ID.
+        """
+        selected_ids = [str(i) for i in selected_ids][:max_compare]
+        self.selected_id = selected_ids[0]
+        self.compare_ids = selected_ids
+        self.transform = None
+        self._show_compare_renderers(selected_ids)
+        first, last = await get_ts_extent(self.kind, selected_ids)
+        return await self._show_window(first, last, start_time, end_time)
+
+    async def _show_window(self, first, last, start_time, end_time):
+        now = datetime.datetime.now()
+        end_time = _to_datetime(end_time) if end_time is not None else min(last or now, now)
+        start_time = _to_datetime(start_time) if start_time is not None else end_time - default_window
+        self.bounds = (min(first or start_time, start_time), max(last or end_time, end_time, now))
+
+        self.plot.x_range.update(start=start_time, end=end_time, bounds=self.bounds)
+        return await self.load(start_time, end_time)
+
+    def _show_compare_renderers(self, selected_ids):
+        # Renderarna skapas första gången de behövs och återanvänds sedan
+        while len(self.compare_renderers) < len(selected_ids) - 1:
+            column = f"y{len(self.compare_renderers) + 1}"
+            self.source.data[column] = np.full(len(self.source.data["x"]), np.nan)
+            self.compare_renderers.append(self.plot.line(
+                x="x", y=column, source=self.source, line_width=2,
+                line_color=compare_colors[len(self.compare_renderers) + 1]))
+        for i, renderer in enumerate(self.compare_renderers):
+            renderer.visible = i < len(selected_ids) - 1
+
+        if self.legend is None and selected_ids:
+            self.legend = Legend(items=[], location="top_left", click_policy="hide")
+            self.plot.add_layout(self.legend)
+        if self.legend is not None:
+            renderers = [self.renderer] + self.compare_renderers
+            self.legend.items = [LegendItem(label=selected_id, renderers=[renderer])
+                                 for selected_id, renderer in zip(selected_ids, renderers)]
+            self.legend.visible = bool(selected_ids)
+
+    def _set_columns(self, times, columns):
+        # Alla kolumner i källan måste ha samma längd, dolda renderare får NaN
+        x = _epoch_ms(times)
+        data = {"x": x}
+        for i in range(len(self.compare_renderers) + 1):
+            data["y" if i == 0 else f"y{i}"] = columns[i] if i < len(columns) else np.full(len(x), np.nan)
+        self.source.data = data
+
+    @staticmethod
+    def window_of(data):
+        """
+        (start_time, end_time) of a fetched DataFrame, (None, None) if empty,
+        for show() with the window another viewer had.
+        """
+        if data is None or len(data) < 2:
+            return None, None
+        return data.index[0], data.index[-1]
+
+    def set_transform(self, transform):
+        """
+        Replace the transform and redraw the fetched window without a new query.
+        """
+        self.transform = transform
+        if self.data is not None and not self.compare_ids:
+            self.source.data["y"] = self._values(self.data)
+
+    def clear(self):
+        """
+        Empty the plot until the next show().
+        """
+        self.selected_id = None
+        self.compare_ids = None
+        self.data = None
+        self._loaded = None
+        self._show_compare_renderers([])
+        self._set_columns(np.empty(0, dtype="M8[ms]"), [])
+
+    def _values(self, data):
+        values = data if self.transform is None else self.transform(data)
+        return np.asarray(values, dtype=np.float64).ravel()
+
+    async def pan(self, step):
+        """
+        Move the visible window step widths forward (step > 0) or back.
+        """
+        if self.selected_id is None or self._loaded is None:
+            return
+        start_time, end_time = self._visible
+        width = end_time - start_time
+        start_time = min(max(start_time + step * width, self.bounds[0]), self.bounds[1] - width)
+        self.plot.x_range.update(start=start_time, end=start_time + width)
+        await self.load(start_time, start_time + width)
+
+    async def load(self, start_time, end_time):
+        """
+        Fetch the window around start_time - end_time and redraw.
+        """
+        width = end_time - start_time
+        fetch_start = max(start_time - fetch_margin * width, self.bounds[0])
+        fetch_end = min(end_time + fetch_margin * width, self.bounds[1])
+        points = int(plot_max_points(self.plot) * (fetch_end - fetch_start) / width)
+
+        if self.compare_ids:
+            data = await get_ts_windows(self.kind, self.compare_ids, fetch_start, fetch_end, max(points, 2))
+            # Serierna har min/max-punkter på olika tider, på den gemensamma tidsaxeln
+            # interpoleras varje serie mellan sina egna punkter som en separat linje skulle ritas
+            self.data = (data.reindex(columns=self.compare_ids).astype(np.float64)
+                         .interpolate(method="index", limit_area="inside"))
+            self._set_columns(self.data.index.values,
+                              [self.data[i].values for i in self.compare_ids])
+        else:
+            self.data = await get_ts_window(self.kind, self.selected_id, fetch_start, fetch_end, max(points, 2))
+            self._set_columns(self.data.index.values, [self._values(self.data)])
+        self._loaded = (fetch_start, fetch_end, width)
+        self._visible = (start_time, end_time)
+        if self.on_update is not None:
+            self.on_update(start_time, end_time)
+        return self.data
+
+    def _covers(self, start_time, end_time):
+        if self._loaded is None:
+            return False
+        fetch_start, fetch_end, width = self._loaded
+        return (fetch_start <= start_time and end_time <= fetch_end
+                and (end_time - start_time) * zoom_reload_factor >= width)
+
+    def _ranges_update(self, event):
+        if self.selected_id is None or event.x0 is None or event.x1 is None:
+            return
+        start_time, end_time = _to_datetime(event.x0), _to_datetime(event.x1)
+        if end_time <= start_time:
+            return
+        self._visible = (start_time, end_time)
+        if self._covers(start_time, end_time):
+            if self.on_update is not None:
+                self.on_update(start_time, end_time)
+            return
+        run_in_session(self._reload, start_time, end_time)
+
+    async def _reload(self, start_time, end_time):
+        # En snabb följd av zoomhändelser köas bakom sessionens lås, bara den senaste hämtas
+        if self._visible == (start_time, end_time) and not self._covers(start_time, end_time):
+            await self.load(start_time, end_time)